@@ -0,0 +1,711 @@
+# benchmarks/benchmark.py
+"""端到端基准测试与负载生成
+
+    python benchmarks/benchmark.py stages -o stages.json
+    python benchmarks/benchmark.py load --clients 8 --requests 20 -o load.json
+    python benchmarks/benchmark.py transport -o transport.json
+    python benchmarks/benchmark.py router --workers 3 --clients 6 -o router.json
+    python benchmarks/benchmark.py compare baseline.json new.json
+
+默认使用随机权重的主干网络和合成图像，不需要下载预训练权重或真实数据。
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# 添加路径以便导入本地模块
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from PIL import Image
+
+# 比较时视为“越小越好”的指标后缀；其余（吞吐量）越大越好
+LOWER_IS_BETTER = ('_ms', '_bytes', '_mb', 'wall_s')
+
+
+def rss_mb():
+    """当前常驻内存（MB）"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # 非Linux：退化为峰值常驻内存
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def timed(func, repeat):
+    """多次运行并返回(每次耗时毫秒列表, 最后一次结果)"""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples, result
+
+
+def summarize(samples):
+    samples = np.asarray(samples)
+    return {
+        'mean_ms': round(float(samples.mean()), 3),
+        'p50_ms': round(float(np.percentile(samples, 50)), 3),
+        'p95_ms': round(float(np.percentile(samples, 95)), 3),
+        'p99_ms': round(float(np.percentile(samples, 99)), 3),
+        'n': int(samples.size),
+    }
+
+
+def make_synthetic_images(directory, count, size):
+    """生成合成RGB图像（平滑背景加噪声），返回路径列表"""
+    rng = np.random.default_rng(0)
+    paths = []
+    yy, xx = np.mgrid[0:size, 0:size] / size
+    for i in range(count):
+        base = 128 + 60 * np.sin(2 * np.pi * (xx * (i % 3 + 1) + yy))
+        noise = rng.normal(0, 20, (size, size, 3))
+        pixels = np.clip(base[..., None] + noise, 0, 255).astype(np.uint8)
+        path = os.path.join(directory, f'synthetic_{i:04d}.png')
+        Image.fromarray(pixels).save(path)
+        paths.append(path)
+    return paths
+
+
+def build_model(feature_dim, n_samples, seed=0):
+    """用合成特征训练PaDiM模型（计时与模型质量无关）"""
+    from server.model import PaDimModel
+
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 1, (4, feature_dim))
+    features = centers[rng.integers(0, 4, n_samples)] + rng.normal(0, 0.3, (n_samples, feature_dim))
+    model = PaDimModel()
+    model.fit(features)
+    return model
+
+
+def environment():
+    import torch
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+# ---- 分阶段基准 ----
+
+def bench_stages(args):
+    from client.encryption import HomomorphicEncryption
+    from server.model import WideResNet101FeatureExtractor
+    from server.server import MedicalAIServer, ClientSession
+    from shared.communication import CommunicationProtocol
+    from shared.preprocessing import decode_image, to_tensor
+    from shared.dtypes import to_compute, to_storage
+
+    results = {'environment': environment(), 'config': vars(args).copy(), 'stages': {}}
+    results['config'].pop('func', None)
+    stages = results['stages']
+
+    extractor = WideResNet101FeatureExtractor(pretrained=args.pretrained)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = make_synthetic_images(tmp, args.images, args.image_size)
+
+        samples, tensors = [], []
+        for path in paths:
+            start = time.perf_counter()
+            tensors.append(to_tensor(decode_image(path)))
+            samples.append((time.perf_counter() - start) * 1000)
+        stages['decode'] = summarize(samples)
+
+    extractor.extract_features(tensors[0])  # 预热
+    samples, features = [], []
+    for tensor in tensors:
+        sample, feature = timed(lambda: extractor.extract_features(tensor), 1)
+        samples += sample
+        features.append(feature)
+    stages['extract'] = summarize(samples)
+
+    model = build_model(features[0].size, args.train_samples)
+    server = MedicalAIServer(port=0, pretrained=args.pretrained)
+    server.swap_model(model)
+    stages['bundle_size_bytes'] = len(pickle.dumps({'version': model.BUNDLE_VERSION, 'model': model}))
+    pca_components, pca_mean = model.pca.components_, model.pca.mean_
+    samples, _ = timed(lambda: (features[0] - pca_mean).dot(pca_components.T), args.repeat)
+    stages['pca_project'] = summarize(samples)
+    reduced = [(f - pca_mean).dot(pca_components.T) for f in features]
+
+    encryption = HomomorphicEncryption()
+    samples, context_bytes = timed(encryption.generate_keys, max(1, args.repeat // 5))
+    stages['keygen'] = summarize(samples)
+    stages['context_size_bytes'] = len(context_bytes)
+
+    samples, encrypted = timed(lambda: encryption.encrypt_features(reduced[0]), args.repeat)
+    stages['encrypt'] = summarize(samples)
+    stages['ciphertext_size_bytes'] = len(encrypted)
+
+    message = {'type': 'encrypted_features', 'features': encrypted}
+    encode = lambda: CommunicationProtocol.encode_payload(message, "json")
+    samples, payload = timed(encode, args.repeat)
+    stages['serialize'] = summarize(samples)
+    stages['request_frame_bytes'] = len(payload) + CommunicationProtocol.HEADER_SIZE
+    samples, _ = timed(
+        lambda: CommunicationProtocol.decode_payload(payload, "json"), args.repeat
+    )
+    stages['deserialize'] = summarize(samples)
+
+    session = ClientSession(server.registry, ('benchmark', 0))
+    samples, _ = timed(lambda: server.setup_tenseal_context(session, context_bytes), 1)
+    stages['context_load'] = summarize(samples)
+    server.process_encrypted_features(encrypted, session)  # 构建预编码常量
+    samples, result = timed(lambda: server.process_encrypted_features(encrypted, session), args.repeat)
+    stages['server_eval'] = summarize(samples)
+    stages['result_size_bytes'] = sum(len(item) for item in result)
+
+    samples, decrypted = timed(lambda: encryption.decrypt_result(result), args.repeat)
+    stages['decrypt'] = summarize(samples)
+
+    # 紧凑数据类型路径：特征经float16缓存，按float32投影后加密
+    compact = to_compute(to_storage(features[0]))
+    compact_reduced = (compact - to_compute(pca_mean)).dot(to_compute(pca_components).T)
+    compact_decrypted = encryption.decrypt_result(server.process_encrypted_features(
+        encryption.encrypt_features(compact_reduced), session
+    ))
+    session.close()
+
+    # 密文结果与双精度明文距离的误差
+    reference = (features[0].astype(np.float64) - pca_mean).dot(pca_components.T.astype(np.float64))
+    plain = ((reference - model.gmm.means_.astype(np.float64)) ** 2).sum(axis=1)
+    scale = np.maximum(np.abs(plain), 1.0)
+    abs_error = np.abs(np.asarray(decrypted) - plain)
+    compact_error = np.abs(np.asarray(compact_decrypted) - plain)
+    results['accuracy'] = {
+        'max_abs_error': float(abs_error.max()),
+        'max_rel_error': float((abs_error / scale).max()),
+        'compact_max_rel_error': float((compact_error / scale).max()),
+        # 判定只依赖最小距离：紧凑路径下的异常分数变化
+        'compact_score_rel_error': float(
+            abs(np.sqrt(np.min(compact_decrypted)) - np.sqrt(plain.min())) / np.sqrt(plain.min())
+        ),
+    }
+    results['memory'] = {'rss_mb': round(rss_mb(), 1), 'peak_rss_mb': round(peak_rss_mb(), 1)}
+    return results
+
+
+# ---- 负载生成 ----
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def run_load_clients(url, keys, clients, requests, during=None):
+    """启动clients个客户端（轮流使用keys中的密钥），各自建立会话后同时开始发送加密请求
+
+    during在所有客户端就绪后、等待结束前调用（例如杀掉服务器进程）。
+    返回(延迟毫秒列表, 错误数, 耗时秒)。
+    """
+    from client.client import MedicalAIClient
+    from shared.communication import CommunicationProtocol
+
+    rng = np.random.default_rng(1)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def run_client(index):
+        encryption = keys[index % len(keys)]
+        client = MedicalAIClient(feature_extractor=object(), encryption=encryption, server_url=url)
+        try:
+            if not client.ensure_session():
+                raise RuntimeError("会话建立失败")
+            encrypted = encryption.encrypt_features(
+                rng.normal(0, 1, client.pca_components.shape[0])
+            )
+            barrier.wait()
+            local = []
+            for request_id in range(requests):
+                start = time.perf_counter()
+                CommunicationProtocol.send_data(client.socket, {
+                    'type': 'encrypted_features', 'request_id': request_id, 'features': encrypted
+                }, "json")
+                response, _ = CommunicationProtocol.receive_data(client.socket)
+                if response is None or response.get('status') != 'success':
+                    with lock:
+                        errors[0] += 1
+                    continue
+                encryption.decrypt_result(response['encrypted_result'])
+                local.append((time.perf_counter() - start) * 1000)
+            with lock:
+                latencies.extend(local)
+        except Exception:
+            with lock:
+                errors[0] += requests
+            try:
+                barrier.abort()
+            except threading.BrokenBarrierError:
+                pass
+        finally:
+            client.close_connection()
+
+    threads = [threading.Thread(target=run_client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+    start = time.perf_counter()
+    if during is not None:
+        during()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def bench_load(args):
+    from client.encryption import HomomorphicEncryption
+    from server.server import MedicalAIServer
+
+    results = {'environment': environment(), 'config': vars(args).copy()}
+    results['config'].pop('func', None)
+
+    model = build_model(args.feature_dim, args.train_samples)
+    port = args.port or free_port()
+    url = f'tcp://localhost:{port}'
+    listen = []
+    if args.transport != 'tcp':
+        if args.port:
+            raise SystemExit("--transport 只能用于本地启动的服务器")
+        url = f'{args.transport}://{tempfile.mkdtemp(prefix="ppmad_load_")}/server.sock'
+        listen.append(url)
+    server = None
+    if not args.port:
+        server = MedicalAIServer(host='localhost', port=port, max_workers=args.clients,
+                                 pretrained=args.pretrained, listen=listen)
+        server.swap_model(model)
+        threading.Thread(target=server.start_server, daemon=True).start()
+        time.sleep(0.5)
+
+    rss_before = rss_mb()
+    # 所有负载客户端共享一组密钥；特征预先加密，测量的是服务器端路径
+    encryption = HomomorphicEncryption()
+    encryption.get_public_context()
+    latencies, errors, wall = run_load_clients(url, [encryption], args.clients, args.requests)
+
+    if server is not None:
+        server.stop_server()
+
+    results['load'] = dict(summarize(latencies) if latencies else {'n': 0})
+    results['load'].update({
+        'clients': args.clients,
+        'errors': errors,
+        'wall_s': round(wall, 3),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+    })
+    results['memory'] = {
+        'rss_before_mb': round(rss_before, 1),
+        'rss_after_mb': round(rss_mb(), 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    return results
+
+
+# ---- 多进程路由 ----
+
+def wait_for_port(port, timeout=60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"服务器进程未在 {timeout} 秒内启动（端口 {port}）")
+
+
+def bench_router(args):
+    """本机启动多个服务器进程和路由器，运行中杀掉一个进程，检查会话转移"""
+    from client.encryption import HomomorphicEncryption
+    from server.router import MedicalAIRouter
+
+    results = {'environment': environment(), 'config': vars(args).copy()}
+    results['config'].pop('func', None)
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    tmp = tempfile.mkdtemp(prefix='ppmad_router_')
+    bundle = os.path.join(tmp, 'model.pkl')
+    build_model(args.feature_dim, args.train_samples).save(bundle)
+
+    ports = [free_port() for _ in range(args.workers)]
+    workers = []
+    for port in ports:
+        with open(os.path.join(tmp, f'worker_{port}.log'), 'wb') as log:
+            workers.append(subprocess.Popen(
+                [sys.executable, os.path.join(root, 'main_server.py'), '--headless', '--port',
+                 str(port), '--model-bundle', bundle, '--max-workers', str(args.clients + 2)],
+                stdout=log, stderr=subprocess.STDOUT
+            ))
+    router = None
+    try:
+        for port in ports:
+            wait_for_port(port)
+        router_port = free_port()
+        router = MedicalAIRouter(
+            [f'tcp://localhost:{router_port}'], [f'tcp://localhost:{port}' for port in ports],
+            health_interval=0.5
+        )
+        threading.Thread(target=router.start, daemon=True).start()
+        router.wait_ready(10)
+        url = f'tcp://localhost:{router_port}'
+
+        # 每组密钥一个上下文指纹；同一指纹的会话应落到同一进程
+        keys = []
+        for _ in range(args.keys):
+            encryption = HomomorphicEncryption()
+            encryption.get_public_context()
+            keys.append(encryption)
+        assignments = {}
+        before = {}
+        killed = None
+
+        def during():
+            nonlocal killed
+            for session in list(router.sessions):
+                if session.worker is not None and session.fingerprint is not None:
+                    assignments.setdefault(session.fingerprint[:12], set()).add(session.worker.url)
+            before.update(
+                {url: state['sessions'] for url, state in router.stats()['workers'].items()}
+            )
+            if args.kill_after > 0:
+                time.sleep(args.kill_after)
+                # 杀掉会话最多的进程，模拟进程崩溃
+                busiest = max(before, key=before.get)
+                killed = workers[ports.index(int(busiest.rsplit(':', 1)[1]))]
+                killed.send_signal(signal.SIGKILL)
+
+        latencies, errors, wall = run_load_clients(url, keys, args.clients, args.requests, during)
+        stats = router.stats()
+    finally:
+        if router is not None:
+            router.drain(5)
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+
+    results['router'] = dict(summarize(latencies) if latencies else {'n': 0})
+    results['router'].update({
+        'workers': args.workers,
+        'clients': args.clients,
+        'keys': args.keys,
+        'errors': errors,
+        'failovers': stats['failovers'],
+        'killed_worker': killed is not None,
+        'max_ms': round(max(latencies), 3) if latencies else None,
+        'wall_s': round(wall, 3),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+    })
+    results['sessions_per_worker'] = before
+    # 每个上下文指纹对应的进程数（一致性哈希下应为1）
+    results['workers_per_context'] = {key: len(urls) for key, urls in assignments.items()}
+    return results
+
+
+# ---- 传输层 ----
+
+def bench_transport(args):
+    """比较TCP回环、Unix域套接字和共享内存传输：帧往返（回显）耗时"""
+    from shared import transport
+    from shared.communication import CommunicationProtocol
+
+    results = {'environment': environment(), 'config': vars(args).copy()}
+    results['config'].pop('func', None)
+    directory = tempfile.mkdtemp(prefix='ppmad_transport_')
+    urls = {
+        'tcp': f'tcp://localhost:{free_port()}',
+        'unix': f'unix://{directory}/unix.sock',
+        'shm': f'shm://{directory}/shm.sock',
+    }
+    rng = np.random.default_rng(0)
+    sizes = [int(size * 1024 * 1024) for size in args.sizes_mb]
+    payloads = {size: rng.bytes(size) for size in sizes}
+
+    def echo(listener):
+        conn, _ = listener.accept()
+        try:
+            while True:
+                payload, data_type = CommunicationProtocol.receive_frame(conn)
+                if payload is None:
+                    break
+                CommunicationProtocol.send_frame(conn, payload, data_type)
+        finally:
+            conn.close()
+
+    for scheme, url in urls.items():
+        listener = transport.Listener(url)
+        thread = threading.Thread(target=echo, args=(listener,), daemon=True)
+        thread.start()
+        conn = transport.connect(url)
+        scheme_results = {}
+        for size, payload in payloads.items():
+            def round_trip():
+                CommunicationProtocol.send_frame(conn, payload, 'binr')
+                return CommunicationProtocol.receive_frame(conn)
+            round_trip()  # 预热
+            samples, (echoed, _) = timed(round_trip, args.repeat)
+            if echoed != payload:
+                raise RuntimeError(f"{scheme} 传输数据不一致")
+            summary = summarize(samples)
+            # 往返传输了两倍的负载
+            summary['throughput_mb_s'] = round(2 * size / 1e6 / (summary['p50_ms'] / 1000), 1)
+            scheme_results[f'{size_label(size)}'] = summary
+        conn.close()
+        thread.join(5)
+        listener.close()
+        results[scheme] = scheme_results
+    os.rmdir(directory)
+    return results
+
+
+def size_label(size):
+    return f'{size / (1024 * 1024):g}MB'
+
+
+# ---- 图像预处理 ----
+
+def make_large_images(directory, count, size):
+    """生成大尺寸JPEG和多页金字塔TIFF（模拟扫描仪输出），返回{格式: 路径列表}"""
+    rng = np.random.default_rng(0)
+    paths = {'jpeg': [], 'tiff': []}
+    yy, xx = np.mgrid[0:size, 0:size] / size
+    for i in range(count):
+        base = 128 + 60 * np.sin(2 * np.pi * (xx * (i % 3 + 1) + yy))
+        noise = rng.normal(0, 20, (size, size, 1))
+        image = Image.fromarray(np.clip(base[..., None] + noise, 0, 255).astype(np.uint8).repeat(3, -1))
+        path = os.path.join(directory, f'large_{i:04d}.jpg')
+        image.save(path, quality=90)
+        paths['jpeg'].append(path)
+        levels = [image.resize((size >> k, size >> k)) for k in range(1, 5) if size >> k >= 224]
+        path = os.path.join(directory, f'large_{i:04d}.tif')
+        image.save(path, save_all=True, append_images=levels, compression='tiff_lzw')
+        paths['tiff'].append(path)
+    return paths
+
+
+def bench_preprocess(args):
+    """比较整图解码+缩放、缩小分辨率解码、磁盘缓存命中和进程池吞吐"""
+    import torchvision.transforms as transforms
+    from shared.preprocessing import Preprocessor, decode_image, to_tensor
+
+    results = {'environment': environment(), 'config': vars(args).copy()}
+    results['config'].pop('func', None)
+    full = transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = make_large_images(tmp, args.images, args.image_size)
+        for fmt, paths in images.items():
+            cache = Preprocessor(cache_dir=os.path.join(tmp, f'cache_{fmt}'))
+            for path in paths:
+                cache.load(path)  # 填充缓存
+            stages = {}
+            samples = []
+            for path in paths:
+                start = time.perf_counter()
+                full(Image.open(path).convert('RGB'))
+                samples.append((time.perf_counter() - start) * 1000)
+            stages['full_decode'] = summarize(samples)
+            samples = []
+            for path in paths:
+                start = time.perf_counter()
+                to_tensor(decode_image(path))
+                samples.append((time.perf_counter() - start) * 1000)
+            stages['reduced_decode'] = summarize(samples)
+            samples = []
+            for path in paths:
+                start = time.perf_counter()
+                cache.load(path)  # 含内容哈希
+                samples.append((time.perf_counter() - start) * 1000)
+            stages['cache_hit'] = summarize(samples)
+
+            pool = Preprocessor(workers=args.workers)
+            list(pool.map(paths[:args.workers]))  # 启动工作进程
+            start = time.perf_counter()
+            for _, tensor in pool.map(paths):
+                if isinstance(tensor, Exception):
+                    raise tensor
+            stages['pool_images_per_s'] = round(len(paths) / (time.perf_counter() - start), 2)
+            pool.close()
+            results[fmt] = stages
+    return results
+
+
+# ---- 结果比较 ----
+
+def flatten(data, prefix=''):
+    items = {}
+    for key, value in data.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            items.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[name] = value
+    return items
+
+
+def compare(baseline, current, tolerance):
+    """逐项比较两次结果，返回(报告行, 回归项列表)"""
+    base = flatten({k: v for k, v in baseline.items() if k not in ('environment', 'config')})
+    new = flatten({k: v for k, v in current.items() if k not in ('environment', 'config')})
+    lines, regressions = [], []
+    for name in sorted(set(base) & set(new)):
+        old_value, new_value = base[name], new[name]
+        if name.endswith('.n'):
+            continue
+        lower_better = name.endswith(LOWER_IS_BETTER) or 'error' in name
+        if name.startswith('accuracy.'):
+            # CKKS噪声每次加密都不同，只在误差数量级变化时报警
+            worse = new_value > max(10 * old_value, 1e-6)
+        elif not old_value:
+            worse = lower_better and new_value > 0
+        else:
+            change = (new_value - old_value) / abs(old_value)
+            worse = change > tolerance if lower_better else change < -tolerance
+        change_text = f'{(new_value - old_value) / abs(old_value):+8.1%}' if old_value else '     n/a'
+        flag = '  <-- 回归' if worse else ''
+        lines.append(f'{name:45s} {old_value:>14.3f} {new_value:>14.3f} {change_text}{flag}')
+        if worse:
+            regressions.append(name)
+    return lines, regressions
+
+
+def cmd_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    lines, regressions = compare(baseline, current, args.tolerance)
+    print('\n'.join(lines))
+    if regressions:
+        print(f"\n发现 {len(regressions)} 项回归（容差 {args.tolerance:.0%}）")
+        return 1
+    print("\n未发现回归")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PP-MAD基准测试")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    def common(p):
+        p.add_argument('--pretrained', action='store_true', help="使用预训练权重（需要下载）")
+        p.add_argument('--train-samples', type=int, default=160, help="训练模型用的合成特征数")
+        p.add_argument('-o', '--output', help="结果JSON文件")
+        p.add_argument('--baseline', help="与该基线结果比较，发现回归时返回非零")
+        p.add_argument('--tolerance', type=float, default=0.10)
+
+    p = sub.add_parser('stages', help="各阶段耗时与大小")
+    common(p)
+    p.add_argument('--images', type=int, default=8)
+    p.add_argument('--image-size', type=int, default=512)
+    p.add_argument('--repeat', type=int, default=10)
+    p.set_defaults(func=bench_stages)
+
+    p = sub.add_parser('load', help="多客户端并发负载")
+    common(p)
+    p.add_argument('--clients', type=int, default=4)
+    p.add_argument('--requests', type=int, default=10, help="每个客户端的请求数")
+    p.add_argument('--feature-dim', type=int, default=2048)
+    p.add_argument('--port', type=int, help="压测已运行的服务器（默认启动本地服务器）")
+    p.add_argument('--transport', choices=('tcp', 'unix', 'shm'), default='tcp',
+                   help="客户端与本地服务器之间的传输方式")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser('router', help="本机多进程路由：会话分布与进程崩溃时的转移")
+    common(p)
+    p.add_argument('--workers', type=int, default=3, help="服务器进程数")
+    p.add_argument('--clients', type=int, default=6)
+    p.add_argument('--keys', type=int, default=3, help="密钥组数（不同的上下文指纹）")
+    p.add_argument('--requests', type=int, default=20, help="每个客户端的请求数")
+    p.add_argument('--feature-dim', type=int, default=2048)
+    p.add_argument('--kill-after', type=float, default=1.0,
+                   help="开始发送请求后多少秒杀掉一个服务器进程（0为不杀）")
+    p.set_defaults(func=bench_router)
+
+    p = sub.add_parser('transport', help="TCP回环与同机共享内存传输对比")
+    p.add_argument('-o', '--output', help="结果JSON文件")
+    p.add_argument('--baseline', help="与该基线结果比较，发现回归时返回非零")
+    p.add_argument('--tolerance', type=float, default=0.10)
+    p.add_argument('--sizes-mb', type=float, nargs='+', default=[0.0625, 1, 8, 32],
+                   help="帧大小（MB）；上下文约35MB，单个密文约0.3MB")
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_transport)
+
+    p = sub.add_parser('preprocess', help="大尺寸图像预处理：缩小分辨率解码、缓存、进程池")
+    p.add_argument('-o', '--output', help="结果JSON文件")
+    p.add_argument('--baseline', help="与该基线结果比较，发现回归时返回非零")
+    p.add_argument('--tolerance', type=float, default=0.10)
+    p.add_argument('--images', type=int, default=8)
+    p.add_argument('--image-size', type=int, default=4096)
+    p.add_argument('--workers', type=int, default=4, help="进程池大小")
+    p.set_defaults(func=bench_preprocess)
+
+    p = sub.add_parser('compare', help="比较两次结果")
+    p.add_argument('baseline')
+    p.add_argument('current')
+    p.add_argument('--tolerance', type=float, default=0.10)
+    p.set_defaults(func=None)
+
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        return cmd_compare(args)
+
+    results = args.func(args)
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(baseline, results, args.tolerance)
+        print('\n'.join(lines))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+# client/cli.py
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+
+
+# 添加路径以便导入本地模块
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+
+def collect_image_paths(inputs, file_list=None, recursive=False):
+    """收集待检测的图像：文件、目录或列表文件（每行一个路径）"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            if recursive:
+                for root, _, files in os.walk(item):
+                    paths.extend(os.path.join(root, name) for name in files)
+            else:
+                paths.extend(os.path.join(item, name) for name in os.listdir(item))
+        else:
+            paths.append(item)
+    if file_list:
+        with open(file_list, 'r', encoding='utf-8') as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    return sorted(p for p in paths if p.lower().endswith(IMAGE_EXTENSIONS))
+
+
+class BatchScorer:
+    """并发批量检测：每条服务器连接运行一条分阶段流水线，共享密钥和特征提取器"""
+
+    def __init__(self, host, port, concurrency=2, threshold=None, pipeline_options=None,
+                 model_name=None, result_cache=None, server_url=None, decision_degree=None,
+                 preprocessor=None):
+        from client.client import MedicalAIClient
+        from client.encryption import HomomorphicEncryption
+        from server.model import WideResNet101FeatureExtractor
+        from shared.he_params import decision_depth
+
+        self.concurrency = max(1, concurrency)
+        self.threshold = threshold  # None时使用服务器发布的校准阈值
+        self.pipeline_options = pipeline_options or {}
+        self.feature_extractor = WideResNet101FeatureExtractor()
+        self.encryption = HomomorphicEncryption(
+            decision_depth(decision_degree) if decision_degree else None
+        )
+        self.clients = [
+            MedicalAIClient(host, port, self.feature_extractor, self.encryption, model_name,
+                            result_cache, server_url, decision_degree, preprocessor)
+            for _ in range(self.concurrency)
+        ]
+        self.logger = logging.getLogger(__name__)
+
+    def _to_record(self, client, result):
+        if 'error' in result:
+            return {'image_path': result['image_path'], 'error': result['error']}
+        record = {'image_path': result['image_path']}
+        record.update(client.score_result(result['result'], self.threshold))
+        return record
+
+    def _worker(self, client, paths, emit, checkpoint):
+        try:
+            if not client.ensure_session():
+                for path in paths:
+                    emit({'image_path': path, 'error': '无可用的服务器连接'})
+                return
+            client.process_batch(
+                paths, checkpoint=checkpoint,
+                on_result=lambda result: emit(self._to_record(client, result)),
+                **self.pipeline_options
+            )
+            self.logger.info(f"流水线统计: {json.dumps(client.last_pipeline_stats)}")
+        finally:
+            client.close_connection()
+
+    def run(self, paths, output, checkpoint_path=None):
+        """检测所有图像并以JSONL写入output，返回失败数"""
+        from client.pipeline import Checkpoint
+
+        lock = threading.Lock()
+        failures = [0]
+
+        def emit(record):
+            with lock:
+                if 'error' in record:
+                    failures[0] += 1
+                output.write(json.dumps(record, ensure_ascii=False) + '\n')
+                output.flush()
+
+        checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
+        # 按连接静态分片
+        shards = [paths[i::self.concurrency] for i in range(self.concurrency)]
+        threads = [
+            threading.Thread(target=self._worker, args=(client, shard, emit, checkpoint), daemon=True)
+            for client, shard in zip(self.clients, shards) if shard
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+        return failures[0]
+
+
+def main(argv=None):
+    """无界面批量检测客户端入口"""
+    from shared.he_params import DECISION_DEGREES
+
+    parser = argparse.ArgumentParser(description="医学影像密态检测客户端（批量）")
+    parser.add_argument('inputs', nargs='*', help="图像文件或目录")
+    parser.add_argument('--file-list', help="包含图像路径的文本文件，每行一个")
+    parser.add_argument('-r', '--recursive', action='store_true', help="递归扫描目录")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--url', help="服务器地址URL，优先于--host/--port"
+                        "（如 shm:///run/ppmad.sock 使用同机共享内存传输）")
+    parser.add_argument('-j', '--concurrency', type=int, default=2, help="并发连接数")
+    parser.add_argument('--model', help="服务器上的模型名称（默认模型可省略）")
+    parser.add_argument('--threshold', type=float,
+                        help="异常分数阈值（默认使用服务器训练时校准的阈值）")
+    parser.add_argument('--decision-degree', type=int, choices=DECISION_DEGREES,
+                        help="由服务器在密文上完成阈值判定，每张图像只返回一个密文；"
+                        "次数越高越接近精确判定，但需要更大的加密参数，延迟更高")
+    parser.add_argument('--batch-size', type=int, default=8, help="特征提取批大小")
+    parser.add_argument('--decode-workers', type=int, default=4)
+    parser.add_argument('--encrypt-workers', type=int, default=2)
+    parser.add_argument('--max-in-flight', type=int, default=8, help="每条连接未返回的最大请求数")
+    parser.add_argument('--preprocess-workers', type=int, default=0,
+                        help="图像解码进程数（大尺寸TIFF等解码较慢时使用，0为在解码线程中进行）")
+    parser.add_argument('--tensor-cache', help="缩放后图像的磁盘缓存目录，可与服务器训练共用")
+    parser.add_argument('--checkpoint', help="检查点文件，重新运行时跳过已完成的图像")
+    parser.add_argument('--result-cache', help="结果缓存的sqlite文件，重复提交的图像不再请求服务器")
+    parser.add_argument('--cache-ttl', type=float, default=7 * 24 * 3600, help="缓存有效期（秒）")
+    parser.add_argument('--cache-features', action='store_true',
+                        help="同时缓存特征，模型升级后跳过特征提取")
+    parser.add_argument('-o', '--output', help="JSONL结果文件（默认标准输出）")
+    parser.add_argument('--trace', help="导出各阶段耗时的Chrome trace JSON文件")
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper(), logging.INFO),
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    paths = collect_image_paths(args.inputs, args.file_list, args.recursive)
+    if not paths:
+        print("没有找到待检测的图像", file=sys.stderr)
+        return 2
+
+    pipeline_options = {
+        'batch_size': args.batch_size,
+        'decode_workers': args.decode_workers,
+        'encrypt_workers': args.encrypt_workers,
+        'max_in_flight': args.max_in_flight,
+    }
+    result_cache = None
+    if args.result_cache:
+        from client.result_cache import ResultCache
+        result_cache = ResultCache(args.result_cache, ttl=args.cache_ttl,
+                                   cache_features=args.cache_features)
+    from shared.preprocessing import Preprocessor
+    preprocessor = Preprocessor(args.preprocess_workers, args.tensor_cache)
+    scorer = BatchScorer(args.host, args.port, args.concurrency, args.threshold,
+                         pipeline_options, args.model, result_cache, args.url,
+                         args.decision_degree, preprocessor)
+    output = open(args.output, 'a', encoding='utf-8') if args.output else sys.stdout
+    try:
+        failures = scorer.run(paths, output, args.checkpoint)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        preprocessor.close()
+        if result_cache is not None:
+            logging.getLogger(__name__).info(f"结果缓存: {json.dumps(result_cache.stats())}")
+            result_cache.close()
+        if args.trace:
+            from client.tracing import export_chrome_trace
+            export_chrome_trace(args.trace, [client.tracer for client in scorer.clients])
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
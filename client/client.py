@@ -1,23 +1,49 @@
 # client/client.py
-import socket
 import numpy as np
 import tenseal as ts
-from PIL import Image
-import torchvision.transforms as transforms
 from .encryption import HomomorphicEncryption
+from .tracing import Tracer
 from shared.communication import CommunicationProtocol
+from shared import transport
+from shared.he_params import DECISION_DEGREES, decision_depth
+from shared.preprocessing import Preprocessor, image_digest
+from shared.dtypes import to_compute
 from server.model import WideResNet101FeatureExtractor  # 导入特征提取器
+import hashlib
 import logging
 import json
+import time
 
 class MedicalAIClient:
-    def __init__(self, server_host='localhost', server_port=8888):
+    def __init__(self, server_host='localhost', server_port=8888,
+                 feature_extractor=None, encryption=None, model_name=None,
+                 result_cache=None, server_url=None, decision_degree=None,
+                 preprocessor=None):
         self.server_host = server_host
         self.server_port = server_port
-        self.encryption = HomomorphicEncryption()
-        self.feature_extractor = WideResNet101FeatureExtractor()  # 初始化特征提取器
+        # 连接地址，按协议选择传输：tcp://、unix://、shm://（同机共享内存）
+        self.server_url = server_url or f"tcp://{server_host}:{server_port}"
+        self.model_name = model_name  # 请求的模型名称（None为服务器默认模型）
+        self.model_version = None  # 服务器为本会话固定的模型版本
+        self.model_key = None  # (模型名称, 模型内容摘要)，结果缓存的键之一
+        self.result_cache = result_cache  # 可选的ResultCache
+        # 请求服务器端密态判定时的多项式次数（None为默认的逐分量距离模式）
+        if decision_degree is not None and decision_degree not in DECISION_DEGREES:
+            raise ValueError(f"不支持的多项式次数 {decision_degree}，可选 {DECISION_DEGREES}")
+        self.decision_degree = decision_degree
+        self.decision = None  # 服务器确认的判定参数，未启用时为None
+        # 批量模式下多个连接可共享同一密钥和特征提取器
+        self.encryption = encryption or HomomorphicEncryption(
+            decision_depth(decision_degree) if decision_degree else None
+        )
+        self.feature_extractor = feature_extractor or WideResNet101FeatureExtractor()  # 初始化特征提取器
         self.pca_components = None  # 存储PCA组件
         self.pca_mean = None  # 存储PCA均值
+        self.calibration = None  # 服务器发布的分数归一化参数和阈值
+        self.key_sent = False  # 当前连接是否已上传公钥
+        self.tracer = Tracer()  # 各阶段耗时追踪
+        # 图像预处理（缩小分辨率解码，可共享进程池和磁盘缓存）
+        self.preprocessor = preprocessor or Preprocessor()
         self.setup_logging()
         
     def setup_logging(self):
@@ -31,9 +57,13 @@ class MedicalAIClient:
     def connect_to_server(self):
         """连接到服务器"""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.server_host, self.server_port))
-            self.logger.info(f"已连接到服务器 {self.server_host}:{self.server_port}")
+            with self.tracer.span('connect'):
+                self.socket = transport.connect(self.server_url)
+            self.key_sent = False
+            # 新连接对应新会话，服务器可能已切换模型版本
+            self.pca_components = None
+            self.pca_mean = None
+            self.logger.info(f"已连接到服务器 {self.server_url}")
             return True
         except Exception as e:
             self.logger.error(f"连接服务器失败: {e}")
@@ -42,19 +72,22 @@ class MedicalAIClient:
     def send_public_key(self):
         """发送公钥到服务器"""
         try:
-            # 生成密钥对
-            context_bytes = self.encryption.generate_keys()
-            
-            # 发送公钥
-            message = {
-                'type': 'public_key',
-                'context': context_bytes
-            }
-            CommunicationProtocol.send_data(self.socket, message, "json")
+            # 生成密钥对（已生成则复用）
+            with self.tracer.span('keygen'):
+                context_bytes = self.encryption.get_public_context()
             
-            # 等待响应
-            response, _ = CommunicationProtocol.receive_data(self.socket)
+            with self.tracer.span('context_upload', bytes=len(context_bytes)):
+                # 发送公钥
+                message = {
+                    'type': 'public_key',
+                    'context': context_bytes
+                }
+                CommunicationProtocol.send_data(self.socket, message, "json")
+                
+                # 等待响应
+                response, _ = CommunicationProtocol.receive_data(self.socket)
             if response and response.get('status') == 'success':
+                self.key_sent = True
                 self.logger.info("公钥发送成功")
                 return True
             else:
@@ -69,13 +102,33 @@ class MedicalAIClient:
         """从服务器获取PCA参数"""
         try:
             message = {'type': 'get_pca_params'}
-            CommunicationProtocol.send_data(self.socket, message, "json")
-            
-            response, _ = CommunicationProtocol.receive_data(self.socket)
+            if self.model_name:
+                message['model'] = self.model_name
+            if self.decision_degree:
+                message['decision_degree'] = self.decision_degree
+            with self.tracer.span('pca_fetch'):
+                CommunicationProtocol.send_data(self.socket, message, "json")
+                response, _ = CommunicationProtocol.receive_data(self.socket)
             if response and response.get('status') == 'success':
-                self.pca_components = np.array(response['pca_components'])
-                self.pca_mean = np.array(response['pca_mean'])
-                self.logger.info("成功获取PCA参数")
+                # 投影在float32下计算（与服务器端训练一致）
+                self.pca_components = to_compute(response['pca_components'])
+                self.pca_mean = to_compute(response['pca_mean'])
+                self.calibration = response.get('calibration')
+                self.model_version = response.get('model_version')
+                self.decision = response.get('decision')
+                model_name = response.get('model_name')
+                if self.decision is not None:
+                    # 判定结果和距离结果不能混用同一缓存条目
+                    model_name = f"{model_name}:decision{self.decision['degree']}"
+                elif self.decision_degree:
+                    self.logger.warning(
+                        f"服务器未启用密态判定，使用逐分量距离模式: {response.get('decision_error')}"
+                    )
+                # 按模型内容缓存：服务器重启或重新训练后版本号可能指向另一个模型
+                self.model_key = (model_name, response.get('model_digest') or self._model_digest())
+                self.logger.info(
+                    f"成功获取PCA参数（模型 {response.get('model_name')} v{self.model_version}）"
+                )
                 return True
             else:
                 self.logger.error(f"获取PCA参数失败: {response.get('message', '未知错误')}")
@@ -84,52 +137,175 @@ class MedicalAIClient:
             self.logger.error(f"获取PCA参数时出错: {e}")
             return False
     
+    def load_image(self, image_path, digest=None):
+        """加载并预处理单张图像（digest为已算好的内容哈希，供张量缓存使用）"""
+        return self.preprocessor.load(image_path, digest)
+    
+    def project_features(self, features: np.ndarray) -> np.ndarray:
+        """PCA降维，支持单个特征向量或(N, D)批量"""
+        reduced = (features - self.pca_mean).dot(self.pca_components.T)
+        if self.decision is not None:
+            # 密态判定模式下服务器端均值按同一系数缩放
+            reduced = reduced / self.decision['input_scale']
+        return reduced
+    
+    def ensure_session(self):
+        """确保已连接、已发送公钥并获取PCA参数"""
+        if not hasattr(self, 'socket') and not self.connect_to_server():
+            return False
+        if not self.key_sent and not self.send_public_key():
+            return False
+        if self.pca_components is None or self.pca_mean is None:
+            return self.get_pca_parameters()
+        return True
+    
+    def process_batch(self, image_paths, checkpoint=None, on_result=None, **options):
+        """批量处理图像：解码、批量提取、降维、加密、流水线发送和解密并行进行
+        
+        返回按完成顺序排列的结果列表，每项包含image_path以及result或error。
+        checkpoint为检查点文件路径（或共享的Checkpoint对象），用于断点续跑。
+        options传给BatchPipeline（batch_size、decode_workers、encrypt_workers、
+        max_in_flight、queue_size）。
+        """
+        from .pipeline import BatchPipeline
+        
+        if not self.ensure_session():
+            raise RuntimeError("无法建立会话，批量处理终止")
+        pipeline = BatchPipeline(self, checkpoint=checkpoint, **options)
+        results = pipeline.run(image_paths, on_result=on_result)
+        self.last_pipeline_stats = pipeline.stats()
+        return results
+    
+    def score_result(self, result, threshold=None):
+        """把解密结果转换为异常分数并判定
+        
+        result为每个高斯分量的平方距离，分数取到最近分量中心的距离。
+        threshold未指定时使用服务器发布的校准阈值；两者都没有时无法判定，
+        is_anomaly为None。密态判定模式下见score_decision（threshold不适用）。
+        """
+        if self.decision is not None:
+            return self.score_decision(result)
+        distances = np.asarray(result, dtype=np.float64)
+        # CKKS噪声可能使接近0的平方距离略小于0
+        score = float(np.sqrt(max(distances.min(), 0.0)))
+        calibration = self.calibration
+        if threshold is None and calibration:
+            threshold = calibration['threshold']
+        record = {'anomaly_score': score, 'threshold': threshold}
+        if calibration:
+            record['normalized_score'] = (score - calibration['loc']) / calibration['scale']
+        record['is_anomaly'] = None if threshold is None else score > threshold
+        return record
+    
+    def score_decision(self, result):
+        """解释密态判定结果
+        
+        结果近似为距离在阈值内的高斯分量数，低于cutoff判为异常；
+        超出[-0.5, 分量数 + 0.5]说明输入超出拟合区间（多项式发散），也判为异常。
+        anomaly_score取1 - 结果，与cutoff比较的方向和距离分数一致。
+        """
+        value = float(np.asarray(result, dtype=np.float64).ravel()[0])
+        decision = self.decision
+        in_range = -0.5 <= value <= decision['components'] + 0.5
+        threshold = 1.0 - decision['cutoff']
+        return {
+            'anomaly_score': 1.0 - value,
+            'threshold': threshold,
+            'is_anomaly': not in_range or 1.0 - value > threshold,
+            'decision_degree': decision['degree'],
+        }
+    
+    def lookup_cache(self, image_path):
+        """查询结果缓存，返回(图像哈希, 缓存的分数)
+        
+        未启用缓存时返回(None, None)。模型以最近一次会话获取的内容摘要为准，
+        解密后的分数与密钥无关，重新生成密钥后（例如下次运行）仍可命中。
+        """
+        if self.result_cache is None:
+            return None, None
+        with self.tracer.span('hash', image=image_path):
+            digest = image_digest(image_path)
+        if self.model_key is None:
+            return digest, None
+        return digest, self.result_cache.get(digest, self.model_key)
+    
+    def store_result(self, digest, result):
+        """把解密后的分数写入结果缓存"""
+        if self.result_cache is not None and digest and self.model_key is not None:
+            self.result_cache.put(digest, self.model_key, result)
+    
+    def _model_digest(self):
+        """旧版服务器不发送模型摘要时，按收到的PCA参数、校准信息和判定参数计算"""
+        digest = hashlib.sha256()
+        for array in (self.pca_components, self.pca_mean):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest.update(json.dumps([self.calibration, self.decision], sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+    
+    def record_server_time(self, wait_start, response, image_path=None):
+        """根据服务器回传的耗时，把等待响应的时间拆分为server和network两段"""
+        wait = time.perf_counter() - wait_start
+        server = 0.0
+        if response and 'server_time_ms' in response:
+            server = min(response['server_time_ms'] / 1000, wait)
+            self.tracer.add_span('server', wait_start, server, image=image_path)
+        self.tracer.add_span('network', wait_start + server, wait - server, image=image_path)
+    
     def process_image(self, image_path):
         """处理图像并发送加密特征"""
         try:
+            # 重复提交的图像直接返回缓存的结果
+            digest, cached = self.lookup_cache(image_path)
+            if cached is not None:
+                self.logger.info(f"命中结果缓存: {image_path}")
+                return cached
+            
             # 检查是否已获取PCA参数
             if self.pca_components is None or self.pca_mean is None:
                 if not self.get_pca_parameters():
                     self.logger.error("无法获取PCA参数，无法继续处理")
                     return None
             
-            # 图像预处理
-            preprocess = transforms.Compose([
-                transforms.Resize((224, 224)),  # WideResNet默认输入尺寸
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406],  # ImageNet均值
-                    std=[0.229, 0.224, 0.225]   # ImageNet标准差
-                )
-            ])
-            
-            # 加载并预处理图像
-            image = Image.open(image_path).convert('RGB')
-            image_tensor = preprocess(image)
-            
-            # 使用WideResNet101提取真实特征
-            features = self.feature_extractor.extract_features(image_tensor)
+            span = self.tracer.span
+            features = self.result_cache.get_features(digest) if digest else None
+            if features is None:
+                # 加载并预处理图像
+                with span('decode', image=image_path):
+                    image_tensor = self.load_image(image_path, digest)
+                
+                # 使用WideResNet101提取真实特征
+                with span('extract', image=image_path):
+                    features = self.feature_extractor.extract_features(image_tensor)
+                if digest:
+                    self.result_cache.put_features(digest, features)
             
             # 在客户端进行PCA降维（明文状态）
             self.logger.info("在客户端进行PCA降维")
-            reduced_features = features.dot(self.pca_components.T) + self.pca_mean
+            with span('project', image=image_path):
+                reduced_features = self.project_features(features)
             
             # 加密降维后的特征
-            encrypted_features = self.encryption.encrypt_features(reduced_features)
+            with span('encrypt', image=image_path):
+                encrypted_features = self.encryption.encrypt_features(reduced_features)
             
             # 发送加密特征
             message = {
                 'type': 'encrypted_features',
                 'features': encrypted_features
             }
-            CommunicationProtocol.send_data(self.socket, message, "json")
+            with span('send', image=image_path):
+                CommunicationProtocol.send_data(self.socket, message, "json")
             
             # 接收结果
+            wait_start = time.perf_counter()
             response, _ = CommunicationProtocol.receive_data(self.socket)
+            self.record_server_time(wait_start, response, image_path)
             if response and response.get('status') == 'success':
                 # 解密结果
                 encrypted_result = response['encrypted_result']
-                decrypted_result = self.encryption.decrypt_result(encrypted_result)
+                with span('decrypt', image=image_path):
+                    decrypted_result = self.encryption.decrypt_result(encrypted_result)
+                self.store_result(digest, decrypted_result)
                 
                 self.logger.info(f"检测完成，结果: {decrypted_result}")
                 return decrypted_result
@@ -145,4 +321,6 @@ class MedicalAIClient:
         """关闭连接"""
         if hasattr(self, 'socket'):
             self.socket.close()
+            del self.socket
+            self.key_sent = False
             self.logger.info("连接已关闭")
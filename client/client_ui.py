@@ -1,61 +1,96 @@
 # client/client_ui.py
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
                            QWidget, QTextEdit, QPushButton, QLabel, QProgressBar,
-                           QFileDialog, QFrame, QSplitter, QGroupBox)
+                           QFileDialog, QFrame, QSplitter, QGroupBox, QCheckBox)
 from PyQt6.QtCore import QThread, pyqtSignal, Qt, QDateTime
 from PyQt6.QtGui import QFont, QPixmap
 import sys
 import os
-import numpy as np
+import time
 
 # 添加路径以便导入本地模块
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
+# 单张图像检测依次经过的阶段（与客户端追踪的span名称一致）
+PIPELINE_STAGES = ('connect', 'keygen', 'context_upload', 'pca_fetch', 'decode',
+                   'extract', 'project', 'encrypt', 'send', 'server', 'network', 'decrypt')
+
 class ClientThread(QThread):
     """客户端处理线程"""
     log_signal = pyqtSignal(str)
     result_signal = pyqtSignal(dict)
     progress_signal = pyqtSignal(int)
     
+    # 各阶段历史平均耗时（毫秒），进度条按实际耗时比例推进
+    stage_estimates = {stage: 100.0 for stage in PIPELINE_STAGES}
+    
     def __init__(self, client, image_path):
         super().__init__()
         self.client = client
         self.image_path = image_path
+        self._completed = set()
+    
+    def on_span(self, span):
+        """阶段完成时按历史耗时权重更新进度"""
+        if span.name not in self.stage_estimates or span.name in self._completed:
+            return
+        self._completed.add(span.name)
+        total = sum(self.stage_estimates.values())
+        done = sum(self.stage_estimates[name] for name in self._completed)
+        self.progress_signal.emit(min(99, int(100 * done / total)))
+    
+    def update_estimates(self, breakdown):
+        """指数滑动平均更新各阶段耗时估计"""
+        for name, ms in breakdown.items():
+            if name in self.stage_estimates:
+                self.stage_estimates[name] = 0.7 * self.stage_estimates[name] + 0.3 * ms
+    
+    def emit_result(self, result, timings):
+        # 按服务器发布的校准参数计算分数并判定
+        record = self.client.score_result(result)
+        record.update({'image_path': self.image_path, 'timings': timings})
+        self.result_signal.emit(record)
+        self.log_signal.emit(f"异常检测完成，分数: {record['anomaly_score']:.3f}")
     
     def run(self):
         self.log_signal.emit("开始处理图像...")
+        tracer = self.client.tracer
+        tracer.add_listener(self.on_span)
+        run_start = time.perf_counter()
         
         try:
+            # 重复检测的图像直接使用本地缓存，不连接服务器
+            _, cached = self.client.lookup_cache(self.image_path)
+            if cached is not None:
+                self.log_signal.emit("命中本地结果缓存")
+                self.emit_result(cached, tracer.breakdown(self.image_path))
+                self.progress_signal.emit(100)
+                return
+            
             # 连接服务器
             if not self.client.connect_to_server():
                 self.log_signal.emit("连接服务器失败")
                 return
-                
-            self.progress_signal.emit(25)
             
             # 发送公钥
             if not self.client.send_public_key():
                 self.log_signal.emit("发送公钥失败")
                 return
                 
-            self.progress_signal.emit(50)
             self.log_signal.emit("公钥发送成功")
             
             # 处理图像
             result = self.client.process_image(self.image_path)
-            self.progress_signal.emit(75)
             
             if result is not None:
-                # 模拟异常检测结果
-                anomaly_score = float(np.mean(result))
-                is_anomaly = anomaly_score > 0.5
-                
-                self.result_signal.emit({
-                    'anomaly_score': anomaly_score,
-                    'is_anomaly': is_anomaly,
-                    'image_path': self.image_path
-                })
-                self.log_signal.emit(f"异常检测完成，分数: {anomaly_score:.3f}")
+                # 本次检测的耗时分解（含连接和公钥上传）
+                timings = {
+                    span.name: round(span.duration_ms, 3)
+                    for span in tracer.spans() if span.start >= run_start
+                }
+                timings.update(tracer.breakdown(self.image_path))
+                self.update_estimates(timings)
+                self.emit_result(result, timings)
             else:
                 self.log_signal.emit("图像处理失败")
                 
@@ -63,6 +98,8 @@ class ClientThread(QThread):
             self.client.close_connection()
         except Exception as e:
             self.log_signal.emit(f"处理过程中出错: {str(e)}")
+        finally:
+            tracer.remove_listener(self.on_span)
 
 class ClientUI(QMainWindow):
     def __init__(self):
@@ -101,6 +138,10 @@ class ClientUI(QMainWindow):
         self.connect_btn.clicked.connect(self.connect_server)
         server_layout.addWidget(self.connect_btn)
         
+        self.cache_checkbox = QCheckBox("缓存检测结果")
+        self.cache_checkbox.setToolTip("重复检测同一图像时直接使用本地结果，不再请求服务器")
+        server_layout.addWidget(self.cache_checkbox)
+        
         self.connection_status = QLabel("未连接")
         server_layout.addWidget(self.connection_status)
         
@@ -141,6 +182,15 @@ class ClientUI(QMainWindow):
         self.score_label = QLabel("异常分数: -")
         result_layout.addWidget(self.score_label)
         
+        self.timing_label = QLabel("耗时分解: -")
+        self.timing_label.setWordWrap(True)
+        result_layout.addWidget(self.timing_label)
+        
+        self.export_trace_btn = QPushButton("导出追踪")
+        self.export_trace_btn.clicked.connect(self.export_trace)
+        self.export_trace_btn.setEnabled(False)
+        result_layout.addWidget(self.export_trace_btn)
+        
         left_layout.addWidget(result_group)
         
         # 进度条
@@ -172,10 +222,15 @@ class ClientUI(QMainWindow):
         try:
             from client.client import MedicalAIClient
             
-            self.client = MedicalAIClient()
+            result_cache = None
+            if self.cache_checkbox.isChecked():
+                from client.result_cache import ResultCache
+                result_cache = ResultCache(cache_features=True)
+            self.client = MedicalAIClient(result_cache=result_cache)
             # 实际执行连接操作并检查结果
             if self.client.connect_to_server():
                 self.connect_btn.setEnabled(False)
+                self.cache_checkbox.setEnabled(False)
                 self.select_btn.setEnabled(True)
                 self.connection_status.setText("已连接")
                 self.log_message("服务器连接成功")
@@ -218,6 +273,7 @@ class ClientUI(QMainWindow):
             self.client_thread = ClientThread(self.client, self.current_image)
             self.client_thread.log_signal.connect(self.log_message)
             self.client_thread.result_signal.connect(self.show_result)
+            self.progress_bar.setValue(0)
             self.client_thread.progress_signal.connect(self.progress_bar.setValue)
             self.client_thread.start()
             
@@ -226,16 +282,44 @@ class ClientUI(QMainWindow):
         score = result['anomaly_score']
         is_anomaly = result['is_anomaly']
         
-        self.score_label.setText(f"异常分数: {score:.3f}")
+        text = f"异常分数: {score:.3f}"
+        if 'normalized_score' in result:
+            text += f"（归一化 {result['normalized_score']:.2f}，阈值 {result['threshold']:.3f}）"
+        self.score_label.setText(text)
         
-        if is_anomaly:
+        if is_anomaly is None:
+            self.result_label.setText("检测结果: 模型未校准，无法判定")
+            self.result_label.setStyleSheet("color: orange; font-weight: bold;")
+        elif is_anomaly:
             self.result_label.setText("检测结果: ❌ 异常")
             self.result_label.setStyleSheet("color: red; font-weight: bold;")
         else:
             self.result_label.setText("检测结果: ✅ 正常")
             self.result_label.setStyleSheet("color: green; font-weight: bold;")
+        
+        timings = result.get('timings', {})
+        if timings:
+            total = sum(timings.values())
+            lines = [f"{name}: {ms:.1f} ms ({100 * ms / total:.0f}%)"
+                     for name, ms in timings.items()]
+            self.timing_label.setText("耗时分解:\n" + "\n".join(lines))
+            self.export_trace_btn.setEnabled(True)
             
         self.process_btn.setEnabled(True)
+    
+    def export_trace(self):
+        """导出Chrome trace JSON（可在chrome://tracing或Perfetto中打开）"""
+        if not self.client:
+            return
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "导出追踪", "client_trace.json", "Trace JSON (*.json)"
+        )
+        if file_path:
+            try:
+                self.client.tracer.export_chrome_trace(file_path)
+                self.log_message(f"追踪已导出: {file_path}")
+            except OSError as e:
+                self.log_message(f"导出追踪失败: {e}")
         
     def log_message(self, message):
         """记录日志消息"""
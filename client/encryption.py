@@ -2,14 +2,20 @@
 import tenseal as ts
 import numpy as np
 import logging
+import threading
+from shared.he_params import ckks_parameters
 
 class HomomorphicEncryption:
     """同态加密处理类"""
     
-    def __init__(self):
+    def __init__(self, depth=None):
+        # 需要的乘法深度（服务器端密态判定需要更深的参数），None为默认参数
+        self.depth = depth
         self.context = None
         self.public_key = None
         self.private_key = None
+        self.context_bytes = None
+        self._lock = threading.Lock()
         
     def generate_keys(self, poly_modulus_degree=8192, coeff_mod_bit_sizes=[60, 40, 40, 60]):
         """生成同态加密密钥对"""
@@ -29,22 +35,39 @@ class HomomorphicEncryption:
         self.public_key = self.context
         
         logging.info("同态加密密钥对生成完成")
-        return self.context.serialize()
+        self.context_bytes = self.context.serialize()
+        return self.context_bytes
+    
+    def get_public_context(self):
+        """获取序列化的公共上下文，必要时先生成密钥"""
+        with self._lock:
+            if self.context_bytes is None:
+                if self.depth is None:
+                    self.generate_keys()
+                else:
+                    self.generate_keys(*ckks_parameters(self.depth))
+            return self.context_bytes
     
     def encrypt_features(self, features: np.ndarray) -> bytes:
         """加密特征向量"""
         if self.context is None:
             raise RuntimeError("加密上下文未初始化")
             
-        # 确保特征数据是浮点数
-        features = features.astype(np.float64)
+        # CKKS按双精度编码；只在这里转换，之前的计算保持float32
+        features = np.asarray(features, dtype=np.float64)
         encrypted_vector = ts.ckks_vector(self.context, features)
         return encrypted_vector.serialize()
     
-    def decrypt_result(self, encrypted_data: bytes) -> np.ndarray:
-        """解密密文结果"""
+    def decrypt_result(self, encrypted_data) -> np.ndarray:
+        """解密密文结果（单个密文或每个分量一个密文的列表）"""
         if self.context is None:
             raise RuntimeError("加密上下文未初始化")
+        
+        if isinstance(encrypted_data, (list, tuple)):
+            return np.array([
+                ts.ckks_vector_from(self.context, item).decrypt()[0]
+                for item in encrypted_data
+            ])
             
         encrypted_vector = ts.ckks_vector_from(self.context, encrypted_data)
         return np.array(encrypted_vector.decrypt())
\ No newline at end of file
@@ -0,0 +1,453 @@
+# client/pipeline.py
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from shared.communication import CommunicationProtocol
+
+# 流水线结束标记
+_DONE = object()
+
+
+class StageStats:
+    """单个阶段的吞吐统计"""
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items, seconds):
+        with self._lock:
+            self.items += items
+            self.busy += seconds
+
+    def as_dict(self, wall):
+        return {
+            'items': self.items,
+            'workers': self.workers,
+            'busy_s': round(self.busy, 4),
+            # 每个工作线程满负荷时的处理能力
+            'capacity_per_s': round(self.items * self.workers / self.busy, 2) if self.busy else None,
+            'throughput_per_s': round(self.items / wall, 2) if wall else None,
+            'utilization': round(self.busy / (wall * self.workers), 3) if wall else None,
+        }
+
+
+class Checkpoint:
+    """JSONL检查点：记录已完成的图像结果，重新运行时跳过
+
+    每条记录带有所属会话（模型名称、模型内容摘要和判定模式），只恢复与当前会话一致的结果：
+    重新训练或换模型后阈值不同，判定模式下的结果也不是平方距离。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.completed = {}  # 图像路径 -> (会话, 结果)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 上次中断时写了一半的行
+                    if 'result' in record:
+                        session = (record.get('model_name'), record.get('model_digest'),
+                                   record.get('decision'))
+                        self.completed[record['image_path']] = (session, np.array(record['result']))
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def get(self, image_path, session):
+        """返回该会话下已完成的结果，没有或属于其他会话时返回None"""
+        with self._lock:
+            entry = self.completed.get(image_path)
+        if entry is None or entry[0] != tuple(session):
+            return None
+        return entry[1]
+
+    def record(self, image_path, result, session):
+        model_name, model_digest, decision = session
+        line = json.dumps({
+            'image_path': image_path,
+            'model_name': model_name,
+            'model_digest': model_digest,
+            'decision': decision,
+            'result': np.asarray(result).tolist(),
+        })
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            self.completed[image_path] = (tuple(session), np.asarray(result))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class BatchPipeline:
+    """客户端分阶段批量处理流水线
+
+    解码 → 批量特征提取 → PCA降维 → 加密 → 发送 → 接收 → 解密，
+    各阶段之间用有界队列连接，使CPU、同态加密和网络相互重叠。
+    """
+
+    def __init__(self, client, batch_size=8, decode_workers=4, encrypt_workers=2,
+                 max_in_flight=8, queue_size=None, checkpoint=None):
+        self.client = client
+        self.batch_size = max(1, batch_size)
+        self.decode_workers = max(1, decode_workers)
+        self.encrypt_workers = max(1, encrypt_workers)
+        self.max_in_flight = max(1, max_in_flight)
+        self.queue_size = queue_size or 2 * self.batch_size
+        # checkpoint可以是路径，也可以是多个流水线共享的Checkpoint对象
+        self._owns_checkpoint = isinstance(checkpoint, str)
+        self.checkpoint = Checkpoint(checkpoint) if self._owns_checkpoint else checkpoint
+        self.logger = logging.getLogger(__name__)
+
+        self._stats = {
+            'decode': StageStats('decode', self.decode_workers),
+            'extract': StageStats('extract'),
+            'project': StageStats('project'),
+            'encrypt': StageStats('encrypt', self.encrypt_workers),
+            'send': StageStats('send'),
+            'receive': StageStats('receive'),
+            'decrypt': StageStats('decrypt'),
+        }
+        self._wall = 0.0
+        self._results = []
+        self._results_lock = threading.Lock()
+        self._on_result = None
+        self._abort = threading.Event()
+        self._digests = {}  # 图像路径 -> 内容哈希（启用结果缓存时）
+        self._cached = 0
+        self._count_lock = threading.Lock()  # 解码线程池中的多个线程更新计数
+
+    def _emit(self, record):
+        with self._results_lock:
+            self._results.append(record)
+            if self._on_result is not None:
+                try:
+                    self._on_result(record)
+                except Exception as e:
+                    # 回调失败不能中断所在阶段，否则下游等不到结束标记
+                    self.logger.error(f"结果回调失败（{record['image_path']}）: {e}")
+
+    def _record(self, stage, start, count=1, **args):
+        """更新阶段统计，并把该区间写入客户端追踪"""
+        duration = time.perf_counter() - start
+        self._stats[stage].add(count, duration)
+        if count > 1:
+            args['batch'] = count
+        self.client.tracer.add_span(stage, start, duration, **args)
+
+    def _fail(self, image_path, message):
+        self._emit({'image_path': image_path, 'error': message})
+
+    # ---- 各阶段 ----
+
+    def _decode_stage(self, paths, out_q):
+        def decode(path):
+            try:
+                digest, cached = self.client.lookup_cache(path)
+            except Exception as e:
+                self._fail(path, f"图像读取失败: {e}")
+                return
+            if cached is not None:
+                with self._count_lock:
+                    self._cached += 1
+                self._emit({'image_path': path, 'result': cached, 'cached': True})
+                return
+            start = time.perf_counter()
+            try:
+                if digest:
+                    self._digests[path] = digest
+                    features = self.client.result_cache.get_features(digest)
+                    if features is not None:
+                        # 特征已缓存（例如模型升级后重新评估），跳过解码和特征提取
+                        out_q.put((path, None, features))
+                        return
+                tensor = self.client.load_image(path, digest)
+            except Exception as e:
+                self._fail(path, f"图像解码失败: {e}")
+                return
+            self._record('decode', start, image=path)
+            out_q.put((path, tensor, None))
+
+        try:
+            with ThreadPoolExecutor(self.decode_workers, thread_name_prefix='decode') as pool:
+                # 分段提交，避免一次性为所有图像排队
+                window = []
+                for path in paths:
+                    if self._abort.is_set():
+                        self._fail(path, "流水线已中止")
+                        continue
+                    window.append((path, pool.submit(decode, path)))
+                    if len(window) >= self.queue_size:
+                        self._wait_decode(*window.pop(0))
+                for path, future in window:
+                    self._wait_decode(path, future)
+        finally:
+            # 无论如何都要通知下游阶段结束，否则后续阶段会一直等待
+            out_q.put(_DONE)
+
+    def _wait_decode(self, path, future):
+        try:
+            future.result()
+        except Exception as e:
+            self._fail(path, f"图像处理失败: {e}")
+
+    def _extract_stage(self, in_q, out_q):
+        try:
+            done = False
+            while not done:
+                batch = []
+                item = in_q.get()
+                if item is _DONE:
+                    break
+                batch.append(item)
+                # 凑满一批，或上游暂时没有数据时立即处理
+                while len(batch) < self.batch_size:
+                    try:
+                        item = in_q.get(timeout=0.05)
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        done = True
+                        break
+                    batch.append(item)
+                try:
+                    self._extract_batch(batch, out_q)
+                except Exception as e:
+                    # 例如特征维度与PCA参数不一致、缓存写入失败
+                    for path, _, _ in batch:
+                        self._fail(path, f"特征处理失败: {e}")
+        finally:
+            out_q.put(_DONE)
+
+    def _extract_batch(self, batch, out_q):
+        # 特征已缓存的图像不再提取
+        pending = [i for i, (_, tensor, _) in enumerate(batch) if tensor is not None]
+        if pending:
+            start = time.perf_counter()
+            try:
+                extracted = self.client.feature_extractor.extract_features_batch(
+                    [batch[i][1] for i in pending]
+                )
+            except Exception as e:
+                for i in pending:
+                    self._fail(batch[i][0], f"特征提取失败: {e}")
+                batch[:] = [item for item in batch if item[1] is None]
+            else:
+                self._record('extract', start, len(pending))
+                for i, vector in zip(pending, extracted):
+                    batch[i] = (batch[i][0], None, vector)
+                for i in pending:
+                    path, _, vector = batch[i]
+                    if path in self._digests:
+                        self.client.result_cache.put_features(self._digests[path], vector)
+        if not batch:
+            return
+        paths = [path for path, _, _ in batch]
+        features = np.stack([vector for _, _, vector in batch])
+
+        start = time.perf_counter()
+        reduced = self.client.project_features(features)
+        self._record('project', start, len(batch))
+        out_q.put((paths, reduced))
+
+    def _encrypt_stage(self, in_q, out_q):
+        def encrypt(path, vector):
+            start = time.perf_counter()
+            try:
+                encrypted = self.client.encryption.encrypt_features(vector)
+            except Exception as e:
+                self._fail(path, f"加密失败: {e}")
+                return
+            self._record('encrypt', start, image=path)
+            out_q.put((path, encrypted))
+
+        with ThreadPoolExecutor(self.encrypt_workers, thread_name_prefix='encrypt') as pool:
+            pending = []
+            while True:
+                item = in_q.get()
+                if item is _DONE:
+                    break
+                paths, reduced = item
+                for path, vector in zip(paths, reduced):
+                    pending.append(pool.submit(encrypt, path, vector))
+                # 限制已提交但未完成的加密任务数
+                while len(pending) > self.queue_size:
+                    pending.pop(0).result()
+            for future in pending:
+                future.result()
+        out_q.put(_DONE)
+
+    def _send_stage(self, in_q, in_flight):
+        request_id = 0
+        while True:
+            item = in_q.get()
+            if item is _DONE:
+                break
+            path, encrypted = item
+            if self._abort.is_set():
+                self._fail(path, "连接已断开")
+                continue
+            request_id += 1
+            # in_flight有界：未收到响应的请求过多时在此阻塞
+            in_flight.put((request_id, path))
+            start = time.perf_counter()
+            try:
+                CommunicationProtocol.send_data(self.client.socket, {
+                    'type': 'encrypted_features',
+                    'request_id': request_id,
+                    'features': encrypted
+                }, "json")
+            except Exception as e:
+                self.logger.error(f"发送失败: {e}")
+                self._abort.set()
+            self._record('send', start, image=path)
+        in_flight.put(_DONE)
+
+    def _receive_stage(self, in_flight, out_q):
+        while True:
+            item = in_flight.get()
+            if item is _DONE:
+                break
+            request_id, path = item
+            if self._abort.is_set():
+                self._fail(path, "连接已断开")
+                continue
+            start = time.perf_counter()
+            try:
+                response, _ = CommunicationProtocol.receive_data(self.client.socket)
+            except Exception as e:
+                self.logger.error(f"接收失败: {e}")
+                response = None
+            self._stats['receive'].add(1, time.perf_counter() - start)
+            self.client.record_server_time(start, response, path)
+            if response is None:
+                self._abort.set()
+                self._fail(path, "连接已断开")
+                continue
+            if response.get('request_id') != request_id:
+                self._abort.set()
+                self._fail(path, "响应顺序不一致")
+                continue
+            if response.get('status') != 'success':
+                self._fail(path, response.get('message', '服务器处理失败'))
+                continue
+            out_q.put((path, response['encrypted_result']))
+        out_q.put(_DONE)
+
+    def _decrypt_stage(self, in_q):
+        session = self._session()
+        while True:
+            item = in_q.get()
+            if item is _DONE:
+                break
+            path, encrypted_result = item
+            start = time.perf_counter()
+            try:
+                result = self.client.encryption.decrypt_result(encrypted_result)
+            except Exception as e:
+                self._fail(path, f"解密失败: {e}")
+                continue
+            self._record('decrypt', start, image=path)
+            try:
+                self.client.store_result(self._digests.pop(path, None), result)
+                if self.checkpoint is not None:
+                    self.checkpoint.record(path, result, session)
+            except Exception as e:
+                self._fail(path, f"结果保存失败: {e}")
+                continue
+            self._emit({'image_path': path, 'result': result})
+
+    def _session(self):
+        """检查点记录所属的会话：(模型名称, 模型内容摘要, 判定多项式次数)"""
+        model_name, model_digest = self.client.model_key or (None, None)
+        decision = self.client.decision
+        return (model_name, model_digest, decision['degree'] if decision else None)
+
+    # ---- 运行 ----
+
+    def run(self, image_paths, on_result=None):
+        """运行流水线，返回所有结果（包括检查点中已有的结果）"""
+        self._on_result = on_result
+        self._results = []
+        paths = list(image_paths)
+
+        if self.checkpoint is not None:
+            session = self._session()
+            todo = []
+            for path in paths:
+                result = self.checkpoint.get(path, session)
+                if result is not None:
+                    self._emit({'image_path': path, 'result': result, 'resumed': True})
+                else:
+                    todo.append(path)
+            if len(todo) < len(paths):
+                self.logger.info(f"从检查点恢复 {len(paths) - len(todo)} 个结果")
+            paths = todo
+
+        decoded_q = queue.Queue(self.queue_size)
+        projected_q = queue.Queue(max(1, self.queue_size // self.batch_size))
+        encrypted_q = queue.Queue(self.queue_size)
+        in_flight_q = queue.Queue(self.max_in_flight)
+        received_q = queue.Queue(self.queue_size)
+
+        stages = [
+            threading.Thread(target=self._decode_stage, args=(paths, decoded_q), name='decode'),
+            threading.Thread(target=self._extract_stage, args=(decoded_q, projected_q), name='extract'),
+            threading.Thread(target=self._encrypt_stage, args=(projected_q, encrypted_q), name='encrypt'),
+            threading.Thread(target=self._send_stage, args=(encrypted_q, in_flight_q), name='send'),
+            threading.Thread(target=self._receive_stage, args=(in_flight_q, received_q), name='receive'),
+            threading.Thread(target=self._decrypt_stage, args=(received_q,), name='decrypt'),
+        ]
+        start = time.perf_counter()
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+        for stage in stages:
+            stage.join()
+        self._wall = time.perf_counter() - start
+
+        if self._owns_checkpoint:
+            self.checkpoint.close()
+        self._log_stats()
+        return self._results
+
+    def stats(self):
+        """各阶段吞吐统计及瓶颈阶段"""
+        stages = {name: stat.as_dict(self._wall) for name, stat in self._stats.items()}
+        busy = {name: s['utilization'] or 0 for name, s in stages.items() if name != 'receive'}
+        processed = sum(1 for r in self._results if not r.get('resumed') and not r.get('cached'))
+        return {
+            'wall_s': round(self._wall, 4),
+            'processed': processed,
+            'images_per_s': round(processed / self._wall, 2) if self._wall else None,
+            'cached': self._cached,
+            'stages': stages,
+            # receive包含等待服务器计算的时间，不参与瓶颈判断
+            'bottleneck': max(busy, key=busy.get) if any(busy.values()) else None,
+        }
+
+    def _log_stats(self):
+        stats = self.stats()
+        self.logger.info(
+            f"批量处理完成: {stats['processed']} 张, 用时 {stats['wall_s']}s, "
+            f"{stats['images_per_s']} 张/秒, 瓶颈阶段: {stats['bottleneck']}"
+        )
+        for name, s in stats['stages'].items():
+            self.logger.info(
+                f"  {name}: {s['items']} 项, 忙碌 {s['busy_s']}s, "
+                f"处理能力 {s['capacity_per_s']}/s, 利用率 {s['utilization']}"
+            )
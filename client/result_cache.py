@@ -0,0 +1,159 @@
+# client/result_cache.py
+import json
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from shared.dtypes import COMPUTE_DTYPE, to_storage
+
+SCHEMA_VERSION = 2  # 2: 结果按模型内容摘要缓存，不再与密钥相关
+
+
+class ResultCache:
+    """客户端检测结果缓存（可选启用）
+
+    结果按(图像内容哈希, 模型名称, 模型内容摘要)缓存解密后的分数（与密钥无关，
+    每次运行重新生成密钥也能命中）；特征按图像内容哈希缓存，模型升级后可跳过
+    解码和特征提取直接重新评估。
+    path为sqlite文件路径，默认只保存在内存中；条目超过TTL后失效，
+    超过容量时淘汰最久未访问的条目。
+    """
+
+    def __init__(self, path=':memory:', max_entries=10000, ttl=7 * 24 * 3600,
+                 cache_features=False, max_features=2000):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.cache_features = cache_features
+        self.max_features = max(1, max_features)
+        self.hits = 0
+        self.misses = 0
+        self.feature_hits = 0
+        self._lock = threading.Lock()
+        # 流水线的多个阶段线程共用同一连接，由_lock串行化
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            # 旧格式的结果按进程内版本号和密钥缓存，不能复用
+            self._db.execute('DROP TABLE IF EXISTS results')
+            self._db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS results (
+                image TEXT, model TEXT, digest TEXT,
+                scores TEXT, created REAL, accessed REAL,
+                PRIMARY KEY (image, model, digest)
+            );
+            CREATE TABLE IF NOT EXISTS features (
+                image TEXT PRIMARY KEY, dtype TEXT, data BLOB,
+                created REAL, accessed REAL
+            );
+        ''')
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, image, model_key):
+        """返回缓存的分数（ndarray），未命中或已过期返回None
+
+        model_key为(模型名称, 模型内容摘要)。
+        """
+        model, digest = model_key
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT scores, created FROM results WHERE image=? AND model=? AND digest=?',
+                (image, model, digest)
+            ).fetchone()
+            if row is None or self._expired(row[1], now):
+                if row is not None:
+                    self._db.execute(
+                        'DELETE FROM results WHERE image=? AND model=? AND digest=?',
+                        (image, model, digest)
+                    )
+                    self._db.commit()
+                self.misses += 1
+                return None
+            self._db.execute(
+                'UPDATE results SET accessed=? WHERE image=? AND model=? AND digest=?',
+                (now, image, model, digest)
+            )
+            self._db.commit()
+            self.hits += 1
+        return np.array(json.loads(row[0]))
+
+    def put(self, image, model_key, scores):
+        model, digest = model_key
+        now = time.time()
+        scores = json.dumps(np.asarray(scores).tolist())
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                (image, model, digest, scores, now, now)
+            )
+            self._evict('results', self.max_entries)
+            self._db.commit()
+
+    def get_features(self, image):
+        """返回缓存的特征向量（未启用特征缓存时总是None）"""
+        if not self.cache_features:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT dtype, data, created FROM features WHERE image=?', (image,)
+            ).fetchone()
+            if row is None or self._expired(row[2], now):
+                return None
+            self._db.execute('UPDATE features SET accessed=? WHERE image=?', (now, image))
+            self._db.commit()
+            self.feature_hits += 1
+        return np.frombuffer(row[1], dtype=row[0]).astype(COMPUTE_DTYPE)
+
+    def put_features(self, image, features):
+        if not self.cache_features:
+            return
+        # 磁盘上按float16保存，读取时恢复为float32
+        features = np.ascontiguousarray(to_storage(features))
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?)',
+                (image, features.dtype.str, features.tobytes(), now, now)
+            )
+            self._evict('features', self.max_features)
+            self._db.commit()
+
+    def _evict(self, table, limit):
+        """删除过期条目，并按最近访问时间淘汰超出容量的条目"""
+        if self.ttl is not None:
+            self._db.execute(f'DELETE FROM {table} WHERE created < ?', (time.time() - self.ttl,))
+        count = self._db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        if count > limit:
+            self._db.execute(
+                f'DELETE FROM {table} WHERE rowid IN '
+                f'(SELECT rowid FROM {table} ORDER BY accessed LIMIT ?)',
+                (count - limit,)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM results')
+            self._db.execute('DELETE FROM features')
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            results = self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            features = self._db.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+        return {
+            'results': results,
+            'features': features,
+            'hits': self.hits,
+            'misses': self.misses,
+            'feature_hits': self.feature_hits,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
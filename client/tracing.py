@@ -0,0 +1,124 @@
+# client/tracing.py
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 同一进程内的所有Tracer共用时间原点，多个连接的追踪可以合并到一个文件
+_ORIGIN = time.perf_counter()
+_WALL_ORIGIN = time.time()
+
+
+class Span:
+    """一段计时区间（perf_counter秒）"""
+
+    __slots__ = ('name', 'start', 'end', 'tid', 'args')
+
+    def __init__(self, name, start, end, tid, args):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.tid = tid
+        self.args = args
+
+    @property
+    def duration_ms(self):
+        return (self.end - self.start) * 1000
+
+
+class Tracer:
+    """客户端追踪：记录各阶段span，可导出为Chrome trace-event JSON
+
+    span的args中带image字段时可按图像汇总耗时。
+    """
+
+    def __init__(self, max_spans=100000):
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """每个span结束时调用callback(span)"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def add_span(self, name, start, duration, **args):
+        """记录一个已测量的区间（例如服务器回传的耗时）"""
+        span = Span(name, start, start + duration, threading.get_ident(), args)
+        with self._lock:
+            self._spans.append(span)
+        for callback in list(self._listeners):
+            callback(span)
+        return span
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield args  # 调用方可以在区间内补充args
+        finally:
+            self.add_span(name, start, time.perf_counter() - start, **args)
+
+    def spans(self, image=None):
+        with self._lock:
+            spans = list(self._spans)
+        if image is None:
+            return spans
+        return [span for span in spans if span.args.get('image') == image]
+
+    def breakdown(self, image=None):
+        """按span名称汇总耗时（毫秒），保持首次出现的顺序"""
+        totals = {}
+        for span in self.spans(image):
+            totals[span.name] = totals.get(span.name, 0.0) + span.duration_ms
+        return {name: round(ms, 3) for name, ms in totals.items()}
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+    def to_chrome_trace(self):
+        """Chrome trace-event格式（chrome://tracing、Perfetto可直接打开）"""
+        pid = os.getpid()
+        events = [{
+            'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': 'PP-MAD client'}
+        }]
+        for span in self.spans():
+            events.append({
+                'name': span.name,
+                'cat': 'client' if span.name != 'server' else 'server',
+                'ph': 'X',
+                'ts': round((span.start - _ORIGIN) * 1e6, 3),
+                'dur': round((span.end - span.start) * 1e6, 3),
+                'pid': pid,
+                'tid': span.tid,
+                'args': {k: str(v) for k, v in span.args.items()},
+            })
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'start_time': _WALL_ORIGIN},
+        }
+
+    def export_chrome_trace(self, path):
+        return export_chrome_trace(path, [self])
+
+
+def export_chrome_trace(path, tracers):
+    """把多个Tracer的span合并导出为一个Chrome trace JSON文件"""
+    trace = None
+    for tracer in tracers:
+        part = tracer.to_chrome_trace()
+        if trace is None:
+            trace = part
+        else:
+            trace['traceEvents'].extend(e for e in part['traceEvents'] if e['ph'] != 'M')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(trace or {'traceEvents': []}, f, ensure_ascii=False)
+    return path
@@ -4,27 +4,54 @@ import os
 import subprocess
 
 def check_qt_dependencies():
-    """检查Qt依赖是否完整"""
+    """检查Qt依赖是否完整（一次dpkg-query调用）"""
     required_libs = [
         'libxcb-cursor0', 'libxcb-xinerama0', 'libxcb-randr0',
         'libxcb-icccm4', 'libxcb-image0', 'libxcb-keysyms1'
     ]
     
-    missing = []
-    for lib in required_libs:
-        try:
-            result = subprocess.run(['dpkg', '-l', lib], 
-                                  capture_output=True, text=True)
-            if result.returncode != 0:
-                missing.append(lib)
-        except:
-            missing.append(lib)
-    
-    return missing
+    try:
+        result = subprocess.run(
+            ['dpkg-query', '-W', '-f=${Package} ${Status}\\n'] + required_libs,
+            capture_output=True, text=True
+        )
+    except FileNotFoundError:
+        # 非Debian系统，无法检查，交给Qt自行报错
+        return []
+    
+    installed = set()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if parts and line.endswith(' ok installed'):
+            installed.add(parts[0].split(':')[0])
+    
+    return [lib for lib in required_libs if lib not in installed]
+
+def run_headless(argv):
+    """无界面模式：不加载Qt，也不检查系统库"""
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(current_dir)
+    
+    from server.daemon import main as headless_main
+    return headless_main(argv)
+
+def run_router(argv):
+    """会话路由器：把客户端会话分配到多个无界面服务器进程"""
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(current_dir)
+    
+    from server.router import main as router_main
+    return router_main(argv)
 
 def main():
-    # 设置环境变量
-    os.environ['QT_QPA_PLATFORM'] = 'xcb'
+    # 无界面模式
+    if '--headless' in sys.argv[1:]:
+        return run_headless([arg for arg in sys.argv[1:] if arg != '--headless'])
+    if '--router' in sys.argv[1:]:
+        return run_router([arg for arg in sys.argv[1:] if arg != '--router'])
+    
+    # 设置环境变量（允许外部覆盖平台插件）
+    os.environ.setdefault('QT_QPA_PLATFORM', 'xcb')
     os.environ['QT_DEBUG_PLUGINS'] = '0'
     
     # 检查依赖
@@ -0,0 +1,206 @@
+# server/daemon.py
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+
+# 添加路径以便导入本地模块
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+DEFAULT_CONFIG = {
+    'host': 'localhost',
+    'port': 8888,
+    'listen': [],              # 额外监听地址，如 shm:///run/ppmad.sock（同机客户端）
+    'model_bundle': None,      # 已训练模型包路径（默认模型）
+    'models': {},              # 其他命名模型：名称 -> 模型包路径
+    'train_dir': None,         # 无模型包时，从该目录训练
+    'save_bundle': None,       # 训练完成后保存模型包的路径
+    'preprocess_workers': 0,   # 训练图像解码进程数（0为在训练线程中解码）
+    'tensor_cache_dir': None,  # 缩放后图像的磁盘缓存目录，可与客户端共用
+    'max_workers': 8,          # 并发处理的客户端连接数
+    'queue_timeout': 10,       # 工作线程已满时新连接的最长排队秒数，超时回复服务器繁忙
+    'torch_threads': None,     # PyTorch计算线程数
+    'context_cache_size': 16,  # 缓存的客户端上下文数
+    'constant_cache_size': 32, # 缓存的预编码模型常量组数（上下文 × 模型版本）
+    'max_frame_mb': 4,         # 普通帧（非分块流）的大小上限
+    'message_limits_mb': {},   # 分块流按消息类型的大小上限，覆盖默认值，如 {"public_key": 256}
+    'receive_budget_mb': 512,  # 所有连接接收缓冲区的总预算，用尽时暂停读取
+    'connection_budget_mb': None,  # 单个连接最多占用的接收预算（默认为总预算的一半）
+    'budget_timeout': 30,      # 等待接收预算的最长秒数，超时回复服务器繁忙并断开
+    'metrics_port': None,      # 本机Prometheus指标端点端口（不配置则不启动）
+    'profile_dir': None,       # cProfile结果保存目录
+    'drain_timeout': 30,       # SIGTERM后等待现有会话结束的秒数，超时后直接停止
+    'pretrained': True,
+    'log_level': 'INFO',
+}
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+
+def load_config(path=None, overrides=None):
+    """加载JSON配置文件，命令行参数优先"""
+    config = dict(DEFAULT_CONFIG)
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            user_config = json.load(f)
+        unknown = set(user_config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError(f"未知的配置项: {', '.join(sorted(unknown))}")
+        config.update(user_config)
+    for key, value in (overrides or {}).items():
+        if value is not None:
+            config[key] = value
+    return config
+
+
+def list_images(directory):
+    """列出目录下的所有图像文件（递归）"""
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def build_server(config):
+    """根据配置创建并准备服务器"""
+    if config['torch_threads']:
+        import torch
+        torch.set_num_threads(int(config['torch_threads']))
+
+    from server.server import MedicalAIServer
+    from shared.communication import DEFAULT_MESSAGE_LIMITS, FrameLimits, MiB
+
+    server = MedicalAIServer(
+        host=config['host'],
+        port=int(config['port']),
+        max_workers=int(config['max_workers']),
+        pretrained=config['pretrained'],
+        context_cache_size=int(config['context_cache_size']),
+        constant_cache_size=int(config['constant_cache_size']),
+        listen=config['listen'],
+        frame_limits=FrameLimits(
+            max_frame=int(config['max_frame_mb'] * MiB),
+            per_type=dict(DEFAULT_MESSAGE_LIMITS, **{
+                name: int(mb * MiB) for name, mb in config['message_limits_mb'].items()
+            })
+        ),
+        receive_budget=int(config['receive_budget_mb'] * MiB),
+        connection_budget=(int(config['connection_budget_mb'] * MiB)
+                           if config['connection_budget_mb'] is not None else None),
+        budget_timeout=float(config['budget_timeout']),
+        preprocess_workers=int(config['preprocess_workers']),
+        tensor_cache_dir=config['tensor_cache_dir'],
+        queue_timeout=float(config['queue_timeout'])
+    )
+    if config['model_bundle'] and os.path.exists(config['model_bundle']):
+        server.load_model(config['model_bundle'])
+    elif config['train_dir']:
+        server.train_normal_model(list_images(config['train_dir']))
+        if config['save_bundle'] and server.padim_model.is_fitted:
+            server.save_model(config['save_bundle'])
+    elif not config['models']:
+        raise ValueError("需要配置 model_bundle、train_dir 或 models")
+    for name, path in config['models'].items():
+        server.load_model(path, name)
+    if not server.registry.names():
+        raise RuntimeError("模型未就绪，拒绝启动")
+    if config['metrics_port']:
+        server.start_metrics_endpoint(int(config['metrics_port']), config['profile_dir'])
+    return server
+
+
+def reload_models(server, config):
+    """重新加载配置中的模型包（SIGHUP）
+
+    加载期间进入排空状态，路由器把新会话分配到其他进程；
+    已固定旧版本的会话不受影响。
+    """
+    draining, server.draining = server.draining, True
+    try:
+        if config['model_bundle'] and os.path.exists(config['model_bundle']):
+            server.load_model(config['model_bundle'])
+        for name, path in config['models'].items():
+            server.load_model(path, name)
+    finally:
+        server.draining = draining
+
+
+def main(argv=None):
+    """无界面服务器守护进程入口"""
+    parser = argparse.ArgumentParser(description="医学影像密态检测服务器（无界面）")
+    parser.add_argument('-c', '--config', help="JSON配置文件路径")
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--listen', action='append',
+                        help="额外监听地址（unix:///path 或 shm:///path），可重复")
+    parser.add_argument('--model-bundle', dest='model_bundle')
+    parser.add_argument('--train-dir', dest='train_dir')
+    parser.add_argument('--save-bundle', dest='save_bundle')
+    parser.add_argument('--preprocess-workers', dest='preprocess_workers', type=int)
+    parser.add_argument('--tensor-cache', dest='tensor_cache_dir')
+    parser.add_argument('--max-workers', dest='max_workers', type=int)
+    parser.add_argument('--torch-threads', dest='torch_threads', type=int)
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int)
+    parser.add_argument('--drain-timeout', dest='drain_timeout', type=float)
+    args = parser.parse_args(argv)
+
+    overrides = {k: v for k, v in vars(args).items() if k != 'config'}
+    try:
+        config = load_config(args.config, overrides)
+    except (OSError, ValueError) as e:
+        print(f"配置错误: {e}", file=sys.stderr)
+        return 2
+
+    logging.basicConfig(
+        level=getattr(logging, str(config['log_level']).upper(), logging.INFO),
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    logger = logging.getLogger(__name__)
+
+    try:
+        server = build_server(config)
+    except Exception as e:
+        logger.error(f"启动错误: {e}")
+        return 1
+
+    def graceful_stop():
+        server.drain(float(config['drain_timeout']))
+        server.stop_server()
+
+    def run_reload():
+        try:
+            reload_models(server, config)
+        except Exception as e:
+            logger.error(f"重新加载模型失败: {e}")
+
+    def handle_signal(signum, frame):
+        # SIGTERM先排空再停止；SIGINT或排空中再次收到SIGTERM时立即停止
+        if signum == signal.SIGTERM and not server.draining:
+            logger.info(f"收到信号 {signum}，排空现有会话后停止")
+            threading.Thread(target=graceful_stop, daemon=True).start()
+        else:
+            logger.info(f"收到信号 {signum}，正在停止服务器")
+            server.stop_server()
+
+    def handle_reload(signum, frame):
+        logger.info("收到SIGHUP，重新加载模型")
+        threading.Thread(target=run_reload, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, handle_reload)
+
+    server.start_server()
+    # 排空超时或立即停止时，断开剩余会话（经路由器的客户端会转移到其他进程）
+    server.close_sessions()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
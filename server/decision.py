@@ -0,0 +1,102 @@
+# server/decision.py
+"""服务器端密态判定（可选模式）
+
+默认模式下服务器返回每个高斯分量的平方距离密文，由客户端解密后取最小值。
+判定模式下服务器在密文上用低次多项式近似“最小距离 < 阈值”，
+每张图像只返回一个密文，客户端解密一个数即可判定。
+多项式按模型的校准样本拟合并检验，与明文判定不一致时拒绝启用（回退到默认模式）。
+"""
+import numpy as np
+
+from shared.he_params import DECISION_DEGREES, decision_depth
+
+FIT_NODES = 2000
+RANGE_MARGIN = 1.5       # 拟合区间相对正常样本最大平方距离的余量
+PROBE_FACTORS = (0.8, 1.25)  # 检验时把校准样本的最小距离缩放到阈值的这些倍数
+MIN_AGREEMENT = 0.95     # 检验样本上与明文判定的最低一致率
+
+
+class DecisionPolynomial:
+    """某个模型版本在给定多项式次数下的密态判定
+
+    客户端特征和服务器端均值都除以input_scale，正常样本的平方距离d落在[0, 1]，
+    u = 2d - 1落在[-1, 1]，在u上最小二乘拟合阶跃函数1[u < 阈值]。
+    成对取最小值的比较树需要log2(分量数)倍的深度，这里改为利用
+    min_k d_k < T  <=>  sum_k 1[d_k < T] >= 1，
+    对各分量的多项式值求和（加法不消耗深度），结果近似为距离在阈值内的分量数，
+    >= 0.5判为正常。超出拟合区间的输入（远离所有分量的异常样本）会使多项式发散，
+    客户端把超出[-0.5, 分量数 + 0.5]的结果一律判为异常。
+
+    求和放大了每个分量的拟合误差，拟合时在Chebyshev节点之外加入校准样本实际的距离
+    （与节点总权重相同），使误差集中在没有样本的区间。拟合后在校准样本及其缩放到
+    阈值附近的版本上与明文判定比较，一致率低于MIN_AGREEMENT时抛出ValueError：
+    阈值远小于距离范围时（各分量相距很远），低次多项式无法在阈值处形成阶跃。
+    """
+
+    def __init__(self, calibration, distances, n_components, degree, margin=RANGE_MARGIN):
+        if degree not in DECISION_DEGREES:
+            raise ValueError(f"不支持的多项式次数 {degree}，可选 {DECISION_DEGREES}")
+        if not calibration or not calibration.get('distance_range') or distances is None:
+            raise ValueError("模型缺少距离校准信息，请重新训练后再使用密态判定")
+        self.degree = degree
+        self.n_components = n_components
+        span = calibration['distance_range'] * margin
+        self.input_scale = float(np.sqrt(span))
+        threshold = calibration['threshold'] ** 2
+        cutoff = 2 * threshold / span - 1
+        distances = np.asarray(distances, dtype=np.float64)
+
+        # Chebyshev节点上拟合，区间端点附近的振荡较小；校准距离按总权重与节点相同加入
+        nodes = np.cos(np.pi * (np.arange(FIT_NODES) + 0.5) / FIT_NODES)
+        samples = (2 * distances / span - 1).ravel()
+        points = np.concatenate([nodes, samples])
+        weights = np.concatenate([np.ones(FIT_NODES), np.full(samples.size, FIT_NODES / samples.size)])
+        fit = np.polynomial.Polynomial.fit(
+            points, (points < cutoff).astype(np.float64), degree, w=np.sqrt(weights), domain=[-1, 1]
+        )
+        self.coefficients = fit.convert().coef.tolist()
+
+        self.agreement = self._agreement(distances, threshold, span)
+        if self.agreement < MIN_AGREEMENT:
+            raise ValueError(
+                f"{degree}次多项式在校准样本上与明文判定的一致率为 {self.agreement:.1%}，"
+                f"低于 {MIN_AGREEMENT:.0%}（平方距离阈值 {threshold:.4g}，拟合区间 {span:.4g}）"
+            )
+
+    def plain_decision(self, distances, span):
+        """按密文上的计算在明文上复现判定，返回是否正常"""
+        u = 2 * np.asarray(distances) / span - 1
+        value = np.polynomial.polynomial.polyval(u, self.coefficients).sum(axis=-1)
+        return (value >= 0.5) & (value <= self.n_components + 0.5)
+
+    def _agreement(self, distances, threshold, span):
+        """校准样本，以及把最小距离缩放到阈值两侧的样本上，与明文判定的一致率"""
+        nearest = np.maximum(distances.min(axis=1, keepdims=True), 1e-12)
+        probes = [(distances, distances.min(axis=1) < threshold)]
+        for factor in PROBE_FACTORS:
+            probes.append((distances * (factor * threshold / nearest),
+                           np.full(len(distances), factor < 1)))
+        matches = [self.plain_decision(d, span) == expected for d, expected in probes]
+        return float(np.mean(np.concatenate(matches)))
+
+    def evaluate(self, encrypted_vector, means):
+        """在密文上计算判定值（means为按input_scale缩放后预加密的分量中心）"""
+        result = None
+        for mean in means:
+            diff = encrypted_vector - mean
+            distance = diff.dot(diff)
+            # u = 2d - 1，用加法代替乘以常数，不消耗深度
+            term = (distance + distance - 1).polyval(self.coefficients)
+            result = term if result is None else result + term
+        return result
+
+    def describe(self):
+        """发给客户端的参数：缩放特征、选择加密参数和解释结果都需要"""
+        return {
+            'degree': self.degree,
+            'depth': decision_depth(self.degree),
+            'input_scale': self.input_scale,
+            'components': self.n_components,
+            'cutoff': 0.5,
+            'agreement': round(self.agreement, 4),
+        }
@@ -0,0 +1,106 @@
+# server/he_cache.py
+import hashlib
+import threading
+from collections import OrderedDict
+
+import tenseal as ts
+
+
+def context_fingerprint(context_bytes):
+    """上下文指纹：相同的公钥材料得到相同的指纹"""
+    return hashlib.sha256(context_bytes).hexdigest()
+
+
+class LRUCache:
+    """线程安全的有界LRU缓存，同一个键只构建一次"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._building = {}  # key -> Event，避免并发会话重复构建
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_build(self, key, build):
+        """返回(value, hit)；未命中时调用build()并缓存结果"""
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key], True
+                event = self._building.get(key)
+                if event is None:
+                    event = self._building[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # 其他线程正在构建同一个键，等待后重新查找
+            event.wait()
+
+        try:
+            value = build()
+            with self._lock:
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            return value, False
+        finally:
+            with self._lock:
+                self._building.pop(key).set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class EncodedConstants:
+    """某个上下文下预先加密好的模型常量
+
+    TenSEAL的Python接口不暴露CKKS明文对象，每次“密文 - ndarray”都要重新
+    编码；这里在客户端公钥下预先加密模型常量，请求中只做密文-密文运算。
+    """
+
+    def __init__(self, context, model_version, scale=1.0):
+        self.model_key = model_version.key
+        self.scale = scale  # 密态判定模式下均值按输入缩放系数缩小
+        self.means = [
+            ts.ckks_vector(context, (mean / scale).tolist()) for mean in model_version.means
+        ]
+
+
+class HEConstantCache:
+    """按(上下文指纹, 模型版本, 缩放系数)缓存上下文对象和预编码常量"""
+
+    def __init__(self, max_contexts=16, max_constants=32):
+        self.contexts = LRUCache(max_contexts)
+        self.constants = LRUCache(max_constants)
+
+    def load_context(self, context_bytes):
+        """反序列化上下文，相同公钥的会话共享同一个上下文对象"""
+        fingerprint = context_fingerprint(context_bytes)
+        context, hit = self.contexts.get_or_build(
+            fingerprint, lambda: ts.context_from(context_bytes)
+        )
+        return fingerprint, context, hit
+
+    def get_constants(self, fingerprint, context, model_version, scale=1.0):
+        """获取（必要时构建）该上下文和模型版本下的预编码常量"""
+        constants, _ = self.constants.get_or_build(
+            (fingerprint,) + model_version.key + (scale,),
+            lambda: EncodedConstants(context, model_version, scale)
+        )
+        return constants
+
+    def stats(self):
+        return {'contexts': self.contexts.stats(), 'constants': self.constants.stats()}
@@ -0,0 +1,436 @@
+# server/metrics.py
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as _TallyCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    """单调递增计数器；也可以用回调函数在采集时读取其他对象维护的累计值"""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        # callback返回 {标签值元组: 数值}，无标签时返回单个数值
+        self._callback = callback
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self._callback is not None:
+            result = self._callback()
+            return result if isinstance(result, dict) else {(): result}
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = self.header()
+        for key, value in sorted(self.samples().items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    """可增可减的瞬时值；也可以用回调函数在采集时取值"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """累积分桶直方图"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # key -> [各桶计数..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def summary(self):
+        """每个标签组合的 count / sum / mean"""
+        with self._lock:
+            return {
+                key: {'count': s[-1], 'sum': s[-2], 'mean': s[-2] / s[-1] if s[-1] else 0.0}
+                for key, s in self._series.items()
+            }
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            series = {key: list(s) for key, s in self._series.items()}
+        for key, s in sorted(series.items()):
+            for bound, count in zip(self.buckets, s):
+                labels = _format_labels(self.labelnames, key, [('le', bound)])
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            lines.append(f'{self.name}_bucket{labels} {s[-1]}')
+            plain = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{plain} {s[-2]}')
+            lines.append(f'{self.name}_count{plain} {s[-1]}')
+        return lines
+
+
+class MetricsRegistry:
+    """指标集合，输出Prometheus文本格式"""
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已存在: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), callback=None):
+        return self._register(Counter(self.prefix + name, documentation, labelnames, callback))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self._register(Gauge(self.prefix + name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self.prefix + name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # 回调出错不影响其他指标
+                lines.append(f'# {metric.name} 采集失败: {e}')
+        return '\n'.join(lines) + '\n'
+
+
+class ServerMetrics:
+    """MedicalAIServer的请求级指标"""
+
+    STAGES = ('receive', 'deserialize', 'he_eval', 'serialize', 'send')
+
+    def __init__(self, server=None):
+        self.registry = MetricsRegistry('ppmad_')
+        self.stage_seconds = self.registry.histogram(
+            'stage_seconds', '每个请求各阶段耗时（秒）', ('stage', 'type'))
+        self.requests = self.registry.counter(
+            'requests_total', '已处理的请求数', ('type', 'status'))
+        self.errors = self.registry.counter('errors_total', '错误数', ('kind',))
+        self.bytes_in = self.registry.counter('bytes_received_total', '接收字节数')
+        self.bytes_out = self.registry.counter('bytes_sent_total', '发送字节数')
+        self.active_sessions = self.registry.gauge('active_sessions', '当前活动会话数')
+        self.queue_depth = self.registry.gauge('queue_depth', '已接受但等待工作线程的连接数')
+        self.started_at = time.time()
+        self.registry.gauge('uptime_seconds', '运行时间（秒）',
+                            callback=lambda: round(time.time() - self.started_at, 3))
+        if server is not None:
+            self._register_server_gauges(server)
+
+    def _register_server_gauges(self, server):
+        def cache_stat(field):
+            def collect():
+                stats = server.he_cache.stats()
+                return {(name,): stats[name][field] for name in ('contexts', 'constants')}
+            return collect
+
+        self.registry.counter('he_cache_hits_total', 'HE缓存命中次数', ('cache',), cache_stat('hits'))
+        self.registry.counter('he_cache_misses_total', 'HE缓存未命中次数', ('cache',),
+                              cache_stat('misses'))
+        self.registry.gauge('he_cache_entries', 'HE缓存条目数', ('cache',), cache_stat('entries'))
+        self.registry.gauge('receive_buffer_bytes', '已占用的接收缓冲区预算（字节）',
+                            callback=lambda: server.receive_budget.in_use)
+        self.registry.gauge(
+            'model_version', '各模型当前版本', ('model',),
+            lambda: {(name,): info['version'] for name, info in server.registry.describe().items()}
+        )
+
+    @contextmanager
+    def time(self, stage, request_type='-'):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds.observe(time.perf_counter() - start, stage=stage, type=request_type)
+
+    def render(self):
+        return self.registry.render()
+
+    def snapshot(self):
+        """供界面显示的摘要"""
+        stages = {}
+        for (stage, _), info in self.stage_seconds.summary().items():
+            total = stages.setdefault(stage, {'count': 0, 'sum': 0.0})
+            total['count'] += info['count']
+            total['sum'] += info['sum']
+        requests = sum(self.requests.samples().values())
+        return {
+            'active_sessions': self.active_sessions.value(),
+            'queue_depth': self.queue_depth.value(),
+            'requests': requests,
+            'errors': sum(self.errors.samples().values()),
+            'bytes_in': self.bytes_in.value(),
+            'bytes_out': self.bytes_out.value(),
+            'stage_mean_ms': {
+                stage: round(1000 * info['sum'] / info['count'], 2) if info['count'] else 0.0
+                for stage, info in stages.items()
+            },
+        }
+
+
+class SamplingProfiler:
+    """采样分析器：定期抓取所有线程的调用栈，输出折叠栈格式
+
+    输出与 py-spy record --format raw / flamegraph.pl 兼容：
+    每行“frame;frame;frame 次数”。
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("已有采样正在进行")
+        try:
+            tally = _TallyCounter()
+            me = threading.get_ident()
+            names = {}
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names.update({t.ident: t.name for t in threading.enumerate()})
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = [
+                        f'{f.name} ({os.path.basename(f.filename)}:{f.lineno})'
+                        for f in traceback.extract_stack(frame)
+                    ]
+                    tally[';'.join([names.get(ident, str(ident))] + stack)] += 1
+                time.sleep(self.interval)
+            return ''.join(f'{stack} {count}\n' for stack, count in tally.most_common())
+        finally:
+            self._lock.release()
+
+
+class RequestProfiler:
+    """按请求的cProfile：开启期间逐个抽样分析请求，结束时合并为一个pstats
+
+    Python 3.12起同一时刻只能启用一个分析器，因此一次只分析一个请求，
+    其余并发请求照常执行；其他分析工具已启用时也不分析。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = threading.Lock()  # 正在被分析的请求
+        self._deadline = 0.0
+        self._profiles = []
+
+    @property
+    def active(self):
+        return time.monotonic() < self._deadline
+
+    def start(self, seconds):
+        with self._lock:
+            self._profiles = []
+            self._deadline = time.monotonic() + seconds
+
+    def call(self, func, *args, **kwargs):
+        if not self.active or not self._running.acquire(blocking=False):
+            return func(*args, **kwargs)
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # 其他分析工具已启用
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._profiles.append(profile)
+        finally:
+            self._running.release()
+
+    def collect(self, path=None):
+        """合并已收集的分析结果；给出path时保存为.prof（可用snakeviz等查看）"""
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+        stats = None
+        for profile in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                continue  # 没有采集到调用的分析结果
+        if stats is None:
+            return None
+        if path:
+            stats.dump_stats(path)
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats('cumulative').print_stats(40)
+        return text.getvalue()
+
+
+class MetricsHTTPServer:
+    """仅监听本机的指标与诊断端点
+
+    GET /metrics                             Prometheus文本格式
+    GET /debug/profile?seconds=10            所有线程的采样折叠栈
+    GET /debug/profile?mode=cprofile&seconds=10
+                                             期间所有请求的cProfile汇总（同时保存.prof文件）
+    GET /debug/stacks                        当前所有线程的调用栈
+    """
+
+    MAX_PROFILE_SECONDS = 120
+
+    def __init__(self, metrics, request_profiler=None, host='127.0.0.1', port=9108,
+                 profile_dir=None):
+        self.metrics = metrics
+        self.request_profiler = request_profiler
+        self.sampler = SamplingProfiler()
+        self.profile_dir = profile_dir
+        self.logger = logging.getLogger(__name__)
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def _handler_class(self):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                owner.logger.debug(format % args)
+
+            def _reply(self, status, body, content_type='text/plain; charset=utf-8'):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                try:
+                    if url.path == '/metrics':
+                        self._reply(200, owner.metrics.render(),
+                                    'text/plain; version=0.0.4; charset=utf-8')
+                    elif url.path == '/debug/profile':
+                        seconds = min(float(query.get('seconds', ['10'])[0]),
+                                      owner.MAX_PROFILE_SECONDS)
+                        mode = query.get('mode', ['sample'])[0]
+                        self._reply(200, owner.profile(mode, seconds))
+                    elif url.path == '/debug/stacks':
+                        self._reply(200, owner.dump_stacks())
+                    else:
+                        self._reply(404, 'not found\n')
+                except (ValueError, RuntimeError) as e:
+                    self._reply(400, f'{e}\n')
+
+        return Handler
+
+    def profile(self, mode, seconds):
+        if mode == 'sample':
+            return self.sampler.record(seconds) or '没有采集到样本\n'
+        if mode == 'cprofile':
+            if self.request_profiler is None:
+                raise ValueError("未启用请求分析")
+            self.request_profiler.start(seconds)
+            time.sleep(seconds)
+            path = None
+            if self.profile_dir:
+                path = os.path.join(self.profile_dir, f'requests-{int(time.time())}.prof')
+            text = self.request_profiler.collect(path)
+            if text is None:
+                return '分析期间没有请求\n'
+            return (f'已保存到 {path}\n\n' if path else '') + text
+        raise ValueError(f"未知的分析模式: {mode}")
+
+    def dump_stacks(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        parts = []
+        for ident, frame in sys._current_frames().items():
+            parts.append(f'--- {names.get(ident, ident)} ---\n' + ''.join(traceback.format_stack(frame)))
+        return '\n'.join(parts)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        self.logger.info(f"指标端点: http://{self.httpd.server_address[0]}:{self.port}/metrics")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
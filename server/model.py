@@ -3,21 +3,25 @@ import torch
 import torch.nn as nn
 import torchvision.models as models
 import numpy as np
+import copy
 from sklearn.mixture import GaussianMixture
 from sklearn.decomposition import PCA
 import logging
+import pickle
+from shared.dtypes import COMPUTE_DTYPE, to_storage, pack_upper, unpack_upper
 
 class WideResNet101FeatureExtractor:
     """WideResNet101特征提取器"""
     
-    def __init__(self):
+    def __init__(self, pretrained=True):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.pretrained = pretrained
         self.model = self._load_model()
         self.features = {}
         
     def _load_model(self):
         """加载预训练的WideResNet101模型"""
-        model = models.wide_resnet101_2(pretrained=True)
+        model = models.wide_resnet101_2(pretrained=self.pretrained)
         model.fc = nn.Identity()  # 移除最后的全连接层
         model = model.to(self.device)
         model.eval()
@@ -31,11 +35,26 @@ class WideResNet101FeatureExtractor:
             image_tensor = image_tensor.to(self.device)
             features = self.model(image_tensor)
             return features.cpu().numpy().flatten()
+    
+    def extract_features_batch(self, image_tensors) -> np.ndarray:
+        """批量提取图像特征，返回(N, D)数组"""
+        with torch.no_grad():
+            batch = torch.stack(list(image_tensors)).to(self.device)
+            features = self.model(batch)
+            return features.cpu().numpy().reshape(len(batch), -1)
 
 class PaDimModel:
     """PaDim异常检测模型"""
     
-    def __init__(self, n_components=10, random_state=42):
+    BUNDLE_VERSION = 2  # 2：GMM协方差和精度矩阵按上三角压缩保存
+    SUPPORTED_BUNDLES = (1, 2)
+    
+    def __init__(self, n_components=10, random_state=42, holdout=0.2, quantile=0.99):
+        self.random_state = random_state
+        self.holdout = holdout    # 留出用于校准的正常样本比例
+        self.quantile = quantile  # 阈值取留出正常样本分数的分位数
+        self.calibration = None
+        self.calibration_distances = None  # 校准样本到各分量的平方距离，用于拟合和检验密态判定
         self.gmm = GaussianMixture(
             n_components=n_components, 
             random_state=random_state,
@@ -45,16 +64,125 @@ class PaDimModel:
         self.is_fitted = False
         self.normal_features = []
         
-    def fit(self, features_list):
-        """训练GMM模型"""
-        if not features_list:
+    def fit(self, features_list, copy=True):
+        """训练GMM模型
+        
+        特征统一转换为float32。copy为False时直接使用调用方的float32数组，
+        原地打乱顺序和中心化，不再额外复制（大训练集可节省数倍内存）。
+        """
+        if len(features_list) == 0:
             raise ValueError("特征列表为空")
             
-        # 使用PCA降维
-        reduced_features = self.pca.fit_transform(features_list)
-        self.gmm.fit(reduced_features)
+        if copy:
+            features = np.array(features_list, dtype=COMPUTE_DTYPE)
+        else:
+            features = np.asarray(features_list, dtype=COMPUTE_DTYPE)
+        train, held_out = self._split_holdout(features)
+        
+        # 使用PCA降维；有留出集时训练集之后不再使用，可以原地中心化
+        self.pca.copy = not len(held_out)
+        reduced_features = self.pca.fit_transform(train)
+        # 降维后的矩阵很小，GMM按float64拟合：float32下小样本的全协方差容易奇异
+        self.gmm.fit(reduced_features.astype(np.float64))
         self.is_fitted = True
-        self.normal_features = reduced_features
+        self.normal_features = to_storage(reduced_features)
+        
+        if len(held_out):
+            self.calibration = self.calibrate(held_out, source='holdout')
+        else:
+            logging.warning("正常样本过少，无法留出校准集，阈值按训练样本估计（偏低）")
+            self.calibration = self.calibrate(train, source='train')
+    
+    def _split_holdout(self, features):
+        """随机留出一部分正常样本用于校准，训练集不足以拟合PCA/GMM时不留出"""
+        n_holdout = int(round(len(features) * self.holdout))
+        n_train = len(features) - n_holdout
+        if n_holdout < 2 or n_train < max(self.pca.n_components, self.gmm.n_components):
+            return features, features[:0]
+        # 原地打乱后切片（视图），与按permutation索引得到的划分相同
+        np.random.RandomState(self.random_state).shuffle(features)
+        return features[n_holdout:], features[:n_holdout]
+    
+    def score(self, features: np.ndarray) -> np.ndarray:
+        """异常分数：PCA空间中到最近高斯分量中心的欧氏距离（与密态评估一致）"""
+        return np.sqrt(self.squared_distances(features).min(axis=1))
+    
+    def squared_distances(self, features: np.ndarray) -> np.ndarray:
+        """PCA空间中到每个高斯分量中心的平方距离，形状(N, n_components)"""
+        if not self.is_fitted:
+            raise RuntimeError("模型尚未训练")
+        reduced = self.pca.transform(np.atleast_2d(features))
+        return ((reduced[:, None, :] - self.gmm.means_[None, :, :]) ** 2).sum(axis=-1)
+    
+    def calibrate(self, features, source='holdout'):
+        """根据正常样本的分数分布计算归一化参数和阈值"""
+        squared = self.squared_distances(features)
+        self.calibration_distances = squared.astype(COMPUTE_DTYPE)
+        scores = np.sqrt(squared.min(axis=1))
+        loc = float(np.mean(scores))
+        scale = float(np.std(scores)) or 1.0
+        threshold = float(np.quantile(scores, self.quantile))
+        return {
+            'score': 'min_distance',
+            'loc': loc,
+            'scale': scale,
+            'threshold': threshold,
+            'normalized_threshold': (threshold - loc) / scale,
+            'quantile': self.quantile,
+            'samples': len(scores),
+            'source': source,
+            # 正常样本到任一分量的最大平方距离，服务器端密态判定据此缩放输入
+            'distance_range': float(squared.max()),
+        }
+    
+    def __getstate__(self):
+        """模型包中GMM的协方差和精度矩阵Cholesky因子只保存上三角（float32），
+        精度矩阵加载时重算；打分只用到分量中心，中心保持原精度"""
+        state = self.__dict__.copy()
+        gmm = self.gmm
+        if getattr(gmm, 'covariance_type', None) == 'full' and hasattr(gmm, 'covariances_'):
+            packed = {
+                'covariances': pack_upper(gmm.covariances_).astype(COMPUTE_DTYPE),
+                'precisions_cholesky': pack_upper(gmm.precisions_cholesky_).astype(COMPUTE_DTYPE),
+                'n_features': gmm.covariances_.shape[-1],
+            }
+            gmm = copy.copy(gmm)
+            del gmm.covariances_, gmm.precisions_cholesky_, gmm.precisions_
+            state['gmm'] = gmm
+            state['packed_gmm'] = packed
+        return state
+    
+    def __setstate__(self, state):
+        packed = state.pop('packed_gmm', None)
+        self.__dict__.update(state)
+        if packed is not None:
+            n = packed['n_features']
+            gmm = self.gmm
+            dtype = gmm.means_.dtype
+            gmm.covariances_ = unpack_upper(packed['covariances'], n).astype(dtype)
+            gmm.precisions_cholesky_ = unpack_upper(
+                packed['precisions_cholesky'], n, symmetric=False
+            ).astype(dtype)
+            gmm.precisions_ = gmm.precisions_cholesky_ @ np.swapaxes(gmm.precisions_cholesky_, -1, -2)
+    
+    def save(self, path):
+        """保存模型包（PCA + GMM）"""
+        if not self.is_fitted:
+            raise RuntimeError("模型尚未训练")
+        with open(path, 'wb') as f:
+            pickle.dump({'version': self.BUNDLE_VERSION, 'model': self}, f)
+    
+    @classmethod
+    def load(cls, path):
+        """加载模型包（仅加载可信来源的文件）"""
+        with open(path, 'rb') as f:
+            bundle = pickle.load(f)
+        if not isinstance(bundle, dict) or bundle.get('version') not in cls.SUPPORTED_BUNDLES:
+            raise ValueError(f"不支持的模型包格式: {path}")
+        model = bundle['model']
+        if not isinstance(model, cls) or not model.is_fitted:
+            raise ValueError(f"模型包中没有已训练的模型: {path}")
+        return model
         
     def calculate_mahalanobis_distance(self, feature: np.ndarray) -> float:
         """计算马氏距离（简化版）"""
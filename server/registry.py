@@ -0,0 +1,127 @@
+# server/registry.py
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_MODEL = 'default'
+
+
+class ModelVersion:
+    """不可变的模型版本快照，会话在整个生命周期内固定使用同一个版本"""
+
+    __slots__ = ('name', 'version', 'model', 'means', 'pca_components', 'pca_mean',
+                 'calibration', 'calibration_distances', 'digest', 'created_at')
+
+    def __init__(self, name, version, model):
+        if not model.is_fitted:
+            raise ValueError("不能发布未训练的模型")
+        # 复制为只读数组，之后对原模型的修改不会影响已发布的版本
+        means = np.array(model.gmm.means_, copy=True)
+        components = np.array(model.pca.components_, copy=True)
+        pca_mean = np.array(model.pca.mean_, copy=True)
+        for array in (means, components, pca_mean):
+            array.setflags(write=False)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'model', model)
+        object.__setattr__(self, 'means', means)
+        object.__setattr__(self, 'pca_components', components)
+        object.__setattr__(self, 'pca_mean', pca_mean)
+        # 旧模型包没有校准信息
+        calibration = getattr(model, 'calibration', None)
+        object.__setattr__(self, 'calibration', dict(calibration) if calibration else None)
+        distances = getattr(model, 'calibration_distances', None)
+        if distances is not None:
+            distances = np.array(distances, copy=True)
+            distances.setflags(write=False)
+        object.__setattr__(self, 'calibration_distances', distances)
+        # 模型内容摘要：版本号只在本进程内有效，重启或重新训练后同一版本号可能是另一个模型
+        digest = hashlib.sha256()
+        for array in (components, pca_mean, means) + ((distances,) if distances is not None else ()):
+            digest.update(f'{array.dtype.str}{array.shape}'.encode('ascii'))
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest.update(json.dumps(self.calibration, sort_keys=True).encode('utf-8'))
+        object.__setattr__(self, 'digest', digest.hexdigest())
+        object.__setattr__(self, 'created_at', time.time())
+
+    def __setattr__(self, key, value):
+        raise AttributeError("ModelVersion是只读的")
+
+    @property
+    def key(self):
+        return (self.name, self.version)
+
+    def __repr__(self):
+        return f"ModelVersion({self.name!r}, v{self.version})"
+
+
+class ModelRegistry:
+    """多模型注册表：按名称（模态/部位）管理模型，发布时原子切换引用
+
+    会话通过acquire固定一个版本，release后若该版本已不是当前版本且没有
+    会话再持有，就从注册表中移除以便释放内存。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = {}       # name -> ModelVersion
+        self._retired = {}       # (name, version) -> ModelVersion，仍被会话持有的旧版本
+        self._refs = {}          # (name, version) -> 引用计数
+        self._next_version = {}  # name -> 下一个版本号
+
+    def publish(self, model, name=DEFAULT_MODEL):
+        """发布新模型版本并原子切换为当前版本"""
+        with self._lock:
+            version = self._next_version.get(name, 1)
+            self._next_version[name] = version + 1
+            model_version = ModelVersion(name, version, model)
+            previous = self._current.get(name)
+            self._current[name] = model_version
+            if previous is not None and self._refs.get(previous.key, 0) > 0:
+                self._retired[previous.key] = previous
+            return model_version
+
+    def current(self, name=DEFAULT_MODEL):
+        """当前版本（不固定），不存在时返回None"""
+        return self._current.get(name)
+
+    def acquire(self, name=DEFAULT_MODEL):
+        """固定并返回当前版本，用完必须调用release"""
+        with self._lock:
+            model_version = self._current.get(name)
+            if model_version is None:
+                raise KeyError(f"模型不存在: {name}")
+            self._refs[model_version.key] = self._refs.get(model_version.key, 0) + 1
+            return model_version
+
+    def release(self, model_version):
+        """释放会话对版本的固定"""
+        with self._lock:
+            key = model_version.key
+            count = self._refs.get(key, 0) - 1
+            if count > 0:
+                self._refs[key] = count
+                return
+            self._refs.pop(key, None)
+            self._retired.pop(key, None)
+
+    def names(self):
+        return sorted(self._current)
+
+    def describe(self):
+        """各模型的当前版本及仍被持有的旧版本"""
+        with self._lock:
+            return {
+                name: {
+                    'version': current.version,
+                    'digest': current.digest,
+                    'sessions': self._refs.get(current.key, 0),
+                    'retired': sorted(
+                        version for (n, version) in self._retired if n == name
+                    ),
+                }
+                for name, current in self._current.items()
+            }
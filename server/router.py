@@ -0,0 +1,654 @@
+# server/router.py
+"""会话路由器：把客户端会话分配到多个服务器进程，横向扩展
+
+- 按上下文指纹一致性哈希选择服务器进程，同一公钥的会话落到同一进程，
+  复用该进程缓存的上下文和预编码常量；增减进程时只有相邻区间的会话迁移
+- 定期发送health请求：不可达或排空中（SIGTERM、重新加载模型）的进程不再分配新会话
+- 服务器进程断开时，把会话转移到环上的下一个进程：重新上传上下文、
+  重新固定模型，再重发尚未收到响应的请求（计算请求是幂等的）；
+  新进程上的模型与原来不同时断开会话，避免同一会话的结果来自不同模型
+
+路由器按消息转发，不解密也不计算，只解析public_key（计算指纹）和
+get_pca_params的响应（比较模型）。
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+# 添加路径以便导入本地模块
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from shared.communication import CommunicationProtocol, FrameLimits, FrameTooLarge, ProtocolError
+from shared import transport
+
+DEFAULT_REPLICAS = 64
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def context_fingerprint(context_bytes):
+    """上下文指纹（与服务器端he_cache相同，路由器不依赖tenseal）"""
+    return hashlib.sha256(context_bytes).hexdigest()
+
+
+def _shutdown(conn):
+    """中断连接上阻塞的读写（另一个线程随后读到连接关闭）"""
+    try:
+        getattr(conn, 'sock', conn).shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class HashRing:
+    """一致性哈希环，每个节点放置replicas个虚拟节点使分布均匀"""
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self._positions = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            position = _hash(f"{node}#{i}")
+            index = bisect.bisect(self._positions, position)
+            self._positions.insert(index, position)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        keep = [(p, n) for p, n in zip(self._positions, self._nodes) if n != node]
+        self._positions = [p for p, _ in keep]
+        self._nodes = [n for _, n in keep]
+
+    def lookup(self, key, accept=None):
+        """从key的位置顺时针查找第一个满足accept的节点，都不满足时返回None"""
+        if not self._nodes:
+            return None
+        start = bisect.bisect(self._positions, _hash(key))
+        seen = set()
+        for i in range(len(self._nodes)):
+            node = self._nodes[(start + i) % len(self._nodes)]
+            if node in seen:
+                continue
+            if accept is None or accept(node):
+                return node
+            seen.add(node)
+        return None
+
+
+class WorkerState:
+    """一个服务器进程的健康状态（由健康检查线程更新）"""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = False
+        self.draining = False
+        self.failures = 0
+        self.sessions = 0
+        self.failovers = 0  # 从该进程转移走的会话数
+        self.models = {}
+        self.checked_at = None
+
+    @property
+    def accepting(self):
+        return self.healthy and not self.draining
+
+    def describe(self):
+        return {
+            'healthy': self.healthy,
+            'draining': self.draining,
+            'sessions': self.sessions,
+            'failovers': self.failovers,
+            'models': self.models,
+        }
+
+
+class _Request:
+    """已转发、等待响应的请求；forward为False的是转移时补发的请求，响应不回传客户端"""
+
+    __slots__ = ('kind', 'payload', 'data_type', 'message_type', 'forward', 'answered')
+
+    def __init__(self, kind, payload, data_type, message_type, forward=True):
+        self.kind = kind
+        self.payload = payload
+        self.data_type = data_type
+        self.message_type = message_type
+        self.forward = forward
+        self.answered = False
+
+    def replay(self):
+        return _Request(self.kind, self.payload, self.data_type, self.message_type, forward=False)
+
+
+def model_digest(response):
+    """get_pca_params响应中模型内容的摘要（各进程的版本号互不相关，只能比较内容）"""
+    content = [response.get(key) for key in
+               ('model_name', 'pca_components', 'pca_mean', 'calibration', 'decision')]
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class RouterSession:
+    """一个客户端连接
+
+    会话线程读取客户端请求，发送线程把请求写往上游，响应线程读取上游响应转发给客户端，
+    并在进程断开时转移会话。持有_lock时不做任何套接字读写：上游在等待其响应被读走时
+    不再读取请求，若发送方持锁阻塞，读取响应的线程就拿不到锁，两边互相等待。
+    """
+
+    def __init__(self, router, client, address):
+        self.router = router
+        self.client = client
+        self.address = address
+        self.worker = None
+        self.upstream = None
+        self.pending = deque()    # 已排队或已发送、等待响应的请求（按发送顺序）
+        self.outbox = deque()     # 尚未发往当前上游的请求
+        self.context = None       # 最近一次public_key请求
+        self.fingerprint = None
+        self.pin = None           # 最近一次get_pca_params请求
+        self.digest = None        # 当前固定模型的摘要
+        self.failovers = 0
+        self.closed = False
+        self._lock = threading.Lock()          # 保护upstream、pending和outbox，持有时不做I/O
+        self._outbox_changed = threading.Condition(self._lock)
+        self._client_lock = threading.Lock()   # 会话线程（错误）和响应线程都会写客户端
+        self._pump = None
+
+    @property
+    def logger(self):
+        return self.router.logger
+
+    def run(self):
+        limits = self.router.frame_limits
+        try:
+            while not self.closed:
+                try:
+                    payload, data_type, message_type = CommunicationProtocol.receive_message(
+                        self.client, limits=limits
+                    )
+                except FrameTooLarge as e:
+                    self.logger.warning(f"客户端 {self.address} 的帧超过限制: {e}")
+                    self.reply_error(str(e))
+                    break
+                if payload is None:
+                    break
+                if not self.forward(payload, data_type, message_type):
+                    break
+        except (OSError, ProtocolError) as e:
+            if not self.closed:
+                self.logger.info(f"客户端 {self.address} 连接中断: {e}")
+        finally:
+            self.close()
+
+    def forward(self, payload, data_type, message_type):
+        """把一条客户端请求交给发送线程，返回是否继续"""
+        kind = 'request'
+        if message_type == 'public_key' and data_type == "json":
+            kind = 'context'
+            data = CommunicationProtocol.decode_payload(payload, data_type)
+            fingerprint = context_fingerprint(data['context'])
+            del data
+            payload = self.router.intern_context(fingerprint, payload)
+            if self.fingerprint is not None:
+                self.router.release_context(self.fingerprint)
+            self.fingerprint = fingerprint
+        elif message_type == 'get_pca_params':
+            kind = 'pin'
+        if self._pump is None and not self._start():
+            self.reply_error("没有可用的服务器")
+            return False
+        request = _Request(kind, payload, data_type, message_type)
+        with self._lock:
+            # 上游处理不过来时在这里等待（不读取客户端），压力经TCP窗口传回客户端
+            while not self.closed and len(self.outbox) >= self.router.max_queued:
+                self._outbox_changed.wait()
+            if self.closed:
+                return False
+            if kind == 'context':
+                self.context = request
+            elif kind == 'pin':
+                self.pin = request
+            self.pending.append(request)
+            self.outbox.append(request)
+            self._outbox_changed.notify_all()
+        return True
+
+    def _start(self):
+        """第一条请求：连接服务器进程（有上下文时按指纹选择），启动发送和响应线程"""
+        bound = self._connect()
+        if bound is None:
+            return False
+        with self._lock:
+            self.worker, self.upstream = bound
+        threading.Thread(target=self.send_loop, name=f'send-{self.address}', daemon=True).start()
+        self._pump = threading.Thread(target=self.pump, name=f'pump-{self.address}', daemon=True)
+        self._pump.start()
+        return True
+
+    def _connect(self, exclude=()):
+        """选择服务器进程并连接，返回(进程, 连接)，没有可用进程时返回None（不持有_lock）"""
+        key = self.fingerprint or str(self.address)
+        tried = set(exclude)  # 只在本次选择中排除，之后恢复的进程仍可再次使用
+        while True:
+            worker = self.router.pick(key, tried)
+            if worker is None:
+                return None
+            tried.add(worker.url)
+            try:
+                upstream = transport.connect(worker.url, self.router.connect_timeout)
+            except OSError as e:
+                self.router.report_failure(worker, e)
+                continue
+            self.router.attach(self, worker)
+            return worker, upstream
+
+    def send_loop(self):
+        """按顺序把outbox中的请求写往当前上游；写失败时由响应线程发现断开并转移"""
+        while True:
+            with self._lock:
+                while not self.closed and (not self.outbox or self.upstream is None):
+                    self._outbox_changed.wait()
+                if self.closed:
+                    return
+                request = self.outbox.popleft()
+                upstream = self.upstream
+                self._outbox_changed.notify_all()
+            try:
+                CommunicationProtocol.send_message(
+                    upstream, request.payload, request.data_type, request.message_type
+                )
+            except OSError:
+                _shutdown(upstream)  # 让响应线程尽快读到断开
+
+    def pump(self):
+        """把上游响应按请求顺序转发给客户端"""
+        while not self.closed:
+            upstream = self.upstream
+            if upstream is None:
+                break
+            try:
+                payload, data_type, message_type = CommunicationProtocol.receive_message(upstream)
+            except (OSError, ProtocolError) as e:
+                self.logger.debug(f"上游 {self.worker.url} 读取失败: {e}")
+                payload = None
+            if self.closed:
+                break
+            if payload is None:
+                if not self._failover(upstream):
+                    break
+                continue
+            with self._lock:
+                request = self.pending.popleft() if self.pending else None
+            if request is None:
+                self.logger.warning(f"上游 {self.worker.url} 返回了多余的响应")
+                continue
+            if not self._accept_response(request, payload, data_type):
+                break
+            if request.forward:
+                try:
+                    with self._client_lock:
+                        CommunicationProtocol.send_message(
+                            self.client, payload, data_type, message_type
+                        )
+                except OSError:
+                    break
+        self.close()
+
+    def _accept_response(self, request, payload, data_type):
+        """记录上下文和模型固定的响应；补发失败或转移后模型不一致时返回False"""
+        request.answered = True
+        if request.kind == 'request':
+            return True
+        response = CommunicationProtocol.decode_payload(payload, data_type)
+        success = response.get('status') == 'success'
+        if request.kind == 'context':
+            if not request.forward and not success:
+                self.logger.warning(f"会话 {self.address} 在 {self.worker.url} 上补发上下文失败")
+            return request.forward or success
+        digest = (response.get('model_digest') or model_digest(response)) if success else None
+        if request.forward:
+            self.digest = digest
+            return True
+        if digest != self.digest:
+            self.logger.warning(
+                f"会话 {self.address} 转移到 {self.worker.url} 后模型不一致，断开会话"
+            )
+            return False
+        return True
+
+    def _failover(self, failed):
+        """上游断开：连接下一个进程，补发上下文和模型固定请求，再重发未响应的请求
+
+        在响应线程中执行，但不在这里发送：请求交给发送线程，本线程立即回去读取响应，
+        上游不会因为响应无人读取而停止接收补发的请求。
+        """
+        with self._lock:
+            if self.upstream is not failed or self.closed:
+                return not self.closed  # 已由其他路径完成转移
+            worker = self.worker
+            self.upstream = None
+            self.outbox.clear()
+        _shutdown(failed)  # 中断发送线程在旧连接上阻塞的写
+        failed.close()
+        self.router.detach(self, worker)
+        self.router.report_failure(worker, "连接断开", session=True)
+        if self.failovers >= self.router.max_failovers:
+            self.logger.warning(f"会话 {self.address} 转移次数过多，断开")
+            return False
+        self.failovers += 1
+        bound = self._connect(exclude={worker.url})
+        if bound is None:
+            self.logger.warning(f"会话 {self.address} 无法转移：没有可用的服务器")
+            self.reply_error("服务器连接中断，且没有可用的服务器")
+            return False
+        with self._lock:
+            if self.closed:
+                self.router.detach(self, bound[0])
+                bound[1].close()
+                return False
+            self.worker, self.upstream = bound
+            # 会话线程在转移期间排队的请求也在pending中，一并重发
+            requests = [r for r in self.pending if r.forward]
+            replays = [r.replay() for r in (self.context, self.pin)
+                       if r is not None and r.answered]
+            self.pending = deque(replays + requests)
+            self.outbox = deque(self.pending)
+            self._outbox_changed.notify_all()
+        self.logger.info(
+            f"会话 {self.address} 从 {worker.url} 转移到 {self.worker.url}，"
+            f"重发 {len(requests)} 个请求"
+        )
+        return True
+
+    def reply_error(self, message):
+        try:
+            with self._client_lock:
+                CommunicationProtocol.send_data(
+                    self.client, {'status': 'error', 'message': message}, "json"
+                )
+        except OSError:
+            pass
+
+    def abort(self):
+        """中断会话（路由器停止时）"""
+        _shutdown(self.client)
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            upstream, self.upstream = self.upstream, None
+            self.outbox.clear()
+            self._outbox_changed.notify_all()
+        if upstream is not None:
+            self.router.detach(self, self.worker)
+            _shutdown(upstream)
+            upstream.close()
+        _shutdown(self.client)
+        self.client.close()
+        if self.fingerprint is not None:
+            self.router.release_context(self.fingerprint)
+            self.fingerprint = None
+        self.router.session_closed(self)
+
+
+class MedicalAIRouter:
+    def __init__(self, listen, workers, health_interval=2.0, health_timeout=2.0,
+                 failure_threshold=2, connect_timeout=5.0, max_failovers=3,
+                 frame_limits=None, replicas=DEFAULT_REPLICAS, max_queued=8):
+        self.listen_urls = list(listen)
+        self.workers = {url: WorkerState(url) for url in workers}
+        self.ring = HashRing(self.workers, replicas)
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.failure_threshold = failure_threshold
+        self.connect_timeout = connect_timeout
+        self.max_failovers = max_failovers
+        self.max_queued = max_queued  # 每个会话排队等待发往上游的请求数上限
+        self.frame_limits = frame_limits or FrameLimits()
+        self.sessions = set()
+        self._sessions_changed = threading.Condition()
+        self._lock = threading.Lock()
+        self._contexts = {}  # 指纹 -> [public_key请求负载, 引用计数]，同一公钥的会话共用一份
+        self._stop_event = threading.Event()
+        self._accepting = threading.Event()
+        self.failovers = 0
+        self.setup_logging()
+
+    def setup_logging(self):
+        """设置日志"""
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(levelname)s - %(message)s'
+        )
+        self.logger = logging.getLogger(__name__)
+
+    # ---- 服务器进程选择和健康检查 ----
+
+    def pick(self, key, exclude=()):
+        """按一致性哈希选择可接受新会话的进程"""
+        url = self.ring.lookup(
+            key, lambda url: url not in exclude and self.workers[url].accepting
+        )
+        return self.workers[url] if url is not None else None
+
+    def report_failure(self, worker, error, session=False):
+        """连接失败：立即停止向该进程分配新会话，等健康检查恢复"""
+        with self._lock:
+            if session:
+                worker.failovers += 1
+                self.failovers += 1
+            if worker.healthy:
+                self.logger.warning(f"服务器 {worker.url} 不可用: {error}")
+            worker.healthy = False
+
+    def check(self, worker):
+        """向进程发送health请求并更新状态"""
+        try:
+            conn = transport.connect(worker.url, self.health_timeout)
+            try:
+                conn.settimeout(self.health_timeout)
+                CommunicationProtocol.send_data(conn, {'type': 'health'}, "json")
+                response, _ = CommunicationProtocol.receive_data(conn)
+            finally:
+                conn.close()
+            if not response or response.get('status') != 'success':
+                raise ConnectionError(f"健康检查响应异常: {response}")
+        except (OSError, ProtocolError) as e:
+            with self._lock:
+                worker.failures += 1
+                worker.checked_at = time.time()
+                if worker.healthy and worker.failures >= self.failure_threshold:
+                    worker.healthy = False
+                    self.logger.warning(f"服务器 {worker.url} 健康检查失败: {e}")
+            return False
+        with self._lock:
+            if not worker.healthy:
+                self.logger.info(f"服务器 {worker.url} 可用")
+            elif response.get('draining') and not worker.draining:
+                self.logger.info(f"服务器 {worker.url} 排空中，不再分配新会话")
+            worker.healthy = True
+            worker.draining = bool(response.get('draining'))
+            worker.failures = 0
+            worker.models = response.get('models', {})
+            worker.checked_at = time.time()
+        return True
+
+    def check_all(self):
+        threads = [threading.Thread(target=self.check, args=(worker,), daemon=True)
+                   for worker in self.workers.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _health_loop(self):
+        while not self._stop_event.wait(self.health_interval):
+            self.check_all()
+
+    # ---- 会话和上下文 ----
+
+    def attach(self, session, worker):
+        with self._lock:
+            worker.sessions += 1
+
+    def detach(self, session, worker):
+        with self._lock:
+            worker.sessions -= 1
+
+    def session_closed(self, session):
+        with self._sessions_changed:
+            self.sessions.discard(session)
+            self._sessions_changed.notify_all()
+
+    def intern_context(self, fingerprint, payload):
+        """同一公钥的会话共用一份public_key请求负载（转移时补发）"""
+        with self._lock:
+            entry = self._contexts.get(fingerprint)
+            if entry is None:
+                entry = self._contexts[fingerprint] = [payload, 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release_context(self, fingerprint):
+        with self._lock:
+            entry = self._contexts.get(fingerprint)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._contexts[fingerprint]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self.sessions),
+                'contexts': len(self._contexts),
+                'failovers': self.failovers,
+                'workers': {url: worker.describe() for url, worker in self.workers.items()},
+            }
+
+    # ---- 监听 ----
+
+    def start(self):
+        """启动路由器（阻塞直到调用stop）"""
+        self._stop_event.clear()
+        self.check_all()
+        health = threading.Thread(target=self._health_loop, name='health', daemon=True)
+        health.start()
+        listeners = []
+        selector = selectors.DefaultSelector()
+        try:
+            for url in self.listen_urls:
+                listener = transport.Listener(url, 128)
+                listeners.append(listener)
+                selector.register(listener, selectors.EVENT_READ)
+            self._accepting.set()
+            self.logger.info(
+                f"路由器启动在 {', '.join(self.listen_urls)}，"
+                f"服务器 {', '.join(self.workers)}"
+            )
+            while not self._stop_event.is_set():
+                # 周期性超时以便响应停止请求
+                for key, _ in selector.select(timeout=1.0):
+                    client, address = key.fileobj.accept()
+                    session = RouterSession(self, client, address)
+                    with self._sessions_changed:
+                        self.sessions.add(session)
+                    threading.Thread(
+                        target=session.run, name=f'session-{address}', daemon=True
+                    ).start()
+        except Exception as e:
+            self.logger.error(f"路由器错误: {e}")
+        finally:
+            self._accepting.clear()
+            self._stop_event.set()
+            selector.close()
+            for listener in listeners:
+                listener.close()
+            self.logger.info("路由器已停止监听")
+
+    def wait_ready(self, timeout=None):
+        return self._accepting.wait(timeout)
+
+    def stop(self):
+        """请求停止监听"""
+        self._stop_event.set()
+
+    def drain(self, timeout=None):
+        """停止监听后等待现有会话结束，超时后断开剩余会话"""
+        self.stop()
+        with self._sessions_changed:
+            done = self._sessions_changed.wait_for(lambda: not self.sessions, timeout)
+            remaining = list(self.sessions)
+        if not done:
+            self.logger.warning(f"排空超时，断开 {len(remaining)} 个会话")
+            for session in remaining:
+                session.abort()
+        return done
+
+
+def main(argv=None):
+    """路由器入口"""
+    parser = argparse.ArgumentParser(description="医学影像密态检测会话路由器")
+    parser.add_argument('--listen', action='append', required=True,
+                        help="监听地址（tcp://host:port、unix:///path 或 shm:///path），可重复")
+    parser.add_argument('--worker', action='append', required=True,
+                        help="服务器进程地址，可重复")
+    parser.add_argument('--health-interval', type=float, default=2.0)
+    parser.add_argument('--health-timeout', type=float, default=2.0)
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help="SIGTERM后等待现有会话结束的秒数")
+    parser.add_argument('--max-frame-mb', type=float, default=4)
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper(), logging.INFO),
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    router = MedicalAIRouter(
+        args.listen, args.worker,
+        health_interval=args.health_interval,
+        health_timeout=args.health_timeout,
+        frame_limits=FrameLimits(max_frame=int(args.max_frame_mb * (1 << 20)))
+    )
+    stopping = threading.Event()
+
+    def handle_signal(signum, frame):
+        # SIGTERM停止监听并排空现有会话；SIGINT或再次收到信号时立即断开
+        if signum == signal.SIGTERM and not stopping.is_set():
+            router.logger.info(f"收到信号 {signum}，排空现有会话后停止")
+            stopping.set()
+            router.stop()
+        else:
+            router.logger.info(f"收到信号 {signum}，正在停止路由器")
+            stopping.set()
+            router.stop()
+            for session in list(router.sessions):
+                session.abort()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    router.start()
+    router.drain(args.drain_timeout)
+    router.logger.info(f"路由器统计: {json.dumps(router.stats(), ensure_ascii=False)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
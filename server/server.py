@@ -1,30 +1,96 @@
 # server/server.py
+import select
+import selectors
 import socket
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tenseal as ts
 from .model import WideResNet101FeatureExtractor, PaDimModel
-from shared.communication import CommunicationProtocol
+from .registry import ModelRegistry, DEFAULT_MODEL
+from .he_cache import HEConstantCache, LRUCache
+from .decision import DecisionPolynomial
+from .metrics import ServerMetrics, RequestProfiler, MetricsHTTPServer
+from shared.communication import (
+    BudgetTimeout, CommunicationProtocol, FrameLimits, FrameTooLarge, ProtocolError, ReceiveBudget, MiB
+)
+from shared import transport
+from shared.preprocessing import Preprocessor
+from shared.dtypes import COMPUTE_DTYPE
 import logging
-from PIL import Image
-import torchvision.transforms as transforms 
+
+class TrainingCancelled(Exception):
+    """训练被取消"""
+
+
+class ClientSession:
+    """单个客户端连接的会话状态：TenSEAL上下文和固定的模型版本"""
+    
+    def __init__(self, registry, address):
+        self.registry = registry
+        self.address = address
+        self.context = None
+        self.fingerprint = None
+        self.model_version = None
+        self.constants = None
+        self.decision = None  # 密态判定模式的DecisionPolynomial，默认模式为None
+    
+    def pin(self, name=DEFAULT_MODEL):
+        """固定模型版本；已固定同名模型时保持不变，整个会话结果一致"""
+        if self.model_version is not None:
+            if self.model_version.name == name:
+                return self.model_version
+            self.registry.release(self.model_version)
+            self.model_version = None
+            self.constants = None
+            self.decision = None
+        self.model_version = self.registry.acquire(name)
+        return self.model_version
+    
+    def close(self):
+        """释放固定的模型版本"""
+        if self.model_version is not None:
+            self.registry.release(self.model_version)
+            self.model_version = None
+
 
 class MedicalAIServer:
-    def __init__(self, host='localhost', port=8888):
+    SLOT_POLL = 0.05  # 排队连接检查空闲工作线程的间隔（秒）
+    
+    def __init__(self, host='localhost', port=8888, max_workers=8, pretrained=True,
+                 context_cache_size=16, constant_cache_size=32, listen=None,
+                 frame_limits=None, receive_budget=512 * MiB, preprocess_workers=0,
+                 tensor_cache_dir=None, queue_timeout=10.0, connection_budget=None,
+                 budget_timeout=30.0):
         self.host = host
         self.port = port
-        self.feature_extractor = WideResNet101FeatureExtractor()
-        self.padim_model = PaDimModel()
-        self.normal_features = []
-        self.context = None
-        self.preprocess = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(
-                mean=[0.485, 0.456, 0.406],
-                std=[0.229, 0.224, 0.225]
-            )
-        ])
+        # 除TCP外额外监听的地址，例如 shm:///run/ppmad.sock（同机部署）
+        self.listen_urls = list(listen or [])
+        # 按消息类型限制帧大小；所有连接的接收缓冲区共享一个字节预算，单个连接最多占用connection_budget
+        self.frame_limits = frame_limits or FrameLimits()
+        self.receive_budget = ReceiveBudget(receive_budget, connection_budget, budget_timeout)
+        self.max_workers = max_workers
+        # 每个连接在整个生命周期内占用一个工作线程；没有空闲线程时最多排队queue_timeout秒
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self.pretrained = pretrained
+        self._feature_extractor = None
+        self._extractor_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        # 排空状态：健康检查中报告，路由器不再把新会话分配到本进程
+        self.draining = False
+        self._clients = set()
+        self._clients_changed = threading.Condition()
+        self.registry = ModelRegistry()
+        self.he_cache = HEConstantCache(context_cache_size, constant_cache_size)
+        # 密态判定的拟合多项式，按(模型名称, 版本, 次数)缓存
+        self.decisions = LRUCache(constant_cache_size)
+        self.metrics = ServerMetrics(self)
+        self.request_profiler = RequestProfiler()
+        self.metrics_endpoint = None
+        # 训练图像的解码进程池和缩放后图像缓存（可与客户端共用缓存目录）
+        self.preprocessor = Preprocessor(preprocess_workers, tensor_cache_dir)
         self.setup_logging()
         
     def setup_logging(self):
@@ -35,121 +101,488 @@ class MedicalAIServer:
         )
         self.logger = logging.getLogger(__name__)
     
-    def setup_tenseal_context(self, context_bytes):
-        """设置TenSEAL上下文"""
-        self.context = ts.context_from(context_bytes)
-        self.logger.info("TenSEAL上下文设置完成")
+    @property
+    def feature_extractor(self):
+        """特征提取器（仅训练时需要，首次使用时加载）"""
+        if self._feature_extractor is None:
+            with self._extractor_lock:
+                if self._feature_extractor is None:
+                    self._feature_extractor = WideResNet101FeatureExtractor(self.pretrained)
+        return self._feature_extractor
+    
+    @property
+    def padim_model(self):
+        """默认模型的当前版本（未加载时返回未训练的模型）"""
+        current = self.registry.current(DEFAULT_MODEL)
+        return current.model if current is not None else PaDimModel()
+    
+    def load_model(self, path, name=DEFAULT_MODEL):
+        """从模型包加载已训练的模型"""
+        self.swap_model(PaDimModel.load(path), name)
+        self.logger.info(f"已加载模型包 {path}")
+    
+    def save_model(self, path, name=DEFAULT_MODEL):
+        """保存当前模型为模型包"""
+        current = self.registry.current(name)
+        if current is None:
+            raise RuntimeError(f"模型不存在: {name}")
+        current.model.save(path)
+        self.logger.info(f"模型包已保存到 {path}")
+    
+    def setup_tenseal_context(self, session, context_bytes):
+        """设置会话的TenSEAL上下文（相同公钥复用已缓存的上下文）"""
+        session.fingerprint, session.context, hit = self.he_cache.load_context(context_bytes)
+        session.constants = None
+        self.logger.info(f"TenSEAL上下文设置完成{'（缓存命中）' if hit else ''}")
     
-    def train_normal_model(self, image_paths):
-        """训练正常样本模型"""
+    def build_model(self, image_paths, progress_callback=None, cancel_event=None):
+        """在后台构建新模型，不影响正在服务的模型
+        
+        progress_callback(info)在每张图像处理后调用，info包含stage、done、
+        total、images_per_sec和eta_s；cancel_event被设置时抛出TrainingCancelled。
+        """
         self.logger.info("开始训练正常样本模型...")
+        total = len(image_paths)
+        # 特征直接写入预分配的float32矩阵，训练时不再复制
+        features = None
+        count = 0
+        start = time.perf_counter()
+        
+        def report(stage, done):
+            if progress_callback is None:
+                return
+            elapsed = time.perf_counter() - start
+            rate = done / elapsed if elapsed > 0 else 0.0
+            progress_callback({
+                'stage': stage,
+                'done': done,
+                'total': total,
+                'images_per_sec': rate,
+                'eta_s': (total - done) / rate if rate > 0 else None
+            })
         
-        for path in image_paths:
+        # 解码在进程池中提前进行，与特征提取重叠
+        for i, (path, image_tensor) in enumerate(self.preprocessor.map(image_paths), 1):
+            if cancel_event is not None and cancel_event.is_set():
+                raise TrainingCancelled("训练已取消")
             try:
-                # 加载并预处理图像
-                image = Image.open(path).convert('RGB')
-                image_tensor = self.preprocess(image)
+                if isinstance(image_tensor, Exception):
+                    raise image_tensor
                 
                 # 使用特征提取器提取真实特征
-                features = self.feature_extractor.extract_features(image_tensor)
-                self.normal_features.append(features)
+                feature = self.feature_extractor.extract_features(image_tensor)
+                if features is None:
+                    features = np.empty((total, feature.size), dtype=COMPUTE_DTYPE)
+                features[count] = feature
+                count += 1
             except Exception as e:
                 self.logger.error(f"处理图像 {path} 时出错: {e}")
+            report('extract', i)
         
-        if self.normal_features:
-            self.padim_model.fit(self.normal_features)
-            self.logger.info(f"模型训练完成，共处理 {len(self.normal_features)} 个样本")
-        else:
+        if not count:
             self.logger.warning("没有有效的训练数据")
+            return None
+        
+        if cancel_event is not None and cancel_event.is_set():
+            raise TrainingCancelled("训练已取消")
+        report('fit', total)
+        model = PaDimModel()
+        model.fit(features[:count], copy=False)
+        self.logger.info(f"模型训练完成，共处理 {count} 个样本")
+        calibration = model.calibration
+        self.logger.info(
+            f"阈值校准（{calibration['source']}，{calibration['samples']} 个样本）: "
+            f"阈值 {calibration['threshold']:.4g}，{calibration['quantile']:.0%} 分位数"
+        )
+        return model
+    
+    def swap_model(self, model, name=DEFAULT_MODEL):
+        """发布新模型版本并原子切换，已建立的会话继续使用其固定的版本"""
+        model_version = self.registry.publish(model, name)
+        self.logger.info(f"模型 {name} 已切换到版本 {model_version.version}")
+        return model_version
+    
+    def train_normal_model(self, image_paths, progress_callback=None, cancel_event=None,
+                           name=DEFAULT_MODEL):
+        """训练正常样本模型并切换为当前模型"""
+        model = self.build_model(image_paths, progress_callback, cancel_event)
+        if model is not None:
+            self.swap_model(model, name)
+        return model
     
-    def process_encrypted_features(self, encrypted_features):
-        """处理加密的特征"""
-        if not self.context or not self.padim_model.is_fitted:
-            raise RuntimeError("服务器未就绪")
+    def get_decision(self, model_version, degree):
+        """获取（必要时拟合）模型版本在给定次数下的密态判定多项式"""
+        decision, _ = self.decisions.get_or_build(
+            model_version.key + (degree,),
+            lambda: DecisionPolynomial(
+                model_version.calibration, model_version.calibration_distances,
+                len(model_version.means), degree
+            )
+        )
+        return decision
+    
+    def process_encrypted_features(self, encrypted_features, session):
+        """处理加密的特征（使用会话固定的模型版本）"""
+        if session.context is None:
+            raise RuntimeError("服务器未就绪：未收到公钥")
+        model_version = session.model_version or session.pin()
+        decision = session.decision
+        if session.constants is None:
+            # 每个(上下文, 模型版本, 缩放系数)只编码一次模型常量
+            session.constants = self.he_cache.get_constants(
+                session.fingerprint, session.context, model_version,
+                decision.input_scale if decision is not None else 1.0
+            )
         
         # 反序列化加密特征
-        encrypted_vector = ts.ckks_vector_from(self.context, encrypted_features)
+        encrypted_vector = ts.ckks_vector_from(session.context, encrypted_features)
+        
+        if decision is not None:
+            # 密态判定模式：每张图像只返回一个密文
+            return decision.evaluate(encrypted_vector, session.constants.means).serialize()
         
         # 执行加密状态下的特征比对
         # 直接使用客户端降维后的特征计算距离（不再在服务器端进行PCA）
-        min_distance = None
-        for mean in self.padim_model.gmm.means_:
-            # 计算加密特征与均值的差
+        # 密文之间无法比较大小，返回每个分量的距离，由客户端解密后取最小值
+        distances = []
+        for mean in session.constants.means:
+            # 计算加密特征与均值的差（密文-密文，无需重新编码）
             diff = encrypted_vector - mean
             
             # 简化版马氏距离计算（加密状态下）
             distance = diff.dot(diff)  # 欧氏距离平方（作为马氏距离的近似）
-            
-            # 跟踪最小距离
-            if min_distance is None:
-                min_distance = distance
-            else:
-                min_distance = min(min_distance, distance)
+            distances.append(distance.serialize())
+        
+        return distances
+    
+    def handle_request(self, data, session):
+        """处理一条JSON请求并返回响应"""
+        request_type = data.get('type')
+        if request_type == 'public_key':
+            self.setup_tenseal_context(session, data['context'])
+            return {'status': 'success', 'message': '公钥接收成功'}
+        
+        if request_type == 'get_pca_params':
+            # 固定模型版本并发送对应的PCA参数给客户端
+            try:
+                model_version = session.pin(data.get('model') or DEFAULT_MODEL)
+            except KeyError:
+                return {'status': 'error', 'message': '模型未训练'}
+            response = {
+                'status': 'success',
+                'model_name': model_version.name,
+                'model_version': model_version.version,
+                'model_digest': model_version.digest,
+                'pca_components': model_version.pca_components.tolist(),
+                'pca_mean': model_version.pca_mean.tolist(),
+                'calibration': model_version.calibration
+            }
+            # 客户端可请求密态判定模式；不支持时回退到默认模式并说明原因
+            session.decision = None
+            session.constants = None
+            if data.get('decision_degree'):
+                try:
+                    session.decision = self.get_decision(model_version, int(data['decision_degree']))
+                    response['decision'] = session.decision.describe()
+                except ValueError as e:
+                    self.logger.warning(f"无法启用密态判定: {e}")
+                    response['decision_error'] = str(e)
+            return response
+        
+        if request_type == 'list_models':
+            return {'status': 'success', 'models': self.registry.describe()}
+        
+        if request_type == 'health':
+            return {
+                'status': 'success',
+                'draining': self.draining,
+                'active_sessions': len(self._clients),
+                'models': self.registry.describe()
+            }
+        
+        if request_type == 'encrypted_features':
+            try:
+                with self.metrics.time('he_eval', request_type):
+                    encrypted_result = self.process_encrypted_features(data['features'], session)
+                response = {
+                    'status': 'success', 
+                    'encrypted_result': encrypted_result
+                }
+            except Exception as e:
+                # 单个请求失败不影响同一连接上的后续（流水线）请求
+                self.logger.error(f"处理加密特征时出错: {e}")
+                self.metrics.errors.inc(kind='he_eval')
+                response = {'status': 'error', 'message': str(e)}
+            if 'request_id' in data:
+                response['request_id'] = data['request_id']
+            return response
         
-        return min_distance.serialize()
+        return {'status': 'error', 'message': f'未知的请求类型: {request_type}'}
     
-    def handle_client(self, client_socket, address):
-        """处理客户端连接"""
+    def handle_client(self, client_socket, address, first=None):
+        """处理客户端连接；first为排队期间已读取的第一条消息(负载, 类型, 消息类型, timings)"""
+        self.metrics.queue_depth.dec()
+        self.metrics.active_sessions.inc()
+        with self._clients_changed:
+            self._clients.add(client_socket)
         self.logger.info(f"处理来自 {address} 的连接")
+        session = ClientSession(self.registry, address)
+        metrics = self.metrics
         
         try:
             while True:
-                # 接收数据
-                data, data_type = CommunicationProtocol.receive_data(client_socket)
-                if data is None:
+                if first is not None:
+                    payload, data_type, message_type, timings = first
+                    first = None
+                else:
+                    # 接收数据（从收到帧头开始计时，不含空闲等待）
+                    timings = {}
+                    try:
+                        payload, data_type, message_type = CommunicationProtocol.receive_message(
+                            client_socket, timings, self.frame_limits, self.receive_budget
+                        )
+                    except FrameTooLarge as e:
+                        # 拒绝超限的帧并断开连接，不再读取其余数据
+                        self.logger.warning(f"客户端 {address} 的帧超过限制: {e}")
+                        metrics.errors.inc(kind='frame_limit')
+                        CommunicationProtocol.send_data(
+                            client_socket, {'status': 'error', 'message': str(e)}, "json"
+                        )
+                        break
+                    except BudgetTimeout as e:
+                        # 接收预算长时间被占满：回复繁忙并断开（流已读到一半，连接无法继续使用）
+                        self.logger.warning(f"客户端 {address} 等待接收预算超时: {e}")
+                        metrics.errors.inc(kind='busy')
+                        CommunicationProtocol.send_data(
+                            client_socket, {'status': 'error', 'message': '服务器繁忙，请稍后重试'}, "json"
+                        )
+                        break
+                if payload is None:
+                    break
+                size = len(payload)
+                try:
+                    keep = self._serve_request(
+                        client_socket, session, payload, data_type, message_type, timings
+                    )
+                finally:
+                    del payload
+                    self.receive_budget.release(size)
+                if not keep:
                     break
-                
-                if data_type == "json":
-                    if data.get('type') == 'public_key':
-                        self.setup_tenseal_context(data['context'])
-                        response = {'status': 'success', 'message': '公钥接收成功'}
-                        CommunicationProtocol.send_data(client_socket, response, "json")
-                    
-                    elif data.get('type') == 'get_pca_params':
-                        # 发送PCA参数给客户端
-                        if self.padim_model.is_fitted:
-                            response = {
-                                'status': 'success',
-                                'pca_components': self.padim_model.pca.components_.tolist(),
-                                'pca_mean': self.padim_model.pca.mean_.tolist()
-                            }
-                        else:
-                            response = {'status': 'error', 'message': '模型未训练'}
-                        CommunicationProtocol.send_data(client_socket, response, "json")
-                    
-                    elif data.get('type') == 'encrypted_features':
-                        encrypted_result = self.process_encrypted_features(data['features'])
-                        response = {
-                            'status': 'success', 
-                            'encrypted_result': encrypted_result
-                        }
-                        CommunicationProtocol.send_data(client_socket, response, "json")
                         
         except Exception as e:
             self.logger.error(f"处理客户端 {address} 时出错: {e}")
+            metrics.errors.inc(kind='connection')
         finally:
+            session.close()
             client_socket.close()
+            metrics.active_sessions.dec()
+            with self._clients_changed:
+                self._clients.discard(client_socket)
+                self._clients_changed.notify_all()
+            self._slots.release()
+    
+    def _serve_request(self, client_socket, session, payload, data_type, message_type, timings):
+        """解码一条请求，处理并发送响应；消息与声明不符、连接应断开时返回False"""
+        metrics = self.metrics
+        received_at = time.perf_counter()
+        size = len(payload)
+        metrics.bytes_in.inc(size + CommunicationProtocol.HEADER_SIZE)
+        if data_type != "json":
+            return True
+        
+        data = CommunicationProtocol.decode_payload(payload, data_type)
+        if isinstance(payload, bytearray):
+            payload.clear()  # 附件已复制出来，尽早释放接收缓冲区
+        decoded_at = time.perf_counter()
+        request_type = data.get('type', '-') if isinstance(data, dict) else '-'
+        if not self.frame_limits.matches(message_type, request_type, size):
+            self.logger.warning(
+                f"客户端 {session.address} 的消息类型 {request_type} 与声明的 "
+                f"{message_type or '-'} 不符或超过该类型的限制（{size} 字节）"
+            )
+            metrics.errors.inc(kind='type_mismatch')
+            CommunicationProtocol.send_data(
+                client_socket, {'status': 'error', 'message': f"消息类型与声明不符: {request_type}"}, "json"
+            )
+            return False
+        metrics.stage_seconds.observe(
+            received_at - timings['header_at'], stage='receive', type=request_type
+        )
+        metrics.stage_seconds.observe(
+            decoded_at - received_at, stage='deserialize', type=request_type
+        )
+        
+        response = self.request_profiler.call(self.handle_request, data, session)
+        # 回传服务器端耗时（从收到帧头到计算完成），供客户端追踪
+        response['server_time_ms'] = round(
+            (time.perf_counter() - timings['header_at']) * 1000, 3
+        )
+        
+        with metrics.time('serialize', request_type):
+            payload = CommunicationProtocol.encode_payload(response, "json")
+        with metrics.time('send', request_type):
+            sent = CommunicationProtocol.send_message(client_socket, payload, "json", request_type)
+        metrics.bytes_out.inc(sent)
+        metrics.requests.inc(type=request_type, status=response.get('status', '-'))
+        return True
+    
+    def start_metrics_endpoint(self, port=9108, profile_dir=None):
+        """在本机启动Prometheus指标和诊断端点"""
+        self.metrics_endpoint = MetricsHTTPServer(
+            self.metrics, self.request_profiler, '127.0.0.1', port, profile_dir
+        )
+        self.metrics_endpoint.start()
+        return self.metrics_endpoint
     
     def start_server(self):
-        """启动服务器"""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        """启动服务器（阻塞直到调用stop_server）"""
+        self._stop_event.clear()
+        listeners = []
+        selector = selectors.DefaultSelector()
+        executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix='client'
+        )
         
         try:
-            server_socket.bind((self.host, self.port))
-            server_socket.listen(5)
-            self.logger.info(f"服务器启动在 {self.host}:{self.port}")
+            urls = [f"tcp://{self.host}:{self.port}"] + self.listen_urls
+            for url in urls:
+                listener = transport.Listener(url, max(5, self.max_workers))
+                listeners.append(listener)
+                selector.register(listener, selectors.EVENT_READ)
+            self.logger.info(
+                f"服务器启动在 {', '.join(urls)}，工作线程数 {self.max_workers}"
+            )
             
-            while True:
-                client_socket, address = server_socket.accept()
-                client_thread = threading.Thread(
-                    target=self.handle_client, 
-                    args=(client_socket, address)
-                )
-                client_thread.daemon = True
-                client_thread.start()
+            while not self._stop_event.is_set():
+                # 周期性超时以便响应停止请求
+                for key, _ in selector.select(timeout=1.0):
+                    client_socket, address = key.fileobj.accept()
+                    self.metrics.queue_depth.inc()
+                    if self._slots.acquire(blocking=False):
+                        self._dispatch(executor, client_socket, address)
+                    else:
+                        threading.Thread(
+                            target=self._wait_for_slot, args=(executor, client_socket, address),
+                            daemon=True
+                        ).start()
                 
         except Exception as e:
             self.logger.error(f"服务器错误: {e}")
         finally:
-            server_socket.close()
+            selector.close()
+            for listener in listeners:
+                listener.close()
+            executor.shutdown(wait=False)
+            if self.metrics_endpoint is not None:
+                self.metrics_endpoint.stop()
+                self.metrics_endpoint = None
+            self.logger.info("服务器已停止监听")
+    
+    def _wait_for_slot(self, executor, client_socket, address):
+        """工作线程已满：等待空位，超时后回复服务器繁忙并断开
+
+        排队期间读取连接的第一条消息：health请求（路由器的健康检查）直接回复，不占用工作线程，
+        忙碌但仍存活的进程不会被判为不可用；其他消息留给工作线程处理。
+        """
+        deadline = time.monotonic() + self.queue_timeout
+        first = None
+        # 服务器停止后不再等待空位
+        while not self._stop_event.is_set():
+            if self._slots.acquire(blocking=False):
+                self._dispatch(executor, client_socket, address, first)
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if first is not None:
+                if self._slots.acquire(timeout=remaining):
+                    self._dispatch(executor, client_socket, address, first)
+                    return
+                break
+            if not select.select([client_socket], [], [], min(remaining, self.SLOT_POLL))[0]:
+                continue
+            timings = {}
+            try:
+                payload, data_type, message_type = CommunicationProtocol.receive_message(
+                    client_socket, timings, self.frame_limits, self.receive_budget
+                )
+            except (OSError, ProtocolError) as e:
+                self.logger.warning(f"排队中的客户端 {address} 连接出错: {e}")
+                payload = None
+            if payload is None:
+                self.metrics.queue_depth.dec()
+                client_socket.close()
+                return
+            if message_type == 'health' and self._reply_health(client_socket, payload, data_type):
+                continue
+            first = (payload, data_type, message_type, timings)
+
+        if self._stop_event.is_set():
+            self.logger.info(f"服务器已停止，拒绝排队中的连接 {address}")
+        else:
+            self.logger.warning(f"服务器繁忙，拒绝来自 {address} 的连接（等待 {self.queue_timeout} 秒）")
+        self.metrics.queue_depth.dec()
+        self.metrics.errors.inc(kind='busy')
+        if first is not None:
+            self.receive_budget.release(len(first[0]))
+        try:
+            CommunicationProtocol.send_data(
+                client_socket, {'status': 'error', 'message': '服务器繁忙，请稍后重试'}, "json"
+            )
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+    
+    def _dispatch(self, executor, client_socket, address, first=None):
+        """把已占到名额的连接交给线程池；线程池已关闭（服务器已停止）时释放名额并关闭连接"""
+        try:
+            executor.submit(self.handle_client, client_socket, address, first)
+        except RuntimeError:
+            self.logger.info(f"服务器已停止，关闭来自 {address} 的连接")
+            self._slots.release()
+            self.metrics.queue_depth.dec()
+            if first is not None:
+                self.receive_budget.release(len(first[0]))
+            client_socket.close()
+    
+    def _reply_health(self, client_socket, payload, data_type):
+        """在排队线程中回复health请求，内容不是health时返回False（交给工作线程检查）"""
+        data = CommunicationProtocol.decode_payload(payload, data_type) if data_type == "json" else None
+        if not isinstance(data, dict) or data.get('type') != 'health':
+            return False
+        self.receive_budget.release(len(payload))
+        try:
+            CommunicationProtocol.send_data(client_socket, self.handle_request(data, None), "json")
+        except OSError:
+            pass
+        self.metrics.requests.inc(type='health', status='success')
+        return True
+    
+    def drain(self, timeout=None):
+        """进入排空状态并等待现有会话结束，返回是否在超时前全部结束
+        
+        排空期间仍接受连接（直连的客户端不受影响），路由器根据健康检查不再分配新会话。
+        """
+        self.draining = True
+        self.logger.info(f"开始排空，当前会话数 {len(self._clients)}")
+        with self._clients_changed:
+            done = self._clients_changed.wait_for(lambda: not self._clients, timeout)
+        if not done:
+            self.logger.warning(f"排空超时，仍有 {len(self._clients)} 个会话")
+        return done
+    
+    def close_sessions(self):
+        """关闭仍在进行的会话连接（停止后调用，处理线程读到连接关闭后退出）"""
+        with self._clients_changed:
+            clients = list(self._clients)
+        for client_socket in clients:
+            try:
+                getattr(client_socket, 'sock', client_socket).shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    
+    def stop_server(self):
+        """请求停止服务器"""
+        self._stop_event.set()
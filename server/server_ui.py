@@ -2,10 +2,11 @@
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
                            QWidget, QTextEdit, QPushButton, QLabel, QProgressBar,
                            QFileDialog, QListWidget, QSplitter, QFrame)
-from PyQt6.QtCore import QThread, pyqtSignal, Qt, QDateTime
+from PyQt6.QtCore import QThread, pyqtSignal, Qt, QDateTime, QTimer
 from PyQt6.QtGui import QFont
 import sys
 import os
+import threading
 
 # 添加路径以便导入本地模块
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
@@ -26,11 +27,52 @@ class ServerThread(QThread):
         except Exception as e:
             self.log_signal.emit(f"服务器错误: {str(e)}")
 
+class TrainingThread(QThread):
+    """后台训练线程：构建新模型后原子切换，训练期间服务器继续处理请求"""
+    log_signal = pyqtSignal(str)
+    progress_signal = pyqtSignal(dict)
+    finished_signal = pyqtSignal(bool)
+    
+    def __init__(self, server, file_paths):
+        super().__init__()
+        self.server = server
+        self.file_paths = file_paths
+        self.cancel_event = threading.Event()
+    
+    def cancel(self):
+        """请求取消训练（在下一张图像前生效）"""
+        self.cancel_event.set()
+    
+    def run(self):
+        from server.server import TrainingCancelled
+        
+        self.log_signal.emit(f"开始训练，共 {len(self.file_paths)} 个文件")
+        try:
+            model = self.server.build_model(
+                self.file_paths,
+                progress_callback=self.progress_signal.emit,
+                cancel_event=self.cancel_event
+            )
+            if model is None:
+                self.log_signal.emit("没有有效的训练数据，保留原模型")
+                self.finished_signal.emit(False)
+                return
+            self.server.swap_model(model)
+            self.log_signal.emit("模型训练完成，已切换为新模型")
+            self.finished_signal.emit(True)
+        except TrainingCancelled:
+            self.log_signal.emit("训练已取消，保留原模型")
+            self.finished_signal.emit(False)
+        except Exception as e:
+            self.log_signal.emit(f"训练出错: {str(e)}")
+            self.finished_signal.emit(False)
+
 class ServerUI(QMainWindow):
     def __init__(self):
         super().__init__()
         self.server = None
         self.server_thread = None
+        self.training_thread = None
         self.init_ui()
         
     def init_ui(self):
@@ -81,6 +123,11 @@ class ServerUI(QMainWindow):
         self.train_btn.setEnabled(False)
         left_layout.addWidget(self.train_btn)
         
+        self.cancel_train_btn = QPushButton("取消训练")
+        self.cancel_train_btn.clicked.connect(self.cancel_training)
+        self.cancel_train_btn.setEnabled(False)
+        left_layout.addWidget(self.cancel_train_btn)
+        
         # 状态显示
         left_layout.addWidget(QLabel("服务器状态:"))
         self.status_label = QLabel("未启动")
@@ -89,6 +136,19 @@ class ServerUI(QMainWindow):
         self.progress_bar = QProgressBar()
         left_layout.addWidget(self.progress_bar)
         
+        self.train_status_label = QLabel("")
+        left_layout.addWidget(self.train_status_label)
+        
+        # 运行指标
+        left_layout.addWidget(QLabel("运行指标:"))
+        self.metrics_label = QLabel("-")
+        self.metrics_label.setFont(QFont("Monospace", 9))
+        left_layout.addWidget(self.metrics_label)
+        
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.update_metrics)
+        self.metrics_timer.start(1000)
+        
         left_layout.addStretch()
         
         # 右侧日志面板
@@ -153,17 +213,72 @@ class ServerUI(QMainWindow):
             self.log_message(f"已选择 {len(files)} 个训练文件")
             
     def train_model(self):
-        """训练模型"""
+        """在后台线程中训练模型"""
+        if self.training_thread and self.training_thread.isRunning():
+            return
         if self.server and self.train_list.count() > 0:
             file_paths = [self.train_list.item(i).text() 
                          for i in range(self.train_list.count())]
-            self.server.train_normal_model(file_paths)
-            self.log_message("模型训练完成")
+            self.training_thread = TrainingThread(self.server, file_paths)
+            self.training_thread.log_signal.connect(self.log_message)
+            self.training_thread.progress_signal.connect(self.update_training_progress)
+            self.training_thread.finished_signal.connect(self.training_finished)
+            self.progress_bar.setValue(0)
+            self.train_btn.setEnabled(False)
+            self.cancel_train_btn.setEnabled(True)
+            self.training_thread.start()
+        elif not self.server:
+            self.log_message("请先启动服务器")
+    
+    def cancel_training(self):
+        """取消正在进行的训练"""
+        if self.training_thread and self.training_thread.isRunning():
+            self.training_thread.cancel()
+            self.cancel_train_btn.setEnabled(False)
+            self.log_message("正在取消训练...")
+    
+    def update_training_progress(self, info):
+        """更新训练进度"""
+        total = max(info['total'], 1)
+        self.progress_bar.setValue(int(info['done'] * 100 / total))
+        if info['stage'] == 'fit':
+            self.train_status_label.setText("正在拟合模型...")
+            return
+        eta = f"{info['eta_s']:.0f}s" if info['eta_s'] is not None else "-"
+        self.train_status_label.setText(
+            f"特征提取 {info['done']}/{info['total']}，"
+            f"{info['images_per_sec']:.1f} 张/秒，剩余 {eta}"
+        )
+    
+    def training_finished(self, success):
+        """训练结束"""
+        self.train_btn.setEnabled(True)
+        self.cancel_train_btn.setEnabled(False)
+        self.train_status_label.setText("训练完成" if success else "训练未完成")
+        if success:
+            self.progress_bar.setValue(100)
             
     def log_message(self, message):
         """记录日志消息"""
         self.log_text.append(f"[{QDateTime.currentDateTime().toString()}] {message}")
         
+    def update_metrics(self):
+        """刷新运行指标"""
+        if not self.server:
+            return
+        snapshot = self.server.metrics.snapshot()
+        cache = self.server.he_cache.stats()['contexts']
+        lines = [
+            f"活动会话 {snapshot['active_sessions']}  排队 {snapshot['queue_depth']}",
+            f"请求 {snapshot['requests']}  错误 {snapshot['errors']}",
+            f"接收 {snapshot['bytes_in'] / 1e6:.1f} MB  发送 {snapshot['bytes_out'] / 1e6:.1f} MB",
+            f"上下文缓存 命中 {cache['hits']} / 未命中 {cache['misses']}",
+        ]
+        for stage in self.server.metrics.STAGES:
+            if stage in snapshot['stage_mean_ms']:
+                lines.append(f"{stage:<12}{snapshot['stage_mean_ms'][stage]:>10.1f} ms")
+        self.metrics_label.setText("\n".join(lines))
+    
     def update_status(self, status):
         """更新状态"""
         self.status_label.setText(status)
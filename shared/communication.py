@@ -1,45 +1,406 @@
 # shared/communication.py
+import base64
 import json
 import socket
 import struct
+import threading
+import time
 from typing import Any, Dict
 
+MiB = 1 << 20
+
+# 分块流中各消息类型允许的最大总大小
+DEFAULT_MESSAGE_LIMITS = {
+    'public_key': 256 * MiB,          # 上下文约35MB（附件原样发送），给更大的参数留余量
+    'encrypted_features': 32 * MiB,
+    'get_pca_params': 64 * 1024,
+    'list_models': 64 * 1024,
+    'health': 64 * 1024,
+}
+
+
+class ProtocolError(ConnectionError):
+    """对端发送了不符合协议的帧，连接无法继续使用"""
+
+
+class FrameTooLarge(ProtocolError):
+    """帧或消息超过接收端的大小限制"""
+
+
+class FrameLimits:
+    """接收端的帧大小限制
+
+    普通帧只看帧头长度，使用max_frame；分块流在开始帧中声明消息类型，
+    按per_type限制总大小，未列出的类型使用max_message。
+    """
+
+    def __init__(self, max_frame=4 * MiB, max_message=16 * MiB, per_type=None):
+        self.max_frame = max_frame
+        self.max_message = max_message
+        self.per_type = dict(DEFAULT_MESSAGE_LIMITS if per_type is None else per_type)
+
+    def for_message(self, message_type):
+        return self.per_type.get(message_type, self.max_message)
+
+    def matches(self, declared, message_type, size):
+        """解码后的消息类型与分块流声明的一致，且大小不超过该类型的限制
+
+        大小限制按声明的类型检查，内容必须与声明一致，否则可以借宽松的类型绕过限制。
+        """
+        return (not declared or message_type == declared) and size <= self.for_message(message_type)
+
+
+class BudgetTimeout(ProtocolError):
+    """等待接收预算超时（服务器繁忙），连接无法继续读取"""
+
+
+class ReceiveBudget:
+    """接收缓冲区的全局字节预算（流控窗口）
+
+    接收方读取每一帧前按帧头中的长度申请预算，处理完请求后归还；预算用尽时暂停读取，
+    由TCP窗口把压力传回发送方，服务器内存不会随快速客户端无限增长。
+    单个连接最多占用per_connection字节（默认为总预算的一半），超过时抛出FrameTooLarge，
+    慢速或停滞的连接不能独占预算；等待超过timeout秒时抛出BudgetTimeout。
+    单个请求超过总预算时，只有在没有其他占用时才放行，避免死锁。
+    """
+
+    def __init__(self, capacity, per_connection=None, timeout=30.0):
+        self.capacity = capacity
+        self.per_connection = per_connection if per_connection is not None else capacity // 2
+        self.timeout = timeout
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, amount):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while self.in_use and self.in_use + amount > self.capacity:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise BudgetTimeout(f"等待 {amount} 字节接收预算超时（已占用 {self.in_use}）")
+                self._cond.wait(remaining)
+            self.in_use += amount
+
+    def release(self, amount):
+        with self._cond:
+            self.in_use -= amount
+            self._cond.notify_all()
+
+
+class _MessageBudget:
+    """一条消息在全局预算中的占用：检查单连接上限，出错时归还已申请的部分"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.held = 0
+
+    def acquire(self, amount):
+        if self.held + amount > self.budget.per_connection:
+            raise FrameTooLarge(
+                f"连接占用的接收缓冲区 {self.held + amount} 超过单连接上限 {self.budget.per_connection}"
+            )
+        self.budget.acquire(amount)
+        self.held += amount
+
+    def release(self, amount):
+        self.budget.release(amount)
+        self.held -= amount
+
+
 class CommunicationProtocol:
-    """客户端和服务器之间的通信协议"""
-    
+    """客户端和服务器之间的通信协议
+
+    每帧为8字节头部（长度 + 4字节类型）加负载。JSON消息以分块流发送：
+    开始帧（总长度、数据类型、消息类型）之后是若干数据块帧和结束帧，
+    接收方在分配内存前即可按消息类型检查大小，负载也不再受4GB帧长限制。
+    """
+
     HEADER_SIZE = 8
     ENCODING = 'utf-8'
-    
+    RECV_CHUNK = 1 << 20
+    STREAM_CHUNK = 1 << 20
+    BYTES_KEY = '__bytes__'
+    BLOB_KEY = '__blob__'
+    BLOB_MAGIC = b'\x00PPB'  # 带附件的JSON负载（普通JSON不会以\x00开头）
+
+    # 分块流的控制帧
+    STREAM_START = 'STRM'
+    STREAM_CHUNK_TYPE = 'CHNK'
+    STREAM_END = 'CEND'
+    STREAM_HEADER = '!Q4s32s'  # 总长度、数据类型、消息类型
+
     @staticmethod
-    def send_data(sock: socket.socket, data: bytes, data_type: str = "binary"):
-        """发送数据"""
-        if data_type == "json":
-            data = json.dumps(data).encode(CommunicationProtocol.ENCODING)
-        
-        # 发送数据长度和类型
-        header = struct.pack('!I4s', len(data), data_type.encode('ascii')[:4])
-        sock.sendall(header + data)
-    
+    def _json_default(obj):
+        """JSON编码时把bytes（上下文、密文）转换为base64（旧格式，仅用于兼容）"""
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            return {CommunicationProtocol.BYTES_KEY: base64.b64encode(obj).decode('ascii')}
+        raise TypeError(f"无法序列化类型 {type(obj).__name__}")
+
     @staticmethod
-    def receive_data(sock: socket.socket) -> tuple:
-        """接收数据"""
-        # 接收头部信息
-        header = sock.recv(CommunicationProtocol.HEADER_SIZE)
-        if not header:
+    def _json_object_hook(obj):
+        """JSON解码时还原旧格式的base64 bytes字段"""
+        if len(obj) == 1 and CommunicationProtocol.BYTES_KEY in obj:
+            return base64.b64decode(obj[CommunicationProtocol.BYTES_KEY])
+        return obj
+
+    @staticmethod
+    def encode_payload(data, data_type: str = "binary") -> bytes:
+        """把消息编码为帧负载
+
+        JSON消息中的bytes字段（上下文、密文）不再转为base64，而是作为附件原样放在JSON头之后：
+        MAGIC + JSON头长度 + JSON头 + 附件，JSON头中以 {"__blob__": [偏移, 长度]} 引用。
+        编码只复制一次附件；不含bytes字段的消息仍是普通JSON。
+        """
+        if data_type != "json":
+            return data
+        blobs = []
+        offset = 0
+
+        def default(obj):
+            nonlocal offset
+            if isinstance(obj, (bytes, bytearray, memoryview)):
+                view = memoryview(obj).cast('B')
+                blobs.append(view)
+                ref = {CommunicationProtocol.BLOB_KEY: [offset, len(view)]}
+                offset += len(view)
+                return ref
+            raise TypeError(f"无法序列化类型 {type(obj).__name__}")
+
+        header = json.dumps(data, default=default).encode(CommunicationProtocol.ENCODING)
+        if not blobs:
+            return header
+        prefix = CommunicationProtocol.BLOB_MAGIC + struct.pack('!I', len(header))
+        payload = bytearray(len(prefix) + len(header) + offset)
+        payload[:len(prefix)] = prefix
+        position = len(prefix) + len(header)
+        payload[len(prefix):position] = header
+        for view in blobs:
+            payload[position:position + len(view)] = view
+            position += len(view)
+        return payload
+
+    @staticmethod
+    def decode_payload(data: bytes, data_type: str):
+        """解码帧负载
+
+        附件直接从负载切片复制为bytes，解码期间只多占用一份附件大小的内存；
+        调用方解码后即可释放负载。
+        """
+        if data_type != "json":
+            return data
+        magic = CommunicationProtocol.BLOB_MAGIC
+        if data[:len(magic)] != magic:
+            return json.loads(data, object_hook=CommunicationProtocol._json_object_hook)
+
+        with memoryview(data) as view:
+            start = len(magic) + 4
+            if len(view) < start:
+                raise ProtocolError("消息头不完整")
+            (header_len,) = struct.unpack_from('!I', view, len(magic))
+            base = start + header_len
+            if base > len(view):
+                raise ProtocolError(f"消息头长度 {header_len} 超出负载")
+            end = len(view)
+
+            def hook(obj):
+                if len(obj) == 1 and CommunicationProtocol.BLOB_KEY in obj:
+                    ref = obj[CommunicationProtocol.BLOB_KEY]
+                    if (not isinstance(ref, list) or len(ref) != 2
+                            or not all(isinstance(n, int) and n >= 0 for n in ref)
+                            or base + ref[0] + ref[1] > end):
+                        raise ProtocolError(f"附件引用无效: {ref}")
+                    return bytes(view[base + ref[0]:base + ref[0] + ref[1]])
+                return CommunicationProtocol._json_object_hook(obj)
+
+            return json.loads(bytes(view[start:base]), object_hook=hook)
+
+    # ---- 单帧 ----
+
+    @staticmethod
+    def send_frame(sock: socket.socket, payload: bytes, data_type: str) -> int:
+        """发送一帧，返回发送的字节数"""
+        if hasattr(sock, 'write_frame'):
+            # 自定义传输（如共享内存连接）自行处理帧
+            return sock.write_frame(payload, data_type)
+        # 发送数据长度和类型（头部和负载分开发送，避免拼接复制整个负载）
+        header = struct.pack('!I4s', len(payload), data_type.encode('ascii')[:4])
+        sock.sendall(header)
+        if len(payload):
+            sock.sendall(payload)
+        return len(header) + len(payload)
+
+    @staticmethod
+    def _recv_into(sock, view) -> int:
+        """填满view，返回实际读到的字节数（对端关闭时小于len(view)）"""
+        received = 0
+        while received < len(view):
+            n = sock.recv_into(view[received:], min(CommunicationProtocol.RECV_CHUNK, len(view) - received))
+            if not n:
+                break
+            received += n
+        return received
+
+    @staticmethod
+    def read_frame(sock: socket.socket, timings: dict = None, max_size: int = None, into=None,
+                   budget=None):
+        """读取一帧，返回(负载, 类型)；连接在帧边界关闭时返回(None, None)
+
+        max_size限制帧长，超过时在分配内存前抛出FrameTooLarge。
+        给出into（memoryview）时把负载直接读入其中，返回值的负载为读到的长度。
+        给出budget时按帧头中的长度申请预算后再读取负载，读取失败时归还。
+        """
+        if hasattr(sock, 'read_frame'):
+            return sock.read_frame(timings, max_size, into, budget)
+
+        # 接收头部信息（可能分多次到达）
+        header = bytearray(CommunicationProtocol.HEADER_SIZE)
+        received = CommunicationProtocol._recv_into(sock, memoryview(header))
+        if received == 0:
             return None, None
-            
+        if received < len(header):
+            raise ProtocolError("连接在帧头中途断开")
+        if timings is not None:
+            timings['header_at'] = time.perf_counter()
+
         data_len, data_type = struct.unpack('!I4s', header)
         data_type = data_type.decode('ascii').rstrip('\x00')
-        
-        # 接收数据
-        received_data = b''
-        while len(received_data) < data_len:
-            chunk = sock.recv(min(4096, data_len - len(received_data)))
-            if not chunk:
-                break
-            received_data += chunk
-        
+        if max_size is not None and data_len > max_size:
+            raise FrameTooLarge(f"帧长度 {data_len} 超过限制 {max_size}")
+
+        if budget is None:
+            return CommunicationProtocol._read_payload(sock, data_len, into), data_type
+        budget.acquire(data_len)
+        try:
+            return CommunicationProtocol._read_payload(sock, data_len, into), data_type
+        except BaseException:
+            budget.release(data_len)
+            raise
+
+    @staticmethod
+    def _read_payload(sock, data_len, into=None):
+        """读取帧头之后的负载；给出into时读入其中并返回长度"""
+        if into is not None:
+            if data_len > len(into):
+                raise FrameTooLarge(f"数据块长度 {data_len} 超过剩余空间 {len(into)}")
+            if CommunicationProtocol._recv_into(sock, into[:data_len]) < data_len:
+                raise ProtocolError("连接在帧中途断开")
+            return data_len
+
+        # 接收数据（预分配缓冲区，直接返回，不再复制）
+        payload = bytearray(data_len)
+        if CommunicationProtocol._recv_into(sock, memoryview(payload)) < data_len:
+            raise ProtocolError("连接在帧中途断开")
+        return payload
+
+    # ---- 分块流 ----
+
+    @staticmethod
+    def send_stream(sock: socket.socket, chunks, data_type: str, message_type: str = '',
+                    total: int = 0) -> int:
+        """以分块流发送消息，chunks为字节块的可迭代对象（可以是生成器）
+
+        total为负载总长度，未知时为0（接收方逐块检查大小）。返回发送的字节数。
+        """
+        send = CommunicationProtocol.send_frame
+        start = struct.pack(
+            CommunicationProtocol.STREAM_HEADER, total, data_type.encode('ascii')[:4],
+            message_type.encode(CommunicationProtocol.ENCODING)[:32]
+        )
+        sent = send(sock, start, CommunicationProtocol.STREAM_START)
+        for chunk in chunks:
+            if len(chunk):
+                sent += send(sock, chunk, CommunicationProtocol.STREAM_CHUNK_TYPE)
+        sent += send(sock, b'', CommunicationProtocol.STREAM_END)
+        return sent
+
+    @staticmethod
+    def send_message(sock: socket.socket, payload: bytes, data_type: str,
+                     message_type: str = '') -> int:
+        """把已编码的负载切成数据块，以分块流发送（切片不复制负载）"""
+        view = memoryview(payload)
+        size = CommunicationProtocol.STREAM_CHUNK
+        chunks = (view[i:i + size] for i in range(0, len(view), size))
+        return CommunicationProtocol.send_stream(sock, chunks, data_type, message_type, len(view))
+
+    @staticmethod
+    def receive_frame(sock: socket.socket, timings: dict = None, limits: FrameLimits = None,
+                      budget: ReceiveBudget = None) -> tuple:
+        """接收一条消息（普通帧或分块流），返回(负载, 类型)；连接关闭时返回(None, None)
+
+        给出timings时记录收到帧头的时刻（header_at），便于把等待时间和传输时间分开。
+        给出limits时检查帧和消息大小；给出budget时读取前申请预算，
+        调用方处理完后应归还len(负载)字节。
+        """
+        payload, data_type, _ = CommunicationProtocol.receive_message(sock, timings, limits, budget)
+        return payload, data_type
+
+    @staticmethod
+    def receive_message(sock: socket.socket, timings: dict = None, limits: FrameLimits = None,
+                        budget: ReceiveBudget = None) -> tuple:
+        """同receive_frame，另外返回分块流声明的消息类型（普通帧为空字符串）
+
+        转发消息时（会话路由）用它保持原消息类型，下游仍能按类型检查大小。
+        预算按实际到达的帧逐帧申请，声明的总长度只用于提前拒绝超限的消息；
+        声明的消息类型由调用方在解码后与内容核对。
+        """
+        held = _MessageBudget(budget) if budget is not None else None
+        frame_limit = limits.max_frame if limits is not None else None
+        payload, data_type = CommunicationProtocol.read_frame(sock, timings, frame_limit, budget=held)
+        if payload is None:
+            return None, None, None
+        if data_type != CommunicationProtocol.STREAM_START:
+            return payload, data_type, ''
+        if held is not None:
+            held.release(len(payload))  # 开始帧不属于消息负载
+
+        try:
+            total, data_type, message_type = struct.unpack(CommunicationProtocol.STREAM_HEADER, payload)
+        except struct.error:
+            raise ProtocolError("分块流开始帧格式错误")
+        data_type = data_type.decode('ascii').rstrip('\x00')
+        message_type = message_type.decode(CommunicationProtocol.ENCODING, 'replace').rstrip('\x00')
+        limit = limits.for_message(message_type) if limits is not None else None
+        if limit is not None and total > limit:
+            raise FrameTooLarge(f"消息 {message_type or '-'} 长度 {total} 超过限制 {limit}")
+        if total and (limit is None or total < limit):
+            limit = total
+
+        # 逐块读取并申请预算（不按声明的总长度预先分配，停滞的流只占用已到达的数据）
+        buffer = bytearray()
+        try:
+            while True:
+                chunk_limit = None if limit is None else limit - len(buffer)
+                if frame_limit is not None:
+                    chunk_limit = frame_limit if chunk_limit is None else min(chunk_limit, frame_limit)
+                chunk, frame_type = CommunicationProtocol.read_frame(sock, max_size=chunk_limit, budget=held)
+                if chunk is None:
+                    raise ProtocolError("连接在分块流中途断开")
+                if frame_type == CommunicationProtocol.STREAM_END:
+                    break
+                if frame_type != CommunicationProtocol.STREAM_CHUNK_TYPE:
+                    raise ProtocolError(f"分块流中出现意外的帧类型: {frame_type}")
+                buffer += chunk
+                del chunk
+            if total and len(buffer) != total:
+                raise ProtocolError(f"分块流长度不一致: 声明 {total}，实际 {len(buffer)}")
+            return buffer, data_type, message_type
+        except BaseException:
+            if held is not None and held.held:
+                held.release(held.held)
+            raise
+
+    @staticmethod
+    def send_data(sock: socket.socket, data: bytes, data_type: str = "binary") -> int:
+        """发送数据（JSON消息以分块流发送，并声明消息类型）"""
+        payload = CommunicationProtocol.encode_payload(data, data_type)
         if data_type == "json":
-            received_data = json.loads(received_data.decode(CommunicationProtocol.ENCODING))
-        
-        return received_data, data_type
+            return CommunicationProtocol.send_message(sock, payload, data_type, data.get('type', ''))
+        return CommunicationProtocol.send_frame(sock, payload, data_type)
+
+    @staticmethod
+    def receive_data(sock: socket.socket) -> tuple:
+        """接收数据"""
+        payload, data_type = CommunicationProtocol.receive_frame(sock)
+        if payload is None:
+            return None, None
+        return CommunicationProtocol.decode_payload(payload, data_type), data_type
@@ -0,0 +1,44 @@
+# shared/dtypes.py
+"""紧凑数据类型约定
+
+- 磁盘上的特征（结果缓存、模型包中的训练特征）用float16
+- 内存中的特征和BLAS计算（PCA投影、训练）用float32
+- CKKS编码只接受双精度，加密前才转换为float64
+- 对称矩阵（GMM协方差）和三角矩阵（精度矩阵的Cholesky因子）只保存上三角
+"""
+import numpy as np
+
+STORAGE_DTYPE = np.float16
+COMPUTE_DTYPE = np.float32
+_STORAGE_MAX = float(np.finfo(STORAGE_DTYPE).max)
+
+
+def to_storage(array):
+    """转换为磁盘存储类型；超出float16范围时保留float32，避免溢出为inf"""
+    array = np.asarray(array)
+    if array.size and np.abs(array).max() >= _STORAGE_MAX:
+        return array.astype(COMPUTE_DTYPE, copy=False)
+    return array.astype(STORAGE_DTYPE, copy=False)
+
+
+def to_compute(array):
+    """转换为计算类型（已是float32时不复制）"""
+    return np.asarray(array, dtype=COMPUTE_DTYPE)
+
+
+def pack_upper(matrices):
+    """(..., n, n) → (..., n(n+1)/2)，按行保存上三角（含对角线）"""
+    matrices = np.asarray(matrices)
+    rows, cols = np.triu_indices(matrices.shape[-1])
+    return matrices[..., rows, cols]
+
+
+def unpack_upper(packed, n, symmetric=True):
+    """pack_upper的逆变换；symmetric为False时下三角填0（上三角矩阵）"""
+    packed = np.asarray(packed)
+    rows, cols = np.triu_indices(n)
+    matrices = np.zeros(packed.shape[:-1] + (n, n), dtype=packed.dtype)
+    matrices[..., rows, cols] = packed
+    if symmetric:
+        matrices[..., cols, rows] = packed
+    return matrices
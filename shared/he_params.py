@@ -0,0 +1,29 @@
+# shared/he_params.py
+"""CKKS参数选择：客户端生成密钥和服务器端判定模式共用"""
+import math
+
+# 服务器端密态判定支持的多项式次数（奇数次，次数越高阈值附近越精确，乘法深度越大）
+# 3次在阈值附近无法形成阶跃，校准检验总是失败，不再提供
+DECISION_DEGREES = (5, 7, 9, 11, 13, 15)
+DEFAULT_DECISION_DEGREE = 7
+
+# 默认参数：只计算距离（一次平方）
+DEFAULT_POLY_MODULUS_DEGREE = 8192
+DEFAULT_COEFF_MOD_BIT_SIZES = (60, 40, 40, 60)
+
+# 各多项式模数次数下系数模数的总位数上限（128位安全）
+_MAX_COEFF_BITS = {8192: 218, 16384: 438, 32768: 881}
+
+
+def decision_depth(degree):
+    """密态判定所需的乘法深度：平方距离1层 + 多项式求值ceil(log2(degree+1))层"""
+    return 1 + math.ceil(math.log2(degree + 1))
+
+
+def ckks_parameters(depth):
+    """满足乘法深度的最小CKKS参数，返回(poly_modulus_degree, coeff_mod_bit_sizes)"""
+    coeff_mod_bit_sizes = [60] + [40] * depth + [60]
+    for poly_modulus_degree, max_bits in sorted(_MAX_COEFF_BITS.items()):
+        if sum(coeff_mod_bit_sizes) <= max_bits:
+            return poly_modulus_degree, coeff_mod_bit_sizes
+    raise ValueError(f"乘法深度 {depth} 超出支持范围")
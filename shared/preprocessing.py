@@ -0,0 +1,215 @@
+# shared/preprocessing.py
+"""图像预处理：训练（服务器）和推理（客户端）共用
+
+- 缩小分辨率解码：JPEG在DCT域按1/2~1/8解码（draft），多页金字塔TIFF
+  选择不小于目标尺寸的最小一层，缩放时先整数倍降采样（reducing_gap）
+- 可选进程池：大图解码不占用服务线程和GIL
+- 可选磁盘缓存：按文件内容哈希保存缩放后的uint8图像，训练和推理可共用同一目录
+"""
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZE = 224  # WideResNet默认输入尺寸
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+REDUCING_GAP = 3.0  # 缩放前先按整数倍降采样，直到比目标尺寸大约3倍
+DECODE_VERSION = 3  # 解码方式变化时递增，使旧缓存失效
+ASPECT_TOLERANCE = 0.02  # 金字塔各层与第0页宽高比的允许偏差
+HASH_CHUNK = 1 << 20
+
+
+def image_digest(image_path):
+    """图像文件内容的SHA-256，同一图像换路径或重新上传也能命中"""
+    digest = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _select_tiff_level(image, size):
+    """多页TIFF（扫描仪的金字塔图像）切换到宽高都不小于size的最小一层
+
+    只考虑与第0页宽高比一致的页，标签、宏观图、缩略图等附加页不参与选择；
+    只有面积严格小于第0页时才切换：z-stack、多切片、多通道导出的各页与第0页同尺寸，
+    仍解码第0页。
+    """
+    image.seek(0)
+    base_width, base_height = image.size
+    best, best_area = 0, base_width * base_height
+    for index in range(1, image.n_frames):
+        image.seek(index)
+        width, height = image.size
+        if width < size or height < size:
+            continue
+        # 交叉相乘比较宽高比，容许逐层降采样的取整误差
+        if abs(width * base_height - height * base_width) > ASPECT_TOLERANCE * base_width * height:
+            continue
+        if width * height < best_area:
+            best, best_area = index, width * height
+    image.seek(best)
+
+
+def decode_image(image_path, size=IMAGE_SIZE):
+    """解码并缩放为size×size的RGB图像，返回(size, size, 3)的uint8数组"""
+    with Image.open(image_path) as image:
+        if image.format == 'TIFF' and getattr(image, 'n_frames', 1) > 1:
+            _select_tiff_level(image, size)
+        # 仅对JPEG有效：解码时直接缩小到不小于目标尺寸
+        image.draft('RGB', (size, size))
+        image = image.convert('RGB')
+        image = image.resize((size, size), Image.BILINEAR, reducing_gap=REDUCING_GAP)
+        return np.asarray(image, dtype=np.uint8)
+
+
+def to_tensor(array):
+    """uint8 HWC数组 → 按ImageNet均值/标准差归一化的float32 CHW张量"""
+    # 在函数内导入：解码工作进程只需要PIL和numpy，不必加载torch
+    import torch
+    mean = torch.tensor(IMAGENET_MEAN).view(3, 1, 1)
+    std = torch.tensor(IMAGENET_STD).view(3, 1, 1)
+    tensor = torch.from_numpy(np.ascontiguousarray(array)).permute(2, 0, 1).float().div_(255)
+    return tensor.sub_(mean).div_(std)
+
+
+class TensorCache:
+    """缩放后图像的磁盘缓存，按(内容哈希, 尺寸, 解码版本)存为.npy文件
+
+    写入先写临时文件再原子改名，多个进程可以同时读写同一目录。
+    """
+
+    def __init__(self, directory, size=IMAGE_SIZE):
+        self.directory = directory
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(
+            self.directory, digest[:2], f"{digest}_{self.size}_v{DECODE_VERSION}.npy"
+        )
+
+    def get(self, digest):
+        try:
+            array = np.load(self._path(digest))
+        except (OSError, ValueError):
+            return None
+        if array.shape != (self.size, self.size, 3) or array.dtype != np.uint8:
+            return None
+        return array
+
+    def put(self, digest, array):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, path)
+
+
+def _load_array(image_path, size, cache_dir, digest):
+    """在工作进程（或调用线程）中执行：查缓存，未命中时解码并写入缓存"""
+    if cache_dir is None:
+        return decode_image(image_path, size), False
+    cache = TensorCache(cache_dir, size)
+    digest = digest or image_digest(image_path)
+    array = cache.get(digest)
+    if array is not None:
+        return array, True
+    array = decode_image(image_path, size)
+    cache.put(digest, array)
+    return array, False
+
+
+class Preprocessor:
+    """图像预处理器
+
+    workers为0时在调用线程中解码；大于0时使用进程池（以spawn方式启动，
+    避免fork时复制服务线程持有的锁），调用线程只等待结果并转换为张量。
+    cache_dir为磁盘缓存目录，None时不缓存。
+    """
+
+    def __init__(self, workers=0, cache_dir=None, size=IMAGE_SIZE):
+        self.workers = max(0, workers)
+        self.cache_dir = cache_dir
+        self.size = size
+        self.decoded = 0
+        self.cache_hits = 0
+        self._pool = None
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._pool
+
+    def _submit(self, image_path, digest=None):
+        return self._executor().submit(
+            _load_array, image_path, self.size, self.cache_dir, digest
+        )
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.decoded += 1
+
+    def load_array(self, image_path, digest=None):
+        """返回(size, size, 3)的uint8数组；digest为已算好的内容哈希（可省略）"""
+        if self.workers:
+            array, hit = self._submit(image_path, digest).result()
+        else:
+            array, hit = _load_array(image_path, self.size, self.cache_dir, digest)
+        self._count(hit)
+        return array
+
+    def load(self, image_path, digest=None):
+        """返回归一化后的float32 CHW张量"""
+        return to_tensor(self.load_array(image_path, digest))
+
+    def map(self, image_paths):
+        """按输入顺序逐个返回(路径, 张量或异常)，进程池中同时解码多张"""
+        if not self.workers:
+            for path in image_paths:
+                try:
+                    yield path, self.load(path)
+                except Exception as e:
+                    yield path, e
+            return
+        window = deque()
+        for path in image_paths:
+            window.append((path, self._submit(path)))
+            # 只预取有限数量，避免一次性为所有图像排队
+            if len(window) > 2 * self.workers:
+                yield self._collect(*window.popleft())
+        while window:
+            yield self._collect(*window.popleft())
+
+    def _collect(self, path, future):
+        try:
+            array, hit = future.result()
+        except Exception as e:
+            return path, e
+        self._count(hit)
+        return path, to_tensor(array)
+
+    def stats(self):
+        return {'workers': self.workers, 'decoded': self.decoded, 'cache_hits': self.cache_hits}
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
@@ -0,0 +1,324 @@
+# shared/transport.py
+"""传输层：按URL协议选择连接方式
+
+    tcp://host:port      TCP（默认，不带协议的 host:port 也按TCP处理）
+    unix:///path/to.sock Unix域套接字
+    shm:///path/to.sock  Unix域套接字 + 共享内存环形缓冲区，仅限同一主机
+
+shm模式下每个方向各有一个环形缓冲区，由发送方创建；大帧写入环形缓冲区，
+套接字上只传一个小的描述帧。帧过小或缓冲区空间不足时仍直接走套接字。
+"""
+import errno
+import os
+import socket
+import stat
+import struct
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+from urllib.parse import urlparse
+
+from .communication import CommunicationProtocol, FrameTooLarge
+
+DEFAULT_PORT = 8888
+SHM_RING_SIZE = 64 << 20   # 每个方向的环形缓冲区大小
+SHM_MIN_FRAME = 64 << 10   # 小于该大小的帧直接走套接字
+
+# 本进程创建且尚未unlink的缓冲区；同一进程内的两端共用一个resource_tracker
+_local_rings = set()
+
+# shm模式的控制帧类型
+_HANDSHAKE = 'SHMH'
+_DESCRIPTOR = 'SHMD'
+_DESCRIPTOR_FORMAT = '!QQ4s'  # 环形缓冲区中的位置、长度、原帧类型
+
+
+def parse_url(url):
+    """解析传输URL，返回(scheme, address)"""
+    if '://' not in url:
+        url = 'tcp://' + url
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    if scheme == 'tcp':
+        return scheme, (parsed.hostname or 'localhost',
+                        DEFAULT_PORT if parsed.port is None else parsed.port)
+    if scheme in ('unix', 'shm'):
+        path = parsed.netloc + parsed.path
+        if not path:
+            raise ValueError(f"缺少套接字路径: {url}")
+        return scheme, path
+    raise ValueError(f"不支持的传输协议: {scheme}")
+
+
+def connect(url, timeout=None):
+    """连接到服务器，返回套接字（shm模式下为ShmConnection）"""
+    scheme, address = parse_url(url)
+    if scheme == 'tcp':
+        sock = socket.create_connection(address, timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    sock.settimeout(None)
+    if scheme == 'shm':
+        return ShmConnection.client_side(sock)
+    return sock
+
+
+class Listener:
+    """监听套接字，accept时按协议包装连接"""
+
+    def __init__(self, url, backlog=5):
+        self.url = url
+        self.scheme, self.address = parse_url(url)
+        if self.scheme == 'tcp':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            self._remove_stale_socket()
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.address)
+        self.sock.listen(backlog)
+        if self.scheme == 'tcp':
+            # 端口为0时记录系统分配的端口
+            self.address = self.sock.getsockname()[:2]
+
+    def _remove_stale_socket(self):
+        """清理上次异常退出遗留的套接字文件；不是套接字或仍有服务器监听时报错"""
+        try:
+            mode = os.stat(self.address).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise OSError(errno.EEXIST, "路径已存在且不是套接字", self.address)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.address)
+        except ConnectionRefusedError:
+            os.unlink(self.address)
+            return
+        finally:
+            probe.close()
+        raise OSError(errno.EADDRINUSE, "已有服务器在该套接字上监听", self.address)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def accept(self):
+        """返回(连接, 对端描述)；shm握手推迟到连接的第一次收发，避免阻塞accept"""
+        sock, address = self.sock.accept()
+        sock.settimeout(None)
+        if self.scheme == 'tcp':
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock, address
+        peer = f"{self.scheme}://{self.address}"
+        if self.scheme == 'shm':
+            return ShmConnection(sock, server_side=True), peer
+        return sock, peer
+
+    def close(self):
+        self.sock.close()
+        if self.scheme != 'tcp' and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+def _attach(name):
+    """打开对端创建的共享内存，不交给本进程的resource_tracker清理"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _local_rings:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class ShmRing:
+    """单写单读的共享内存环形缓冲区
+
+    头部保存写位置和读位置（单调递增的字节数），写方只改写位置，读方只改读位置。
+    描述帧经套接字传递，套接字收发本身保证了数据写入对读方可见。
+    """
+
+    HEADER = 64
+    _WRITE_POS = 0
+    _READ_POS = 8
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.buf = shm.buf
+        self.capacity = shm.size - self.HEADER
+
+    @classmethod
+    def create(cls, size=SHM_RING_SIZE):
+        name = f"ppmad_{uuid.uuid4().hex[:16]}"
+        ring = cls(shared_memory.SharedMemory(name=name, create=True, size=size + cls.HEADER))
+        struct.pack_into('!QQ', ring.buf, 0, 0, 0)
+        _local_rings.add(ring.name)
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        return cls(_attach(name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def unlink(self):
+        """删除名称；已打开的映射仍然有效"""
+        self.shm.unlink()
+        _local_rings.discard(self.name)
+
+    def _get(self, offset):
+        return struct.unpack_from('!Q', self.buf, offset)[0]
+
+    def _set(self, offset, value):
+        struct.pack_into('!Q', self.buf, offset, value)
+
+    def write(self, payload):
+        """写入一帧，返回起始位置；空间不足时返回None"""
+        length = len(payload)
+        write_pos = self._get(self._WRITE_POS)
+        read_pos = self._get(self._READ_POS)
+        offset = write_pos % self.capacity
+        if read_pos == write_pos and length <= offset:
+            # 缓冲区为空时回到开头写，反复使用已映射的页面，避免缺页
+            write_pos += self.capacity - offset
+        if length > self.capacity - (write_pos - read_pos):
+            return None
+        start = write_pos % self.capacity
+        first = min(length, self.capacity - start)
+        base = self.HEADER
+        payload = memoryview(payload)  # 切片不复制
+        self.buf[base + start:base + start + first] = payload[:first]
+        if first < length:
+            self.buf[base:base + length - first] = payload[first:]
+        self._set(self._WRITE_POS, write_pos + length)
+        return write_pos
+
+    def read(self, position, length, into=None):
+        """读出一帧并释放其空间；给出into时直接复制到其中"""
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        base = self.HEADER
+        if into is not None:
+            into[:first] = self.buf[base + start:base + start + first]
+            if first < length:
+                into[first:length] = self.buf[base:base + length - first]
+            data = None
+        else:
+            data = bytes(self.buf[base + start:base + start + first])
+            if first < length:
+                data += bytes(self.buf[base:base + length - first])
+        self._set(self._READ_POS, position + length)
+        return data
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+
+class ShmConnection:
+    """Unix域套接字 + 共享内存环形缓冲区的连接
+
+    提供write_frame/read_frame，CommunicationProtocol会直接委托给它；
+    其余接口（settimeout、close等）与socket一致。
+    """
+
+    def __init__(self, sock, server_side=False, ring_size=SHM_RING_SIZE):
+        self.sock = sock
+        self.server_side = server_side
+        self.ring_size = ring_size
+        self.outbound = None
+        self.inbound = None
+        self._ready = False
+
+    @classmethod
+    def client_side(cls, sock, ring_size=SHM_RING_SIZE):
+        conn = cls(sock, server_side=False, ring_size=ring_size)
+        conn._handshake()
+        return conn
+
+    def _handshake(self):
+        """交换环形缓冲区名称；双方都打开后由创建方unlink，进程异常退出也不会遗留"""
+        send, receive = CommunicationProtocol.send_frame, CommunicationProtocol.read_frame
+        if self.server_side:
+            payload, data_type = receive(self.sock)
+            if data_type != _HANDSHAKE:
+                raise ConnectionError("共享内存握手失败")
+            self.inbound = ShmRing.attach(payload.decode('ascii'))
+            self.outbound = ShmRing.create(self.ring_size)
+            send(self.sock, self.outbound.name.encode('ascii'), _HANDSHAKE)
+            payload, data_type = receive(self.sock)  # 客户端已打开服务器的缓冲区
+            if data_type != _HANDSHAKE:
+                raise ConnectionError("共享内存握手失败")
+            self.outbound.unlink()
+        else:
+            self.outbound = ShmRing.create(self.ring_size)
+            send(self.sock, self.outbound.name.encode('ascii'), _HANDSHAKE)
+            payload, data_type = receive(self.sock)
+            if data_type != _HANDSHAKE:
+                raise ConnectionError("共享内存握手失败")
+            self.outbound.unlink()  # 服务器已打开客户端的缓冲区
+            self.inbound = ShmRing.attach(payload.decode('ascii'))
+            send(self.sock, b'ok', _HANDSHAKE)
+        self._ready = True
+
+    def write_frame(self, payload, data_type):
+        if not self._ready:
+            self._handshake()
+        position = None
+        if len(payload) >= SHM_MIN_FRAME:
+            position = self.outbound.write(payload)
+        if position is None:
+            return CommunicationProtocol.send_frame(self.sock, payload, data_type)
+        descriptor = struct.pack(
+            _DESCRIPTOR_FORMAT, position, len(payload), data_type.encode('ascii')[:4]
+        )
+        CommunicationProtocol.send_frame(self.sock, descriptor, _DESCRIPTOR)
+        return CommunicationProtocol.HEADER_SIZE + len(payload)
+
+    def read_frame(self, timings=None, max_size=None, into=None, budget=None):
+        if not self._ready:
+            try:
+                self._handshake()
+            except (ConnectionError, OSError):
+                return None, None
+        if into is not None:
+            max_size = len(into)
+        payload, data_type = CommunicationProtocol.read_frame(self.sock, timings, max_size, into, budget)
+        if data_type != _DESCRIPTOR:
+            return payload, data_type
+        if into is not None:
+            payload = into[:payload]
+        elif budget is not None:
+            budget.release(len(payload))  # 描述符本身不计入，按环形缓冲区中的帧长申请
+        position, length, data_type = struct.unpack(_DESCRIPTOR_FORMAT, payload)
+        if max_size is not None and length > max_size:
+            raise FrameTooLarge(f"帧长度 {length} 超过限制 {max_size}")
+        data_type = data_type.decode('ascii').rstrip('\x00')
+        if into is not None:
+            self.inbound.read(position, length, into)
+            return length, data_type
+        if budget is None:
+            return self.inbound.read(position, length), data_type
+        budget.acquire(length)
+        try:
+            return self.inbound.read(position, length), data_type
+        except BaseException:
+            budget.release(length)
+            raise
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+        for ring in (self.outbound, self.inbound):
+            if ring is not None:
+                ring.close()
+        self.outbound = self.inbound = None
@@ -0,0 +1,181 @@
+# tests/test_communication.py
+"""分块流、帧大小限制和接收预算"""
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+
+# 添加路径以便导入本地模块
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from shared.communication import (
+    BudgetTimeout, CommunicationProtocol, FrameLimits, FrameTooLarge, ReceiveBudget
+)
+
+Protocol = CommunicationProtocol
+
+
+def _send_async(send, *args):
+    """在后台线程发送，避免大消息填满套接字缓冲区后与接收方互相等待"""
+    thread = threading.Thread(target=send, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+        self.receiver.settimeout(10)
+        self.budget = ReceiveBudget(8 << 20, timeout=5.0)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_chunked_round_trip(self):
+        blob = os.urandom(3 * Protocol.STREAM_CHUNK + 123)
+        message = {'type': 'encrypted_features', 'request_id': 7, 'features': [blob, b'']}
+        _send_async(Protocol.send_data, self.sender, message, "json")
+
+        payload, data_type, message_type = Protocol.receive_message(
+            self.receiver, {}, FrameLimits(max_frame=Protocol.STREAM_CHUNK), self.budget
+        )
+        self.assertEqual((data_type, message_type), ("json", 'encrypted_features'))
+        # 开始帧归还，负载按实际到达的数据块计入预算
+        self.assertEqual(self.budget.in_use, len(payload))
+        data = Protocol.decode_payload(payload, data_type)
+        self.assertEqual(data, message)
+        self.budget.release(len(payload))
+        self.assertEqual(self.budget.in_use, 0)
+
+    def test_unknown_total_round_trip(self):
+        chunks = [b'a' * 1000, b'', b'b' * 10]
+        _send_async(Protocol.send_stream, self.sender, chunks, "json", 'health')
+        payload, data_type, message_type = Protocol.receive_message(
+            self.receiver, budget=self.budget
+        )
+        self.assertEqual(bytes(payload), b''.join(chunks))
+        self.assertEqual((data_type, message_type), ("json", 'health'))
+
+    def test_declared_total_over_limit(self):
+        limits = FrameLimits(per_type={'health': 1024})
+        _send_async(Protocol.send_message, self.sender, b'x' * 4096, "json", 'health')
+        with self.assertRaises(FrameTooLarge):
+            Protocol.receive_message(self.receiver, limits=limits, budget=self.budget)
+        self.assertEqual(self.budget.in_use, 0)
+
+    def test_undeclared_total_over_limit(self):
+        # 声明总长度为0时逐块检查，超限时归还已到达数据块的预算
+        limits = FrameLimits(per_type={'health': 1024})
+        chunks = [b'x' * 600, b'y' * 600]
+        _send_async(Protocol.send_stream, self.sender, chunks, "json", 'health')
+        with self.assertRaises(FrameTooLarge):
+            Protocol.receive_message(self.receiver, limits=limits, budget=self.budget)
+        self.assertEqual(self.budget.in_use, 0)
+
+    def test_plain_frame_over_max_frame(self):
+        _send_async(Protocol.send_frame, self.sender, b'x' * 2048, "binary")
+        with self.assertRaises(FrameTooLarge):
+            Protocol.receive_message(
+                self.receiver, limits=FrameLimits(max_frame=1024), budget=self.budget
+            )
+        self.assertEqual(self.budget.in_use, 0)
+
+    def test_length_mismatch(self):
+        start = struct.pack(Protocol.STREAM_HEADER, 100, b'json', b'health')
+        Protocol.send_frame(self.sender, start, Protocol.STREAM_START)
+        Protocol.send_frame(self.sender, b'x' * 10, Protocol.STREAM_CHUNK_TYPE)
+        Protocol.send_frame(self.sender, b'', Protocol.STREAM_END)
+        with self.assertRaises(ConnectionError):
+            Protocol.receive_message(self.receiver, budget=self.budget)
+        self.assertEqual(self.budget.in_use, 0)
+
+    def test_declared_type_mismatch(self):
+        # 以宽松的类型声明（public_key）发送其他请求：大小限制不能按声明放宽
+        limits = FrameLimits(per_type={'public_key': 1 << 20, 'health': 64})
+        message = {'type': 'health', 'padding': 'x' * 1000}
+        payload = Protocol.encode_payload(message, "json")
+        _send_async(Protocol.send_message, self.sender, payload, "json", 'public_key')
+        payload, data_type, declared = Protocol.receive_message(self.receiver, limits=limits)
+        request_type = Protocol.decode_payload(payload, data_type)['type']
+        self.assertEqual(declared, 'public_key')
+        self.assertFalse(limits.matches(declared, request_type, len(payload)))
+
+    def test_matches(self):
+        limits = FrameLimits(per_type={'health': 64})
+        self.assertTrue(limits.matches('health', 'health', 64))
+        self.assertTrue(limits.matches('', 'health', 10))  # 普通帧没有声明类型
+        self.assertFalse(limits.matches('health', 'health', 65))
+        self.assertFalse(limits.matches('health', 'list_models', 10))
+        self.assertFalse(limits.matches('', 'health', 65))
+
+
+class BudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+        self.receiver.settimeout(10)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_timeout_releases_message(self):
+        budget = ReceiveBudget(1000, per_connection=800, timeout=0.2)
+        budget.acquire(700)  # 其他连接占用的预算
+        _send_async(Protocol.send_stream, self.sender, [b'x' * 200, b'y' * 200], "json", 'health')
+        start = time.monotonic()
+        with self.assertRaises(BudgetTimeout):
+            Protocol.receive_message(self.receiver, budget=budget)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        # 已读入的第一块归还，只剩其他连接的占用
+        self.assertEqual(budget.in_use, 700)
+
+    def test_waits_for_release(self):
+        budget = ReceiveBudget(1000, timeout=5.0)
+        budget.acquire(900)
+        _send_async(Protocol.send_stream, self.sender, [b'x' * 300], "json", 'health')
+        threading.Timer(0.1, budget.release, (900,)).start()
+        payload, _, _ = Protocol.receive_message(self.receiver, budget=budget)
+        self.assertEqual(budget.in_use, len(payload))
+
+    def test_per_connection_cap(self):
+        budget = ReceiveBudget(1000, per_connection=500, timeout=5.0)
+        _send_async(Protocol.send_stream, self.sender, [b'x' * 300, b'y' * 300], "json", 'health')
+        with self.assertRaises(FrameTooLarge):
+            Protocol.receive_message(self.receiver, budget=budget)
+        self.assertEqual(budget.in_use, 0)
+
+    def test_oversize_request_runs_alone(self):
+        # 超过总预算的单个请求在没有其他占用时放行，避免死锁
+        budget = ReceiveBudget(100, per_connection=1000, timeout=0.2)
+        budget.acquire(500)
+        self.assertEqual(budget.in_use, 500)
+        with self.assertRaises(BudgetTimeout):
+            budget.acquire(1)
+        budget.release(500)
+        self.assertEqual(budget.in_use, 0)
+
+
+class PayloadTest(unittest.TestCase):
+
+    def test_legacy_bytes_payload(self):
+        data = {'type': 'x', 'blob': b'\x00\x01'}
+        payload = CommunicationProtocol._json_default(data['blob'])
+        legacy = ('{"type": "x", "blob": {"%s": "%s"}}' % (
+            Protocol.BYTES_KEY, payload[Protocol.BYTES_KEY])).encode('utf-8')
+        self.assertEqual(Protocol.decode_payload(legacy, "json"), data)
+
+    def test_bad_blob_reference(self):
+        payload = bytearray(Protocol.encode_payload({'blob': b'abc'}, "json"))
+        payload = payload[:-2]  # 附件被截断
+        with self.assertRaises(ConnectionError):
+            Protocol.decode_payload(payload, "json")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+# tests/test_router.py
+"""一致性哈希环和会话转移（用标准库实现的假服务器进程）"""
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+# 添加路径以便导入本地模块
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from server.router import HashRing, MedicalAIRouter
+from shared import transport
+from shared.communication import CommunicationProtocol
+
+Protocol = CommunicationProtocol
+
+
+class HashRingTest(unittest.TestCase):
+
+    NODES = ['tcp://a:1', 'tcp://b:1', 'tcp://c:1', 'tcp://d:1']
+    KEYS = [f"session-{i}" for i in range(2000)]
+
+    def assignment(self, ring, accept=None):
+        return {key: ring.lookup(key, accept) for key in self.KEYS}
+
+    def test_every_node_used(self):
+        counts = {}
+        for node in self.assignment(HashRing(self.NODES)).values():
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(set(counts), set(self.NODES))
+        self.assertGreater(min(counts.values()), len(self.KEYS) / len(self.NODES) / 3)
+
+    def test_remove_moves_only_its_keys(self):
+        ring = HashRing(self.NODES)
+        before = self.assignment(ring)
+        removed = self.NODES[1]
+        ring.remove(removed)
+        after = self.assignment(ring)
+        for key in self.KEYS:
+            if before[key] == removed:
+                self.assertNotEqual(after[key], removed)
+            else:
+                self.assertEqual(after[key], before[key])
+
+    def test_skip_matches_remove(self):
+        # 健康检查失败的进程按accept跳过，与从环上移除的结果一致
+        removed = self.NODES[2]
+        skipped = self.assignment(HashRing(self.NODES), lambda node: node != removed)
+        ring = HashRing(self.NODES)
+        ring.remove(removed)
+        self.assertEqual(skipped, self.assignment(ring))
+
+    def test_add_back_restores(self):
+        ring = HashRing(self.NODES)
+        before = self.assignment(ring)
+        ring.remove(self.NODES[0])
+        ring.add(self.NODES[0])
+        self.assertEqual(before, self.assignment(ring))
+
+    def test_no_acceptable_node(self):
+        ring = HashRing(self.NODES)
+        self.assertIsNone(ring.lookup('x', lambda node: False))
+        self.assertIsNone(HashRing().lookup('x'))
+
+
+class FakeWorker:
+    """假的服务器进程：按顺序回复请求，并记录收到的请求
+
+    crash为多个进程共用的Event：第一个收到request_id为crash_at的计算请求的进程
+    不回复并退出（关闭监听和所有连接），模拟进程崩溃。
+    """
+
+    def __init__(self, crash, crash_at, digest='model-1'):
+        self.crash = crash
+        self.crash_at = crash_at
+        self.digest = digest
+        self.received = []   # 会话请求（不含health）：(类型, request_id)
+        self.crashed = False
+        self.listener = transport.Listener('tcp://127.0.0.1:0')
+        self.url = 'tcp://%s:%d' % self.listener.address
+        self._conns = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            self._conns.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            while True:
+                data, _ = Protocol.receive_data(conn)
+                if data is None:
+                    return
+                request_type = data['type']
+                if request_type == 'health':
+                    Protocol.send_data(conn, {'status': 'success', 'draining': False}, "json")
+                    continue
+                self.received.append((request_type, data.get('request_id')))
+                if request_type == 'get_pca_params':
+                    reply = {'status': 'success', 'model_name': 'default', 'model_digest': self.digest}
+                elif request_type == 'encrypted_features':
+                    if data['request_id'] == self.crash_at and not self.crash.is_set():
+                        self.crash.set()
+                        self.crashed = True
+                        self.stop()
+                        return
+                    reply = {'status': 'success', 'request_id': data['request_id'], 'worker': self.url}
+                else:
+                    reply = {'status': 'success'}
+                Protocol.send_data(conn, reply, "json")
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.listener.sock.close()
+        for conn in self._conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class FailoverTest(unittest.TestCase):
+
+    REQUESTS = 12
+    CRASH_AT = 4
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.crash = threading.Event()
+        self.workers = []
+        self.router = None
+
+    def tearDown(self):
+        if self.router is not None:
+            self.router.stop()
+            self.router.drain(2)
+        for worker in self.workers:
+            worker.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def start(self, digests):
+        self.workers = [FakeWorker(self.crash, self.CRASH_AT, digest) for digest in digests]
+        url = 'unix://' + os.path.join(self.directory, 'router.sock')
+        self.router = MedicalAIRouter(
+            [url], [worker.url for worker in self.workers], health_interval=60, connect_timeout=2
+        )
+        threading.Thread(target=self.router.start, daemon=True).start()
+        self.assertTrue(self.router.wait_ready(5))
+        client = transport.connect(url, 5)
+        client.settimeout(10)
+        self.addCleanup(client.close)
+        return client
+
+    def run_session(self, client):
+        """上传上下文、固定模型，再流水线发送全部计算请求，返回收到的响应"""
+        Protocol.send_data(client, {'type': 'public_key', 'context': b'context-bytes'}, "json")
+        Protocol.send_data(client, {'type': 'get_pca_params'}, "json")
+        for request_id in range(1, self.REQUESTS + 1):
+            Protocol.send_data(
+                client, {'type': 'encrypted_features', 'request_id': request_id, 'features': b'x'}, "json"
+            )
+        responses = []
+        for _ in range(self.REQUESTS + 2):
+            response, _ = Protocol.receive_data(client)
+            if response is None:
+                break
+            responses.append(response)
+        return responses
+
+    def answered_before_crash(self, responses):
+        """崩溃前已回传的请求数
+
+        进程退出时连接上还有未读的请求，内核发送RST，路由器尚未读取的响应随之丢失，
+        这些请求同样需要重发；因此只能确定已回传的是前若干个请求。
+        """
+        ids = [r.get('request_id') for r in responses[2:] if 'request_id' in r]
+        answered = ids[:self.CRASH_AT - 1]
+        self.assertEqual(answered, list(range(1, len(answered) + 1)))
+        return len(answered)
+
+    def test_replay_order_after_crash(self):
+        client = self.start(['model-1', 'model-1'])
+        responses = self.run_session(client)
+
+        # 客户端按发送顺序收到每个请求恰好一个响应
+        self.assertEqual([r.get('request_id') for r in responses],
+                         [None, None] + list(range(1, self.REQUESTS + 1)))
+        self.assertTrue(all(r['status'] == 'success' for r in responses))
+        crashed = next(worker for worker in self.workers if worker.crashed)
+        survivor = next(worker for worker in self.workers if not worker.crashed)
+        served = [r['worker'] for r in responses[2:]]
+        first = served.index(survivor.url)
+        self.assertLess(first, self.CRASH_AT)
+        self.assertEqual(served, [crashed.url] * first + [survivor.url] * (self.REQUESTS - first))
+
+        # 新进程先收到补发的上下文和模型固定，再按原顺序收到未回传的请求，已回传的不再重发
+        self.assertEqual(survivor.received,
+                         [('public_key', None), ('get_pca_params', None)]
+                         + [('encrypted_features', i) for i in range(first + 1, self.REQUESTS + 1)])
+        self.assertEqual(self.router.stats()['failovers'], 1)
+
+    def test_model_mismatch_closes_session(self):
+        client = self.start(['model-1', 'model-2'])
+        responses = self.run_session(client)
+        # 转移后模型不同：不回传新进程的任何结果，断开会话
+        answered = self.answered_before_crash(responses)
+        self.assertEqual(len(responses), 2 + answered)
+
+    def test_no_worker_left(self):
+        client = self.start(['model-1'])
+        responses = self.run_session(client)
+        answered = self.answered_before_crash(responses)
+        self.assertEqual(len(responses), 2 + answered + 1)
+        self.assertEqual(responses[-1]['status'], 'error')
+
+if __name__ == '__main__':
+    unittest.main()